@@ -0,0 +1,91 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Alarm state of the points: their current value versus their levels.
+
+``evaluate()`` runs after every project sync. It compares each point's
+``current_value`` with its ``warning_level`` and ``critical_level`` in one
+UPDATE statement, so the database does the work for all points at once.
+The stored ``alarm_state``, ``alarm_since`` and ``alarm_peak`` columns then
+answer "which points are over their level right now" without looking at a
+single timeseries.
+
+Note: ``models`` imports us, so we work on the table directly.
+
+"""
+from __future__ import unicode_literals
+
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+ALARM_OK = 0
+ALARM_WARNING = 1
+ALARM_CRITICAL = 2
+ALARM_CHOICES = (
+    (ALARM_OK, _('ok')),
+    (ALARM_WARNING, _('warning')),
+    (ALARM_CRITICAL, _('critical')),
+    )
+ALARM_NAMES = {
+    ALARM_OK: 'ok',
+    ALARM_WARNING: 'warning',
+    ALARM_CRITICAL: 'critical',
+    }
+
+# A changed state restarts ``alarm_since`` and ``alarm_peak``. Otherwise the
+# peak only goes up. Unchanged rows aren't touched at all.
+EVALUATE_QUERY = """
+UPDATE lizard_geodin_point AS point SET
+    alarm_state = evaluated.state,
+    alarm_since = CASE
+        WHEN evaluated.state = %(ok)s THEN NULL
+        WHEN evaluated.state <> point.alarm_state THEN %(now)s
+        ELSE point.alarm_since END,
+    alarm_peak = CASE
+        WHEN evaluated.state = %(ok)s THEN NULL
+        WHEN evaluated.state <> point.alarm_state THEN point.current_value
+        ELSE GREATEST(point.alarm_peak, point.current_value) END
+FROM (
+    SELECT id, CASE
+        WHEN current_value >= critical_level THEN %(critical)s
+        WHEN current_value >= warning_level THEN %(warning)s
+        ELSE %(ok)s END AS state
+    FROM lizard_geodin_point
+    {where}
+) AS evaluated
+WHERE point.id = evaluated.id
+AND (evaluated.state <> point.alarm_state
+     OR (evaluated.state <> %(ok)s
+         AND point.current_value > point.alarm_peak))
+RETURNING point.measurement_id
+"""
+
+
+def evaluate(measurement_ids=None):
+    """Update the alarm state of the points, return the number changed.
+
+    Only the points of the given measurements if ``measurement_ids`` is
+    passed, otherwise all of them. The tiles of the measurements with
+    changed points get a new version, as they show the alarm states.
+    """
+    params = {'ok': ALARM_OK,
+              'warning': ALARM_WARNING,
+              'critical': ALARM_CRITICAL,
+              'now': timezone.now()}
+    where = ''
+    if measurement_ids is not None:
+        measurement_ids = list(measurement_ids)
+        if not measurement_ids:
+            return 0
+        where = 'WHERE measurement_id = ANY(%(measurement_ids)s)'
+        params['measurement_ids'] = measurement_ids
+    cursor = connection.cursor()
+    cursor.execute(EVALUATE_QUERY.format(where=where), params)
+    changed = cursor.fetchall()
+    transaction.commit_unless_managed()
+    # Imported here as models imports us.
+    from lizard_geodin.models import bump_tiles_version
+    for measurement_id in set(row[0] for row in changed):
+        if measurement_id is not None:
+            bump_tiles_version(measurement_id)
+    return len(changed)
@@ -0,0 +1,299 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Query-count and latency budgets for our views.
+
+The views are easy to break with an innocent-looking ``point.measurement``
+in a loop or template. The helpers in here create a synthetic dataset and
+render every one of our URLs against it while counting queries. Both the
+unittests (``tests.py``) and the ``benchmark_geodin_views`` management
+command use them.
+
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import time
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db import reset_queries
+
+from lizard_geodin import models
+from lizard_geodin import tiles
+
+# URL name: (maximum number of queries, maximum number of seconds). The query
+# budgets are absolute, but more important is that they don't depend on the
+# size of the dataset. The lizard-ui/lizard-map base views do a couple of
+# queries of their own, hence the headroom.
+VIEW_BUDGETS = {
+    'lizard_geodin_projects_overview': (15, 2.0),
+    'lizard_geodin_flot_data': (10, 1.0),
+    'lizard_geodin_metrics': (5, 1.0),
+    'lizard_geodin_alarms': (5, 1.0),
+    'lizard_geodin_points_geojson': (5, 1.0),
+    'lizard_geodin_tile': (5, 5.0),
+    'lizard_geodin_points_mvt': (5, 1.0),
+    'lizard_geodin_export': (10, 2.0),
+    'lizard_geodin_point_list': (15, 5.0),
+    'lizard_geodin_point': (10, 1.0),
+    'lizard_geodin_sidebar_point': (10, 1.0),
+    'lizard_geodin_multiple_points': (10, 1.0),
+    'lizard_geodin_project_view': (30, 2.0),
+    'lizard_geodin_supplier_view': (30, 2.0),
+    'lizard_geodin_measurement_view': (20, 1.0),
+    'lizard_geodin_measurement_popup_view': (10, 1.0),
+    }
+# Views that do a query per point of their output, so their number of
+# queries grows with the dataset. Their budget is for the synthetic one.
+PER_POINT_VIEWS = ('lizard_geodin_export',)
+# Zoom level of the tile that is rendered, one that shows single points.
+BENCHMARK_TILE_ZOOM = 14
+MVT_SUPPORTED_QUERY = """
+SELECT count(*) FROM pg_proc WHERE proname = 'st_asmvt'
+"""
+
+
+class QueryCount(object):
+    """Result of ``count_queries()``: filled in when the block exits."""
+    num_queries = None
+    seconds = None
+
+
+@contextmanager
+def count_queries():
+    """Count the queries (and the time) that the wrapped block needs.
+
+    Django only records queries when DEBUG is on, so we temporarily switch on
+    the debug cursor like django's own ``assertNumQueries()`` does.
+
+    """
+    result = QueryCount()
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    # Note: the test client's request_started signal resets the queries, too.
+    reset_queries()
+    start = time.time()
+    try:
+        yield result
+    finally:
+        result.seconds = time.time() - start
+        result.num_queries = len(connection.queries)
+        connection.use_debug_cursor = old_debug_cursor
+
+
+def synthetic_timeseries(num_values=48):
+    """Return geodin-like timeseries json, one value per hour."""
+    return [{'Date': '2012-09-%02dT%02d:00:00Z' % (7 + hour // 24, hour % 24),
+             'Value': hour / 10.0}
+            for hour in range(num_values)]
+
+
+def create_synthetic_dataset(num_projects=2, num_suppliers=3,
+                             num_parameters=2, points_per_measurement=5):
+    """Fill the database with a consistent set of fake geodin objects.
+
+    Every project gets a measurement for every supplier/parameter
+    combination. Points get a packed timeseries (and the matching samples)
+    so that nothing needs to be fetched from geodin.
+    Return the first point, which is handy for building URLs.
+
+    """
+    api_starting_point = models.ApiStartingPoint.objects.create(
+        slug='synthetic', name='Synthetic')
+    suppliers = [models.Supplier.objects.create(
+            slug='supplier-%s' % index, name='Supplier %s' % index)
+                 for index in range(num_suppliers)]
+    parameters = [models.Parameter.objects.create(
+            slug='parameter-%s' % index, name='Parameter %s' % index,
+            unit='m')
+                  for index in range(num_parameters)]
+    first_point = None
+    for project_index in range(num_projects):
+        project = models.Project.objects.create(
+            slug='project-%s' % project_index,
+            name='Project %s' % project_index,
+            active=True,
+            api_starting_point=api_starting_point)
+        for supplier in suppliers:
+            for parameter in parameters:
+                measurement = models.Measurement.objects.create(
+                    name='%s: %s (%s)' % (project.name, parameter.name,
+                                          supplier.name),
+                    project=project,
+                    supplier=supplier,
+                    parameter=parameter)
+                for point_index in range(points_per_measurement):
+                    slug = 'point-%s-%s' % (measurement.id, point_index)
+                    x = 4.5 + point_index * 0.001
+                    y = 52.0 + measurement.id * 0.001
+                    point = models.Point(
+                        slug=slug,
+                        name='Point %s' % slug,
+                        measurement=measurement,
+                        x=x,
+                        y=y,
+                        metadata={'Value': '1.0'},
+                        current_value=1.0)
+                    point.set_location_from_xy()
+                    the_json = synthetic_timeseries()
+                    point.pack_series(the_json)
+                    point.save()
+                    point.store_samples(the_json)
+                    if first_point is None:
+                        first_point = point
+    return first_point
+
+
+def delete_synthetic_dataset():
+    """Remove everything ``create_synthetic_dataset()`` made."""
+    for model in [models.Rollup, models.Sample, models.Point,
+                  models.Measurement, models.Project, models.ApiStartingPoint,
+                  models.Supplier, models.Parameter]:
+        model.objects.all().delete()
+
+
+def mvt_supported():
+    """Return whether postgis can build vector tiles (2.4 or higher)."""
+    cursor = connection.cursor()
+    cursor.execute(MVT_SUPPORTED_QUERY)
+    return cursor.fetchone()[0] > 0
+
+
+def view_urls(point):
+    """Return (url name, url) tuples for all our views.
+
+    The objects in the URLs are taken from the (synthetic) ``point``. The
+    vector tile is left out if postgis can't make them.
+    """
+    measurement = point.measurement
+    tile_x, tile_y = tiles.tile_for_location(point.projected_location,
+                                             BENCHMARK_TILE_ZOOM)
+    urls = [
+        ('lizard_geodin_projects_overview',
+         reverse('lizard_geodin_projects_overview')),
+        ('lizard_geodin_flot_data',
+         reverse('lizard_geodin_flot_data',
+                 kwargs={'point_id': point.id})),
+        ('lizard_geodin_metrics',
+         reverse('lizard_geodin_metrics')),
+        ('lizard_geodin_alarms',
+         reverse('lizard_geodin_alarms')),
+        ('lizard_geodin_tile',
+         reverse('lizard_geodin_tile',
+                 kwargs={'measurement_id': measurement.id,
+                         'zoom': BENCHMARK_TILE_ZOOM,
+                         'x': tile_x,
+                         'y': tile_y})),
+        ('lizard_geodin_points_mvt',
+         reverse('lizard_geodin_points_mvt',
+                 kwargs={'measurement_id': measurement.id,
+                         'zoom': BENCHMARK_TILE_ZOOM,
+                         'x': tile_x,
+                         'y': tile_y})),
+        ('lizard_geodin_export',
+         reverse('lizard_geodin_export',
+                 kwargs={'kind': 'measurement',
+                         'key': measurement.id,
+                         'output_format': 'csv'})),
+        ('lizard_geodin_points_geojson',
+         reverse('lizard_geodin_points_geojson',
+                 kwargs={'measurement_id': measurement.id})),
+        ('lizard_geodin_point_list',
+         reverse('lizard_geodin_point_list')),
+        ('lizard_geodin_point',
+         reverse('lizard_geodin_point', kwargs={'slug': point.slug})),
+        ('lizard_geodin_sidebar_point',
+         reverse('lizard_geodin_sidebar_point',
+                 kwargs={'slug': point.slug})),
+        ('lizard_geodin_multiple_points',
+         reverse('lizard_geodin_multiple_points')),
+        ('lizard_geodin_project_view',
+         reverse('lizard_geodin_project_view',
+                 kwargs={'slug': measurement.project.slug})),
+        ('lizard_geodin_supplier_view',
+         reverse('lizard_geodin_supplier_view',
+                 kwargs={'slug': measurement.supplier.slug})),
+        ('lizard_geodin_measurement_view',
+         reverse('lizard_geodin_measurement_view',
+                 kwargs={'measurement_id': measurement.id})),
+        ('lizard_geodin_measurement_popup_view',
+         reverse('lizard_geodin_measurement_popup_view',
+                 kwargs={'measurement_id': measurement.id})),
+        ]
+    if not mvt_supported():
+        urls = [(url_name, url) for url_name, url in urls
+                if url_name != 'lizard_geodin_points_mvt']
+    return urls
+
+
+def read_content(response):
+    """Return the response's body, a streamed one only queries now."""
+    if getattr(response, 'streaming', False):
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def render_all_views(client, point):
+    """Render every view with the test client; return the measurements.
+
+    What you get back is a list of (url name, url, status code, number of
+    queries, seconds) tuples.
+
+    """
+    result = []
+    for url_name, url in view_urls(point):
+        # The flot data is cached, which would hide the real query count.
+        cache.clear()
+        with count_queries() as counted:
+            response = client.get(url)
+            read_content(response)
+        result.append((url_name, url, response.status_code,
+                       counted.num_queries, counted.seconds))
+    return result
+
+
+def budget_violations(measurements):
+    """Return human-readable strings for measurements over their budget."""
+    violations = []
+    for url_name, url, status_code, num_queries, seconds in measurements:
+        max_queries, max_seconds = VIEW_BUDGETS[url_name]
+        if num_queries > max_queries:
+            violations.append("%s: %s queries (budget %s)" % (
+                    url, num_queries, max_queries))
+        if seconds > max_seconds:
+            violations.append("%s: %.2fs (budget %.2fs)" % (
+                    url, seconds, max_seconds))
+    return violations
+
+
+def lookup_querysets(point):
+    """Return (description, queryset) of the lookups the sync and views do.
+
+    The lookups are for the objects around the (synthetic) ``point``.
+    """
+    measurement = point.measurement
+    project = measurement.project
+    return [
+        ('Point by slug',
+         models.Point.objects.filter(slug=point.slug)),
+        ('Supplier by slug',
+         models.Supplier.objects.filter(slug=measurement.supplier.slug)),
+        ('Parameter by slug',
+         models.Parameter.objects.filter(slug=measurement.parameter.slug)),
+        ('Active project by slug',
+         models.Project.objects.filter(slug=project.slug, active=True)),
+        ('Measurement by project/parameter/supplier',
+         models.Measurement.objects.filter(project=project,
+                                           parameter=measurement.parameter,
+                                           supplier=measurement.supplier)),
+        ('Points in bounding box',
+         models.Point.objects.filter(
+                location__bboverlaps=point.location.buffer(0.001))),
+        ]
+
+
+def explain(queryset):
+    """Return postgres' query plan of the queryset as a list of lines."""
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN ' + sql, params)
+    return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,76 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Grid clustering of points in google's spherical mercator projection.
+
+Per zoom level, the map is divided into square cells of ``CLUSTER_PIXELS``
+pixels. All points in a cell become one cluster at the points' average
+location. ``Measurement.update_clusters()`` stores the clusters for the zoom
+levels in ``CLUSTER_ZOOM_LEVELS``; from ``FIRST_POINTS_ZOOM`` on we show the
+individual points.
+
+"""
+from __future__ import unicode_literals
+import math
+
+TILE_SIZE = 256
+# Meters per pixel at zoom level 0.
+INITIAL_RESOLUTION = 2 * math.pi * 6378137 / TILE_SIZE
+FIRST_POINTS_ZOOM = 14
+CLUSTER_ZOOM_LEVELS = range(FIRST_POINTS_ZOOM)
+CLUSTER_PIXELS = 40
+# Radius of the mouse hover search, lizard-map uses about this many pixels.
+HOVER_RADIUS_PIXELS = 10
+
+
+def resolution(zoom):
+    """Return meters per pixel at the zoom level."""
+    return INITIAL_RESOLUTION / 2 ** zoom
+
+
+def zoom_for_resolution(meters_per_pixel):
+    """Return the zoom level closest to the resolution."""
+    if meters_per_pixel <= 0:
+        return FIRST_POINTS_ZOOM
+    zoom = int(round(math.log(INITIAL_RESOLUTION / meters_per_pixel, 2)))
+    return max(zoom, 0)
+
+
+def use_clusters(zoom):
+    return zoom is not None and zoom < FIRST_POINTS_ZOOM
+
+
+def zoom_from_wms_request(request):
+    """Return zoom level of a WMS GetMap request (in google), or None."""
+    if request is None:
+        return None
+    params = dict((key.lower(), value) for key, value in request.GET.items())
+    try:
+        west, south, east, north = [float(value) for value in
+                                    params['bbox'].split(',')]
+        width = int(params['width'])
+    except (KeyError, ValueError):
+        return None
+    if width <= 0:
+        return None
+    return zoom_for_resolution((east - west) / width)
+
+
+def grid_clusters(points, zoom, cell_pixels=CLUSTER_PIXELS):
+    """Return (x, y, number of points, worst state) clusters.
+
+    ``points`` is an iterable of (x, y, state) in google coordinates. The
+    state is one of the ``ALARM_*`` numbers, higher is worse.
+    """
+    cell_size = resolution(zoom) * cell_pixels
+    cells = {}
+    for x, y, state in points:
+        key = (int(math.floor(x / cell_size)), int(math.floor(y / cell_size)))
+        cell = cells.get(key)
+        if cell is None:
+            cells[key] = [x, y, 1, state]
+        else:
+            cell[0] += x
+            cell[1] += y
+            cell[2] += 1
+            cell[3] = max(cell[3], state)
+    return [(sum_x / count, sum_y / count, count, worst_state)
+            for sum_x, sum_y, count, worst_state in cells.values()]
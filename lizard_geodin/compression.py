@@ -0,0 +1,224 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Compact binary encoding of a timeseries, like facebook's gorilla.
+
+Geodin's series are evenly spaced timestamps with slowly changing values,
+which compresses very well:
+
+- Timestamps (whole seconds) are stored as the difference between
+  consecutive deltas: for an evenly spaced series that's a single 0 bit per
+  timestamp.
+
+- Values are XOR-ed with the previous value. Equal values take a single
+  bit; similar values only differ in a couple of bits in the middle, and
+  only those are stored.
+
+``pack()`` and ``unpack()`` convert between ``array`` timestamps/values
+and the bytes; ``pack_json()`` starts from geodin's json. Missing values
+are stored as NaN.
+
+"""
+from __future__ import unicode_literals
+from array import array
+import calendar
+import json
+import struct
+import time
+
+VERSION = 1
+# Version, number of values, first timestamp, first value.
+HEADER = struct.Struct(b'>BIqd')
+# (prefix bits, prefix length, number of value bits) of the
+# delta-of-delta buckets, see ``_write_timestamp()``.
+TIMESTAMP_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+NAN = float('nan')
+
+
+def float_to_bits(value):
+    return struct.unpack(b'>Q', struct.pack(b'>d', value))[0]
+
+
+def bits_to_float(bits):
+    return struct.unpack(b'>d', struct.pack(b'>Q', bits))[0]
+
+
+class BitWriter(object):
+
+    def __init__(self):
+        self.output = bytearray()
+        self.buffer = 0
+        self.num_bits = 0
+
+    def write(self, value, num_bits):
+        self.buffer = (self.buffer << num_bits) | value
+        self.num_bits += num_bits
+        while self.num_bits >= 8:
+            self.num_bits -= 8
+            self.output.append((self.buffer >> self.num_bits) & 0xff)
+        self.buffer &= (1 << self.num_bits) - 1
+
+    def getvalue(self):
+        """Return the bytes, padding the last one with zeros."""
+        output = bytearray(self.output)
+        if self.num_bits:
+            output.append((self.buffer << (8 - self.num_bits)) & 0xff)
+        return bytes(output)
+
+
+class BitReader(object):
+
+    def __init__(self, data, position=0):
+        self.data = bytearray(data)
+        self.position = position
+        self.buffer = 0
+        self.num_bits = 0
+
+    def read(self, num_bits):
+        while self.num_bits < num_bits:
+            self.buffer = (self.buffer << 8) | self.data[self.position]
+            self.position += 1
+            self.num_bits += 8
+        self.num_bits -= num_bits
+        value = self.buffer >> self.num_bits
+        self.buffer &= (1 << self.num_bits) - 1
+        return value
+
+
+def _write_timestamp(writer, delta_of_delta):
+    if delta_of_delta == 0:
+        writer.write(0, 1)
+        return
+    for prefix, prefix_length, num_bits in TIMESTAMP_BUCKETS:
+        offset = (1 << (num_bits - 1)) - 1
+        if -offset <= delta_of_delta <= offset + 1:
+            writer.write(prefix, prefix_length)
+            writer.write(delta_of_delta + offset, num_bits)
+            return
+    writer.write(0b1111, 4)
+    writer.write(delta_of_delta & 0xffffffff, 32)
+
+
+def _read_timestamp(reader):
+    # The prefix is a run of up to four ones, ended by a zero.
+    ones = 0
+    while ones <= len(TIMESTAMP_BUCKETS) and reader.read(1):
+        ones += 1
+    if ones == 0:
+        return 0
+    if ones <= len(TIMESTAMP_BUCKETS):
+        num_bits = TIMESTAMP_BUCKETS[ones - 1][2]
+        offset = (1 << (num_bits - 1)) - 1
+        return reader.read(num_bits) - offset
+    value = reader.read(32)
+    if value & 0x80000000:
+        value -= 1 << 32
+    return value
+
+
+def pack(timestamps, values):
+    """Return bytes with the timestamps (seconds) and float values."""
+    if not len(timestamps):
+        return HEADER.pack(VERSION, 0, 0, 0.0)
+    writer = BitWriter()
+    previous_timestamp = timestamps[0]
+    previous_delta = 0
+    previous_bits = float_to_bits(values[0])
+    previous_leading, previous_trailing = 65, 0  # No window yet.
+    for timestamp, value in zip(timestamps[1:], values[1:]):
+        delta = timestamp - previous_timestamp
+        _write_timestamp(writer, delta - previous_delta)
+        previous_timestamp, previous_delta = timestamp, delta
+
+        bits = float_to_bits(value)
+        xor = bits ^ previous_bits
+        previous_bits = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if (leading >= previous_leading and
+            trailing >= previous_trailing):
+            # Fits in the previous window.
+            writer.write(0b10, 2)
+            writer.write(xor >> previous_trailing,
+                         64 - previous_leading - previous_trailing)
+            continue
+        meaningful = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        writer.write(meaningful & 0x3f, 6)  # 64 is stored as 0.
+        writer.write(xor >> trailing, meaningful)
+        previous_leading, previous_trailing = leading, trailing
+    return (HEADER.pack(VERSION, len(timestamps), timestamps[0], values[0]) +
+            writer.getvalue())
+
+
+def unpack(data):
+    """Return (timestamps, values) arrays from ``pack()``'s bytes."""
+    version, count, timestamp, value = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unknown packed series version %s" % version)
+    timestamps = array(b'l')
+    values = array(b'd')
+    if not count:
+        return timestamps, values
+    timestamps.append(timestamp)
+    values.append(value)
+    reader = BitReader(data, HEADER.size)
+    delta = 0
+    bits = float_to_bits(value)
+    leading = trailing = 0
+    for _ in range(count - 1):
+        delta += _read_timestamp(reader)
+        timestamp += delta
+        timestamps.append(timestamp)
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        values.append(bits_to_float(bits))
+    return timestamps, values
+
+
+def json_to_arrays(the_json):
+    """Return (timestamps, values) arrays from geodin's timeseries json."""
+    # Imported here as models imports us.
+    from lizard_geodin.models import parse_geodin_date
+    timestamps = array(b'l')
+    values = array(b'd')
+    for timestep in the_json or []:
+        try:
+            date = parse_geodin_date(timestep['Date'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        timestamps.append(calendar.timegm(date.utctimetuple()))
+        try:
+            values.append(float(timestep['Value']))
+        except (KeyError, TypeError, ValueError):
+            values.append(NAN)
+    return timestamps, values
+
+
+def pack_json(the_json):
+    return pack(*json_to_arrays(the_json))
+
+
+def benchmark(the_json, repeat=10):
+    """Return dict comparing json and packed size and decode time."""
+    json_data = json.dumps(the_json)
+    packed = pack_json(the_json)
+    start = time.time()
+    for _ in range(repeat):
+        json.loads(json_data)
+    json_seconds = (time.time() - start) / repeat
+    start = time.time()
+    for _ in range(repeat):
+        unpack(packed)
+    packed_seconds = (time.time() - start) / repeat
+    return {'num_values': len(the_json),
+            'json_bytes': len(json_data),
+            'packed_bytes': len(packed),
+            'json_seconds': json_seconds,
+            'packed_seconds': packed_seconds}
@@ -0,0 +1,271 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Streaming csv/ndjson exports of the sample history.
+
+Everything in here is a generator: samples are read per point in chunks of
+``CHUNK_SIZE`` rows (keyset pagination on the timestamp, so every chunk is
+an index range scan) and written out per chunk. Memory use doesn't depend
+on the number of points or samples. Both the export view and the
+``export_timeseries`` management command use it.
+
+The ``export_parquet`` management command uses the day partition helpers
+at the bottom.
+
+"""
+from __future__ import unicode_literals
+from cStringIO import StringIO
+import csv
+import datetime
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import connection
+import pytz
+
+from lizard_geodin import history
+from lizard_geodin import models
+
+CHUNK_SIZE = 5000
+FORMATS = {'csv': 'text/csv; charset=utf-8',
+           'ndjson': 'application/x-ndjson'}
+RAW = 'raw'
+AUTO = 'auto'
+RAW_FIELDS = ('point', 'timestamp', 'value')
+ROLLUP_FIELDS = ('point', 'timestamp', 'value', 'min', 'max', 'count')
+
+SAMPLES_CHUNK_QUERY = """
+SELECT extract(epoch FROM timestamp), timestamp, value
+FROM lizard_geodin_sample
+WHERE point_id = %(point_id)s
+AND timestamp >= %(start)s AND timestamp < %(end)s
+AND timestamp > %(after)s
+ORDER BY timestamp
+LIMIT %(limit)s
+"""
+ROLLUPS_CHUNK_QUERY = """
+SELECT extract(epoch FROM bucket_start), bucket_start,
+    sum_value / num_values, min_value, max_value, num_values
+FROM lizard_geodin_rollup
+WHERE point_id = %(point_id)s
+AND level = %(level)s
+AND bucket_start >= %(start)s - %(level)s * interval '1 second'
+AND bucket_start < %(end)s
+AND bucket_start > %(after)s
+ORDER BY bucket_start
+LIMIT %(limit)s
+"""
+# Lower than any timestamp, for the first chunk.
+BEGINNING = datetime.datetime(1900, 1, 1)
+DAY_ROWS_QUERY = """
+SELECT point.slug, extract(epoch FROM sample.timestamp), sample.value,
+    supplier.slug, parameter.slug, parameter.unit
+FROM lizard_geodin_sample sample
+JOIN lizard_geodin_point point ON point.id = sample.point_id
+JOIN lizard_geodin_measurement measurement
+    ON measurement.id = point.measurement_id
+LEFT JOIN lizard_geodin_supplier supplier
+    ON supplier.id = measurement.supplier_id
+LEFT JOIN lizard_geodin_parameter parameter
+    ON parameter.id = measurement.parameter_id
+WHERE point.measurement_id = %(measurement_id)s
+AND sample.timestamp >= %(start)s AND sample.timestamp < %(end)s
+ORDER BY point.slug, sample.timestamp
+"""
+DAY_COLUMNS = ('point', 'timestamp', 'value', 'supplier', 'parameter',
+               'unit')
+STATE_FILENAME = '_state.json'
+# Partition of the measurements without project.
+NO_PROJECT = '__none__'
+# Default for GEODIN_LOOKBACK_DAYS: how far back geodin's timeseries go.
+# Downloads can still add samples to those days.
+LOOKBACK_DAYS = 7
+
+
+def select_points(measurement_id=None, supplier_slug=None,
+                  project_slug=None):
+    """Return the points of a measurement, supplier or project."""
+    points = models.Point.objects.all()
+    if measurement_id is not None:
+        points = points.filter(measurement=measurement_id)
+    if supplier_slug is not None:
+        points = points.filter(measurement__supplier__slug=supplier_slug)
+    if project_slug is not None:
+        points = points.filter(measurement__project__slug=project_slug)
+    return points
+
+
+def level(resolution, start, end, width=history.WIDTH):
+    """Return rollup level for the resolution option, None for raw.
+
+    ``resolution`` is ``'raw'``, ``'auto'`` (the coarsest level that still
+    gives ``width`` values) or a rollup level in seconds.
+    """
+    if resolution == RAW:
+        return None
+    if resolution == AUTO:
+        return history.resolution(start, end, width)
+    resolution = int(resolution)
+    if resolution not in history.RESOLUTIONS:
+        raise ValueError("Unknown resolution %s" % resolution)
+    return resolution
+
+
+def fields(rollup_level):
+    return RAW_FIELDS if rollup_level is None else ROLLUP_FIELDS
+
+
+def rows(points, start, end, rollup_level=None):
+    """Yield (point slug, aware datetime, value[, min, max, count]) tuples.
+
+    Per point in id order, in time order.
+    """
+    point_ids = points.order_by('id').values_list('id', 'slug')
+    query = ROLLUPS_CHUNK_QUERY if rollup_level else SAMPLES_CHUNK_QUERY
+    cursor = connection.cursor()
+    for point_id, slug in point_ids.iterator():
+        params = {'point_id': point_id,
+                  'level': rollup_level,
+                  'start': history.db_datetime(start),
+                  'end': history.db_datetime(end),
+                  'after': BEGINNING,
+                  'limit': CHUNK_SIZE}
+        while True:
+            cursor.execute(query, params)
+            chunk = cursor.fetchall()
+            for row in chunk:
+                timestamp = datetime.datetime.fromtimestamp(float(row[0]),
+                                                            pytz.utc)
+                yield (slug, timestamp) + tuple(row[2:])
+            if len(chunk) < CHUNK_SIZE:
+                break
+            # Continue after the last timestamp, as the database gave it.
+            params['after'] = chunk[-1][1]
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def as_csv(rows, field_names):
+    """Yield csv text, a chunk of rows at a time."""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(field_names)
+    yield output.getvalue()
+    for chunk in _chunks(rows):
+        output = StringIO()
+        writer = csv.writer(output)
+        for row in chunk:
+            writer.writerow([row[0].encode('utf-8'), row[1].isoformat()] +
+                            [repr(value) if isinstance(value, float)
+                             else value for value in row[2:]])
+        yield output.getvalue()
+
+
+def as_ndjson(rows, field_names):
+    """Yield newline-delimited json, a chunk of rows at a time."""
+    for chunk in _chunks(rows):
+        yield ''.join(
+            json.dumps(dict(zip(field_names,
+                                (row[0], row[1].isoformat()) + row[2:]))) +
+            '\n'
+            for row in chunk)
+
+
+def export(points, start, end, output_format='csv', rollup_level=None):
+    """Yield the points' samples (or rollups) as csv or ndjson."""
+    renderer = as_csv if output_format == 'csv' else as_ndjson
+    return renderer(rows(points, start, end, rollup_level),
+                    fields(rollup_level))
+
+
+def day_start(date):
+    """Return midnight (UTC) of the aware datetime's day."""
+    date = date.astimezone(pytz.utc)
+    return datetime.datetime(date.year, date.month, date.day,
+                             tzinfo=pytz.utc)
+
+
+def days(first, end):
+    """Yield the start of every day from ``first``'s until ``end``."""
+    day = day_start(first)
+    while day + datetime.timedelta(days=1) <= end:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def complete_until(now):
+    """Return the end of the days that won't get new samples anymore.
+
+    That's midnight before the days that geodin's downloads still cover.
+    """
+    lookback_days = getattr(settings, 'GEODIN_LOOKBACK_DAYS', LOOKBACK_DAYS)
+    return day_start(now) - datetime.timedelta(days=lookback_days)
+
+
+def partition_path(output_dir, project_slug, measurement_id, day):
+    """Return hive-style path of a measurement's day partition.
+
+    Measurements without project (``project_slug`` None) go into the
+    ``NO_PROJECT`` partition.
+    """
+    return os.path.join(output_dir,
+                        'project=%s' % (project_slug or NO_PROJECT),
+                        'measurement=%s' % measurement_id,
+                        'day=%s' % day.strftime('%Y-%m-%d'),
+                        'samples.parquet')
+
+
+def day_columns(measurement_id, day):
+    """Return dict of column lists with the measurement's samples of a day.
+
+    Timestamps are in ms since the epoch (UTC). The rows are read in
+    chunks of ``CHUNK_SIZE``, so only the columns take memory.
+    """
+    cursor = connection.cursor()
+    cursor.execute(DAY_ROWS_QUERY, {
+            'measurement_id': measurement_id,
+            'start': history.db_datetime(day),
+            'end': history.db_datetime(day + datetime.timedelta(days=1))})
+    columns = dict((name, []) for name in DAY_COLUMNS)
+    while True:
+        chunk = cursor.fetchmany(CHUNK_SIZE)
+        if not chunk:
+            break
+        for row in chunk:
+            for name, value in zip(DAY_COLUMNS, row):
+                if name == 'timestamp':
+                    value = int(round(float(value) * 1000))
+                columns[name].append(value)
+    return columns
+
+
+def read_state(output_dir):
+    """Return {measurement id: last exported day} of the output dir."""
+    path = os.path.join(output_dir, STATE_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as state_file:
+        state = json.load(state_file)
+    return dict((int(measurement_id),
+                 datetime.datetime.strptime(day, '%Y-%m-%d').replace(
+                    tzinfo=pytz.utc))
+                for measurement_id, day in state.items())
+
+
+def write_state(output_dir, state):
+    """Atomically write the state that ``read_state()`` reads."""
+    state = dict((str(measurement_id), day.strftime('%Y-%m-%d'))
+                 for measurement_id, day in state.items())
+    handle, temp_path = tempfile.mkstemp(dir=output_dir)
+    with os.fdopen(handle, 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.rename(temp_path, os.path.join(output_dir, STATE_FILENAME))
@@ -0,0 +1,174 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Querying the points' sample history for arbitrary periods.
+
+A graph can't show more values than it is wide, so ``sample_line()`` picks
+a resolution from the requested period and width: the raw samples for short
+periods, otherwise the coarsest of the 10 minute, hourly or daily rollups
+that still has a value per pixel. The rollups (min/max/sum/count per bucket)
+are kept up to date by ``update_rollups()`` whenever new samples come in.
+Both the samples and the rollups are read with range scans on their
+(point, [level,] time) indexes.
+
+Note: ``models`` imports us, so we work on the tables directly.
+
+"""
+from __future__ import unicode_literals
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+import dateutil.parser
+import pytz
+
+# Default graph width in pixels.
+WIDTH = 800
+# Rollup levels: bucket sizes in seconds.
+RESOLUTIONS = (10 * 60, 60 * 60, 24 * 60 * 60)
+DEFAULT_PERIOD = datetime.timedelta(days=7)
+# Someone recalculating the same buckets at the same time makes our insert
+# fail. Retrying works: by then their rollups are visible to our delete.
+ROLLUP_ATTEMPTS = 3
+
+SAMPLES_QUERY = """
+SELECT extract(epoch FROM timestamp), value
+FROM lizard_geodin_sample
+WHERE point_id = %(point_id)s
+AND timestamp >= %(start)s AND timestamp < %(end)s
+ORDER BY timestamp
+"""
+ROLLUPS_QUERY = """
+SELECT extract(epoch FROM bucket_start), sum_value / num_values
+FROM lizard_geodin_rollup
+WHERE point_id = %(point_id)s
+AND level = %(resolution)s
+AND bucket_start >= %(start)s - %(resolution)s * interval '1 second'
+AND bucket_start < %(end)s
+ORDER BY bucket_start
+"""
+# The buckets that the period touches, as timestamptz expressions.
+FIRST_BUCKET = """to_timestamp(floor(
+    extract(epoch FROM %(start)s::timestamptz) / %(level)s) * %(level)s)"""
+LAST_BUCKET = """to_timestamp(floor(
+    extract(epoch FROM %(end)s::timestamptz) / %(level)s) * %(level)s)"""
+DELETE_ROLLUPS_QUERY = """
+DELETE FROM lizard_geodin_rollup
+WHERE point_id = %(point_id)s
+AND level = %(level)s
+AND bucket_start >= {first}
+AND bucket_start <= {last}
+""".format(first=FIRST_BUCKET, last=LAST_BUCKET)
+INSERT_ROLLUPS_QUERY = """
+INSERT INTO lizard_geodin_rollup
+    (point_id, level, bucket_start, min_value, max_value, sum_value,
+     num_values)
+SELECT point_id, %(level)s,
+    to_timestamp(floor(extract(epoch FROM timestamp) / %(level)s)
+                 * %(level)s) AS bucket,
+    min(value), max(value), sum(value), count(*)
+FROM lizard_geodin_sample
+WHERE point_id = %(point_id)s
+AND timestamp >= {first}
+AND timestamp < {last} + %(level)s * interval '1 second'
+GROUP BY point_id, bucket
+""".format(first=FIRST_BUCKET, last=LAST_BUCKET)
+
+
+def parse_time(value):
+    """Return aware datetime from an iso date or a timestamp in ms.
+
+    Flot works with milliseconds, humans with dates. Dates without a
+    timezone are assumed to be in UTC, like geodin's. Raise ValueError for
+    unparseable values.
+    """
+    if value.isdigit():
+        return datetime.datetime.fromtimestamp(int(value) / 1000.0, pytz.utc)
+    date = dateutil.parser.parse(value)
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, pytz.utc)
+    return date
+
+
+def db_datetime(date):
+    """Return aware ``date`` the way the database wants it."""
+    if settings.USE_TZ:
+        return date
+    return timezone.make_naive(date, timezone.get_default_timezone())
+
+
+def from_db_datetime(date):
+    """Return the database's ``date`` as aware datetime."""
+    if timezone.is_naive(date):
+        return timezone.make_aware(date, timezone.get_default_timezone())
+    return date
+
+
+def now():
+    """Return the current time as aware datetime."""
+    return from_db_datetime(timezone.now())
+
+
+def period(start=None, end=None):
+    """Return (start, end), filling in the missing one(s)."""
+    if end is None:
+        end = now()
+    if start is None:
+        start = end - DEFAULT_PERIOD
+    return start, end
+
+
+def resolution(start, end, width=WIDTH):
+    """Return the rollup level to use for the period, None means raw.
+
+    That's the coarsest level that still has ``width`` values.
+    """
+    seconds = (end - start).total_seconds()
+    for level in reversed(RESOLUTIONS):
+        if seconds / level >= width:
+            return level
+    return None
+
+
+def sample_line(point_id, start, end, width=WIDTH):
+    """Return [(aware datetime, value), ...] of the point's samples.
+
+    For the rollups, the value is the bucket's average.
+    """
+    params = {'point_id': point_id,
+              'start': db_datetime(start),
+              'end': db_datetime(end),
+              'resolution': resolution(start, end, width)}
+    query = SAMPLES_QUERY if params['resolution'] is None else ROLLUPS_QUERY
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    return [(datetime.datetime.fromtimestamp(float(epoch), pytz.utc), value)
+            for epoch, value in cursor.fetchall()]
+
+
+def update_rollups(point_id, start, end):
+    """Recalculate the point's rollups of the buckets from start to end.
+
+    Call it with the first and last timestamp of new samples: only the
+    buckets they fall in are recalculated, from the samples.
+    """
+    cursor = connection.cursor()
+    for level in RESOLUTIONS:
+        params = {'point_id': point_id,
+                  'level': level,
+                  'start': start,
+                  'end': end}
+        for attempt in range(1, ROLLUP_ATTEMPTS + 1):
+            savepoint = transaction.savepoint()
+            try:
+                cursor.execute(DELETE_ROLLUPS_QUERY, params)
+                cursor.execute(INSERT_ROLLUPS_QUERY, params)
+            except IntegrityError:
+                transaction.savepoint_rollback(savepoint)
+                if attempt == ROLLUP_ATTEMPTS:
+                    raise
+                continue
+            transaction.savepoint_commit(savepoint)
+            break
+    transaction.commit_unless_managed()
@@ -1,24 +1,33 @@
 # Lots of copy/paste from lizard-riool, btw.  [reinout]
 # from __future__ import unicode_literals  # Mapnik dislikes this.
+import json
 import logging
 import os
 
 from django.conf import settings
 from django.contrib.gis import geos
-from django.shortcuts import get_object_or_404
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db import transaction
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+from django.http import Http404
 from django.template.loader import render_to_string
 from lizard_map import coordinates
-from lizard_map.mapnik_helper import add_datasource_point
 from lizard_map.models import ICON_ORIGINALS
 from lizard_map.models import WorkspaceItemError
 from lizard_map.symbol_manager import SymbolManager
 from lizard_map.workspace import WorkspaceItemAdapter
 import mapnik
 
+from lizard_geodin import clustering
 from lizard_geodin import models
+from lizard_geodin import spatialindex
 
 
 EPSILON = 0.0001
+EXTENT_CACHE_KEY = 'geodin_extent_{id}_{version}'
+EXTENT_CACHE_TIMEOUT = 24 * 60 * 60  # The points version invalidates it.
 
 DATABASE = settings.DATABASES['default']
 PARAMS = {
@@ -27,13 +36,50 @@ PARAMS = {
     'user': DATABASE['USER'],
     'password': DATABASE['PASSWORD'],
     'dbname': DATABASE['NAME'],
-    # 'srid': models.SRID,
+    'srid': 4326,  # Point.location is WGS84.
 }
+# Mapnik fills in the bounding box of the requested tile for ``!bbox!``, so
+# postgis only returns the points in view (using the spatial index).
+POINTS_QUERY = """(
+    SELECT id, location
+    FROM lizard_geodin_point
+    WHERE measurement_id = %(measurement_id)d
+    AND location && !bbox!
+) AS points"""
+CLUSTERS_QUERY = """(
+    SELECT id, location, num_points, worst_state
+    FROM lizard_geodin_pointcluster
+    WHERE measurement_id = %(measurement_id)d
+    AND zoom = %(zoom)d
+    AND location && !bbox!
+) AS clusters"""
+# Hover search: ``<->`` walks the gist index on the projected location in
+# distance order (KNN), ST_DWithin limits it to the search radius.
+NEAREST_POINTS_QUERY = """
+    SELECT id, name,
+        ST_Distance(projected_location,
+                    ST_SetSRID(ST_MakePoint(%s, %s), 3857)) AS distance
+    FROM lizard_geodin_point
+    WHERE measurement_id = %s
+    AND ST_DWithin(projected_location,
+                   ST_SetSRID(ST_MakePoint(%s, %s), 3857), %s)
+    ORDER BY projected_location <-> ST_SetSRID(ST_MakePoint(%s, %s), 3857)
+    LIMIT %s"""
+NUM_SEARCH_RESULTS = 5
+POPUP_MAX_GRAPH_POINTS = 200
+CLUSTER_TEXT_COLORS = {
+    models.ALARM_OK: '#000000',
+    models.ALARM_WARNING: models.CSS_WARNING_COLOR,
+    models.ALARM_CRITICAL: models.CSS_CRITICAL_COLOR,
+    }
 ICON_STYLE = {'icon': 'meetpuntPeil.png',
               'mask': ('meetpuntPeil_mask.png', ),
               'color': (0, 0, 1, 0)}
 ICON_SIZE = (10, 10)  # Normally they're 16x16.
 logger = logging.getLogger(__name__)
+# (icon, color, size) -> mapnik style, see ``points_style()``.
+_STYLE_CACHE = {}
+_styles_prewarmed = False
 
 
 def html_to_mapnik(color):
@@ -42,12 +88,159 @@ def html_to_mapnik(color):
     return rr / 255.0, gg / 255.0, bb / 255.0, 1.0
 
 
+def supplier_color(supplier):
+    """Return the supplier's html color as mapnik color tuple."""
+    override_color = supplier and supplier.html_color
+    if override_color:
+        override_color = override_color.lstrip('#')
+        try:
+            return html_to_mapnik(override_color)
+        except ValueError:
+            pass
+    return ICON_STYLE['color']
+
+
+def _point_symbolizer(color):
+    symbol_manager = SymbolManager(
+        ICON_ORIGINALS,
+        os.path.join(settings.MEDIA_ROOT, 'generated_icons'))
+    icon = ICON_STYLE['icon']
+    mask = ICON_STYLE['mask']
+    output_filename = symbol_manager.get_symbol_transformed(
+        icon, mask=mask, color=color, icon=icon, size=ICON_SIZE)
+    output_filename_abs = os.path.join(
+        settings.MEDIA_ROOT, 'generated_icons', output_filename)
+    # use filename in mapnik pointsymbolizer
+    point_looks = mapnik.PointSymbolizer(
+        output_filename_abs, 'png', 16, 16)
+    point_looks.allow_overlap = True
+    return point_looks
+
+
+def _build_points_style(color):
+    layout_rule = mapnik.Rule()
+    layout_rule.symbols.append(_point_symbolizer(color))
+    points_style = mapnik.Style()
+    points_style.rules.append(layout_rule)
+    return points_style
+
+
+def _style_key(color):
+    return (ICON_STYLE['icon'], color, ICON_SIZE)
+
+
+def points_style(color):
+    """Return mapnik point style for the color, built once per process.
+
+    Mapnik copies the style when it is added to a map, so sharing it is safe.
+    """
+    prewarm_styles()
+    key = _style_key(color)
+    style = _STYLE_CACHE.get(key)
+    if style is None:
+        style = _build_points_style(color)
+        _STYLE_CACHE[key] = style
+    return style
+
+
+def cluster_style(color):
+    """Return mapnik style for clusters: the point icon plus the count.
+
+    The count is colored by the cluster's worst threshold state.
+    """
+    prewarm_styles()
+    key = ('cluster', ) + _style_key(color)
+    style = _STYLE_CACHE.get(key)
+    if style is not None:
+        return style
+    point_looks = _point_symbolizer(color)
+    style = mapnik.Style()
+    for state, text_color in CLUSTER_TEXT_COLORS.items():
+        label = mapnik.TextSymbolizer(
+            mapnik.Expression('[num_points]'), 'DejaVu Sans Bold', 10,
+            mapnik.Color(text_color))
+        label.allow_overlap = True
+        label.displacement = (0, -12)
+        rule = mapnik.Rule()
+        rule.filter = mapnik.Expression('[worst_state] = %d' % state)
+        rule.symbols.append(point_looks)
+        rule.symbols.append(label)
+        style.rules.append(rule)
+    _STYLE_CACHE[key] = style
+    return style
+
+
+def prewarm_styles():
+    """Build the styles for all suppliers' colors, once per process.
+
+    Called on the first style lookup, so the first map of a worker pays for
+    all suppliers and the rest don't.
+    """
+    global _styles_prewarmed
+    if _styles_prewarmed:
+        return
+    _styles_prewarmed = True
+    savepoint = transaction.savepoint()
+    try:
+        colors = set(models.Supplier.objects.values_list(
+                'html_color', flat=True))
+    except DatabaseError:
+        # Probably not migrated yet. Don't leave the transaction aborted.
+        transaction.savepoint_rollback(savepoint)
+        logger.warn("Cannot pre-warm the geodin point styles.")
+        return
+    transaction.savepoint_commit(savepoint)
+    for color in colors:
+        color = supplier_color(models.Supplier(html_color=color))
+        _STYLE_CACHE.setdefault(_style_key(color),
+                                _build_points_style(color))
+        cluster_style(color)
+
+
+@receiver(pre_save, sender=models.Supplier)
+def forget_old_supplier_style(sender, instance, **kwargs):
+    """Drop the cached style of the old color when the color changes."""
+    if instance.pk is None:
+        return
+    try:
+        old = models.Supplier.objects.get(pk=instance.pk)
+    except models.Supplier.DoesNotExist:
+        return
+    if old.html_color != instance.html_color:
+        key = _style_key(supplier_color(old))
+        _STYLE_CACHE.pop(key, None)
+        _STYLE_CACHE.pop(('cluster', ) + key, None)
+
+
 def default_database_params():
     """Get default database params. Use a copy of the dictionary
     because it is mutated by the functions that use it."""
     return PARAMS.copy()
 
 
+def popup_flot_data(point):
+    """Return the point's flot json for a popup, None if it isn't local.
+
+    Only a timeseries we already have is embedded. For the other points the
+    graph loads it from the (cached) flot data url, so a popup never waits
+    for geodin.
+    """
+    if not point.has_local_series():
+        return None
+    return json.dumps(point.flot_data(max_points=POPUP_MAX_GRAPH_POINTS))
+
+
+def in_bulk_or_404(queryset, ids):
+    """Return the objects in the order of ``ids``, with a single query."""
+    if not ids:
+        return []
+    objects = queryset.in_bulk(ids)
+    try:
+        return [objects[int(id)] for id in ids]
+    except KeyError:
+        raise Http404
+
+
 class GeodinPoints(WorkspaceItemAdapter):
     # javascript_hover_handler = 'popup_hover_handler'
 
@@ -62,52 +255,47 @@ class GeodinPoints(WorkspaceItemAdapter):
                 "Measurement %s doesn't exist." % self.measurement_id)
 
     def style(self):
-        """Return mapnik point style.
+        """Return mapnik point style."""
+        return points_style(supplier_color(self.measurement.supplier))
+
+    def layer(self, layer_ids=None, request=None, zoom=None):
+        """Return Mapnik layers and styles.
+
+        Clusters are shown below ``clustering.FIRST_POINTS_ZOOM``. Pass the
+        ``zoom`` when rendering without a WMS request, like for tiles.
         """
-        symbol_manager = SymbolManager(
-            ICON_ORIGINALS,
-            os.path.join(settings.MEDIA_ROOT, 'generated_icons'))
-        icon = ICON_STYLE['icon']
-        mask = ICON_STYLE['mask']
-        override_color = self.measurement.supplier.html_color
-        if override_color:
-            override_color = override_color.lstrip('#')
-            try:
-                color = html_to_mapnik(override_color)
-            except ValueError:
-                color = ICON_STYLE['color']
-        else:
-            color = ICON_STYLE['color']
-        output_filename = symbol_manager.get_symbol_transformed(
-            icon, mask=mask, color=color, icon=icon, size=ICON_SIZE)
-        output_filename_abs = os.path.join(
-            settings.MEDIA_ROOT, 'generated_icons', output_filename)
-        # use filename in mapnik pointsymbolizer
-        point_looks = mapnik.PointSymbolizer(
-            output_filename_abs, 'png', 16, 16)
-        point_looks.allow_overlap = True
-        layout_rule = mapnik.Rule()
-        layout_rule.symbols.append(point_looks)
-        points_style = mapnik.Style()
-        points_style.rules.append(layout_rule)
-        return points_style
-
-    def layer(self, layer_ids=None, request=None):
-        "Return Mapnik layers and styles."
+        if zoom is None:
+            zoom = clustering.zoom_from_wms_request(request)
+        if clustering.use_clusters(zoom):
+            return self.cluster_layer(zoom)
         layers, styles = [], {}
         styles["pointsStyle"] = self.style()
         layer = mapnik.Layer("Geodin points layer", coordinates.WGS84)
-        layer.datasource = mapnik.PointDatasource()
+        params = default_database_params()
+        params['table'] = POINTS_QUERY % {
+            'measurement_id': self.measurement.id}
+        params['geometry_field'] = 'location'
+        params['extent_from_subquery'] = True
+        layer.datasource = mapnik.PostGIS(**params)
         layer.styles.append("pointsStyle")
+        layers.append(layer)
+        return layers, styles
 
-        for point in self.measurement.points.all():
-            add_datasource_point(
-                layer.datasource,
-                point.location.x,
-                point.location.y,
-                'style',
-                'pointsStyle')
-
+    def cluster_layer(self, zoom):
+        """Return Mapnik layers and styles for the clusters at this zoom."""
+        layers, styles = [], {}
+        styles["clustersStyle"] = cluster_style(
+            supplier_color(self.measurement.supplier))
+        layer = mapnik.Layer("Geodin clusters layer", coordinates.GOOGLE)
+        params = default_database_params()
+        params['srid'] = 3857
+        params['table'] = CLUSTERS_QUERY % {
+            'measurement_id': self.measurement.id,
+            'zoom': zoom}
+        params['geometry_field'] = 'location'
+        params['extent_from_subquery'] = True
+        layer.datasource = mapnik.PostGIS(**params)
+        layer.styles.append("clustersStyle")
         layers.append(layer)
         return layers, styles
 
@@ -128,30 +316,36 @@ class GeodinPoints(WorkspaceItemAdapter):
 
     def extent(self, identifiers=None):
         "Return the extent in Google projection"
-        north = None
-        south = None
-        east = None
-        west = None
+        cache_key = EXTENT_CACHE_KEY.format(
+            id=self.measurement.id,
+            version=models.points_version(self.measurement.id))
+        extent = cache.get(cache_key)
+        if extent is None:
+            # An empty dict means "no extent", None means "not cached".
+            extent = self._calculate_extent() or {}
+            cache.set(cache_key, extent, EXTENT_CACHE_TIMEOUT)
+        return extent or None
+
+    def _calculate_extent(self):
+        """Return extent, calculated by postgis in one aggregate query.
+
+        Points at the RD origin (0, 0) are excluded: that's where points
+        without a proper location end up.
+        """
         wgs0coord_x, wgs0coord_y = coordinates.rd_to_wgs84(0.0, 0.0)
-        for point in self.measurement.points.all():
-            x = point.location.x
-            y = point.location.y
-            if (abs(x - wgs0coord_x) > EPSILON or
-                abs(y - wgs0coord_y) > EPSILON):
-
-                if x > east or east is None:
-                    east = x
-                if x < west or west is None:
-                    west = x
-                if y < south or south is None:
-                    south = y
-                if y > north or north is None:
-                    north = y
-        if north is None:
+        rd_origin = geos.Polygon.from_bbox(
+            (wgs0coord_x - EPSILON, wgs0coord_y - EPSILON,
+             wgs0coord_x + EPSILON, wgs0coord_y + EPSILON))
+        rd_origin.srid = 4326
+        bbox = models.Point.objects.filter(
+            measurement=self.measurement,
+            location__isnull=False).exclude(
+            location__intersects=rd_origin).extent(field_name='location')
+        if bbox is None:
             logger.warn("Data points are all at (0, 0) RD, cannot calculate "
                         "extent!")
             return
-
+        west, south, east, north = bbox
         west_transformed, north_transformed = coordinates.wgs84_to_google(
             west, north)
         east_transformed, south_transformed = coordinates.wgs84_to_google(
@@ -165,20 +359,45 @@ class GeodinPoints(WorkspaceItemAdapter):
     def search(self, x, y, radius=None):
         """We only use this for the mouse hover function; return the
         minimal amount of information necessary to show it."""
+        if radius:
+            zoom = clustering.zoom_for_resolution(
+                radius / clustering.HOVER_RADIUS_PIXELS)
+            if clustering.use_clusters(zoom):
+                return self.search_clusters(x, y, radius, zoom)
 
-        pnt = geos.Point(x, y, srid=900913)
-        points = self.measurement.points.filter(
-            location__distance_lte=(pnt, radius)).distance(pnt).order_by(
-            'distance')[:5]
-        if not points:
+        if not radius:
             return []
+        if getattr(settings, 'GEODIN_IN_MEMORY_HOVER_INDEX', False):
+            found = spatialindex.nearest(self.measurement.id, x, y, radius,
+                                         NUM_SEARCH_RESULTS)
+        else:
+            # x/y are google coordinates, just like the projected location.
+            found = [(point.id, point.name, point.distance)
+                     for point in models.Point.objects.raw(
+                    NEAREST_POINTS_QUERY,
+                    [x, y, self.measurement.id, x, y, radius, x, y,
+                     NUM_SEARCH_RESULTS])]
+        result = []
+        for point_id, name, distance in found:
+            result.append({'name': name,
+                           'distance': distance,
+                           'workspace_item': self.workspace_item,
+                           'identifier': {'point_id': point_id},
+                           })
+        return result
 
+    def search_clusters(self, x, y, radius, zoom):
+        pnt = geos.Point(x, y, srid=3857)
+        clusters = self.measurement.clusters.filter(
+            zoom=zoom,
+            location__distance_lte=(pnt, radius)).distance(pnt).order_by(
+            'distance')[:NUM_SEARCH_RESULTS]
         result = []
-        for point in points:
-            result.append({'name': point.name,
-                           'distance': point.distance.m,
+        for cluster in clusters:
+            result.append({'name': '%s meetpunten' % cluster.num_points,
+                           'distance': cluster.distance.m,
                            'workspace_item': self.workspace_item,
-                           'identifier': {'point_id': point.id},
+                           'identifier': {'cluster_id': cluster.id},
                            })
         return result
 
@@ -200,8 +419,23 @@ class GeodinPoints(WorkspaceItemAdapter):
     #         }
 
     def html(self, identifiers=None, layout_options=None):
-        points = [get_object_or_404(models.Point, pk=identifier['point_id'])
-                  for identifier in identifiers]
+        """Return popup html with the graphs' data embedded in it.
+
+        A popup over lots of points costs one query for all points and no
+        extra flot data requests.
+        """
+        cluster_ids = [identifier['cluster_id'] for identifier in identifiers
+                       if 'cluster_id' in identifier]
+        point_ids = [identifier['point_id'] for identifier in identifiers
+                     if 'point_id' in identifier]
+        clusters = in_bulk_or_404(models.PointCluster.objects, cluster_ids)
+        points = in_bulk_or_404(
+            models.Point.objects.select_related('measurement__parameter'),
+            point_ids)
+        graphs = [{'point': point,
+                   'flot_data': popup_flot_data(point)}
+                  for point in points]
         return render_to_string(
             'lizard_geodin/point_popup.html',
-            {'points': points})
+            {'graphs': graphs,
+             'clusters': clusters})
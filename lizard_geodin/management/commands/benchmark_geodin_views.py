@@ -0,0 +1,48 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.client import Client
+
+from lizard_geodin import benchmark
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Render all geodin views against a large synthetic dataset and
+report the number of queries and the time per view. The synthetic data is
+rolled back afterwards, but do run it against a scratch database.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--projects', dest='num_projects', type='int',
+                    default=10,
+                    help="Number of synthetic projects"),
+        make_option('--points', dest='points_per_measurement', type='int',
+                    default=100,
+                    help="Number of synthetic points per measurement"),
+        )
+
+    def handle(self, *args, **options):
+        with transaction.commit_manually():
+            try:
+                point = benchmark.create_synthetic_dataset(
+                    num_projects=options['num_projects'],
+                    num_suppliers=5,
+                    num_parameters=4,
+                    points_per_measurement=options['points_per_measurement'])
+                measurements = benchmark.render_all_views(Client(), point)
+            finally:
+                transaction.rollback()
+        for url_name, url, status_code, num_queries, seconds in measurements:
+            print("{url:<45} {status} {queries:>5} queries {seconds:>7.3f}s"
+                  .format(url=url, status=status_code, queries=num_queries,
+                          seconds=seconds))
+        violations = benchmark.budget_violations(measurements)
+        for violation in violations:
+            print("Over budget: {0}".format(violation))
+        if not violations:
+            print("All views are within their budget.")
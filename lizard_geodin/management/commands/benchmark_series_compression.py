@@ -0,0 +1,59 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lizard_geodin import benchmark
+from lizard_geodin import compression
+from lizard_geodin import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Compare the size and decode time of the points' downloaded json
+with the packed series of compression.py. Without downloaded json in the
+database, a synthetic timeseries is used. Packing a point empties its
+downloaded json, so --pack also frees that space.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--synthetic', dest='num_values', type='int',
+                    default=None,
+                    help="Only use a synthetic series of this many values"),
+        make_option('--pack', dest='pack', action='store_true',
+                    default=False,
+                    help="Also store the packed series of every point"),
+        )
+
+    def handle(self, *args, **options):
+        if options['num_values']:
+            series = [benchmark.synthetic_timeseries(options['num_values'])]
+        else:
+            series = []
+            points = models.Point.objects.filter(
+                downloaded_json__isnull=False)
+            for point in points.iterator():
+                series.append(point.downloaded_json)
+                if options['pack']:
+                    point.pack_series(point.downloaded_json)
+                    point.save()
+            if options['pack']:
+                logger.info("Packed the series of %s points.", len(series))
+            if not series:
+                series = [benchmark.synthetic_timeseries(10000)]
+        totals = dict.fromkeys(['num_values', 'json_bytes', 'packed_bytes',
+                                'json_seconds', 'packed_seconds'], 0)
+        for the_json in series:
+            for key, value in compression.benchmark(the_json).items():
+                totals[key] += value
+        print("{0} series, {1} values".format(len(series),
+                                              totals['num_values']))
+        print("json:   {json_bytes:>12} bytes {json_seconds:>9.4f}s decode"
+              .format(**totals))
+        print("packed: {packed_bytes:>12} bytes {packed_seconds:>9.4f}s decode"
+              .format(**totals))
+        if totals['packed_bytes']:
+            print("Packed is {0:.1f}x smaller.".format(
+                    float(totals['json_bytes']) / totals['packed_bytes']))
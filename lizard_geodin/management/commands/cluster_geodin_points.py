@@ -0,0 +1,23 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from lizard_geodin import alarms
+from lizard_geodin import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Re-evaluate the alarm states of all points (for instance after
+changing their levels) and recalculate the point clusters of all
+measurements. Syncing a project already does this for the project's
+measurements.
+"""
+
+    def handle(self, *args, **options):
+        logger.info("%s points changed alarm state.", alarms.evaluate())
+        for measurement in models.Measurement.objects.all():
+            logger.debug("Clustering %s.", measurement)
+            measurement.update_clusters()
@@ -0,0 +1,61 @@
+import importlib
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from lizard_geodin import benchmark
+
+INDEX_MIGRATION = 'lizard_geodin.migrations.0024_auto__add_unique_indexes'
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Show the query plans of the common geodin lookups with and
+without the indexes of migration 0024, against a large synthetic dataset.
+Everything (including dropping the indexes) is rolled back afterwards, but
+do run it against a scratch database.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--projects', dest='num_projects', type='int',
+                    default=20,
+                    help="Number of synthetic projects"),
+        make_option('--points', dest='points_per_measurement', type='int',
+                    default=500,
+                    help="Number of synthetic points per measurement"),
+        )
+
+    def plans(self, point):
+        connection.cursor().execute('ANALYZE')
+        return [(description, benchmark.explain(queryset))
+                for description, queryset in
+                benchmark.lookup_querysets(point)]
+
+    def handle(self, *args, **options):
+        migration = importlib.import_module(INDEX_MIGRATION).Migration()
+        with transaction.commit_manually():
+            try:
+                point = benchmark.create_synthetic_dataset(
+                    num_projects=options['num_projects'],
+                    num_suppliers=5,
+                    num_parameters=4,
+                    points_per_measurement=options['points_per_measurement'])
+                with_indexes = self.plans(point)
+                migration.backwards(None)
+                without_indexes = self.plans(point)
+            finally:
+                transaction.rollback()
+        for (description, after), (_, before) in zip(with_indexes,
+                                                     without_indexes):
+            print(description)
+            print("  Without the indexes:")
+            for line in before:
+                print("    " + line)
+            print("  With the indexes:")
+            for line in after:
+                print("    " + line)
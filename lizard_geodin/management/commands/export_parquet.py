@@ -0,0 +1,94 @@
+import datetime
+import logging
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import Min
+
+from lizard_geodin import export
+from lizard_geodin import history
+from lizard_geodin import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = '<output directory>'
+    help = """Write the sample history of the selected projects or
+measurements (default: all active projects) to parquet files, partitioned
+by project, measurement and day. Only days that weren't exported yet and
+that are older than GEODIN_LOOKBACK_DAYS (which geodin's downloads can
+still add samples to) are written; the state is kept in the output
+directory. Needs pyarrow.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--project', dest='projects', action='append',
+                    default=[],
+                    help="Project slug (can be repeated)"),
+        make_option('--measurement', dest='measurements', action='append',
+                    type='int', default=[],
+                    help="Measurement id (can be repeated)"),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise CommandError("Exporting to parquet needs pyarrow.")
+        if len(args) != 1:
+            raise CommandError("Pass the output directory.")
+        output_dir = args[0]
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        measurements = models.Measurement.objects.select_related('project')
+        if options['projects'] or options['measurements']:
+            measurements = (
+                measurements.filter(project__slug__in=options['projects']) |
+                measurements.filter(pk__in=options['measurements']))
+        else:
+            measurements = measurements.filter(project__active=True)
+
+        until = export.complete_until(history.now())
+        state = export.read_state(output_dir)
+        num_files = 0
+        for measurement in measurements:
+            if measurement.id in state:
+                first = state[measurement.id] + datetime.timedelta(days=1)
+            else:
+                first = models.Sample.objects.filter(
+                    point__measurement=measurement).aggregate(
+                    first=Min('timestamp'))['first']
+                if first is None:
+                    continue
+                first = history.from_db_datetime(first)
+            for day in export.days(first, until):
+                columns = export.day_columns(measurement.id, day)
+                if columns['point']:
+                    project_slug = (measurement.project and
+                                    measurement.project.slug)
+                    path = export.partition_path(
+                        output_dir, project_slug, measurement.id, day)
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    table = pyarrow.Table.from_arrays(
+                        [pyarrow.array(columns['point'], pyarrow.string()),
+                         pyarrow.array(columns['timestamp'],
+                                       pyarrow.timestamp('ms', tz='UTC')),
+                         pyarrow.array(columns['value'], pyarrow.float64()),
+                         pyarrow.array(columns['supplier'], pyarrow.string()),
+                         pyarrow.array(columns['parameter'],
+                                       pyarrow.string()),
+                         pyarrow.array(columns['unit'], pyarrow.string())],
+                        names=list(export.DAY_COLUMNS))
+                    pyarrow.parquet.write_table(table, path)
+                    num_files += 1
+                state[measurement.id] = day
+            # Save after every measurement, so an interrupted run doesn't
+            # redo everything.
+            export.write_state(output_dir, state)
+        logger.info("Wrote %s parquet files.", num_files)
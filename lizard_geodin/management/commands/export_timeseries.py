@@ -0,0 +1,74 @@
+import logging
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from lizard_geodin import export
+from lizard_geodin import history
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Export the sample history of the points of a measurement,
+supplier or project as csv or ndjson, to stdout or a file.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--measurement', dest='measurement', type='int',
+                    help="Measurement id"),
+        make_option('--supplier', dest='supplier',
+                    help="Supplier slug"),
+        make_option('--project', dest='project',
+                    help="Project slug"),
+        make_option('--start', dest='start',
+                    help="Start date (default: a week before the end)"),
+        make_option('--end', dest='end',
+                    help="End date (default: now)"),
+        make_option('--resolution', dest='resolution', default=export.RAW,
+                    help="'raw' (default), 'auto' or a rollup level in "
+                    "seconds: 600, 3600 or 86400"),
+        make_option('--width', dest='width', type='int',
+                    default=history.WIDTH,
+                    help="Number of values the 'auto' resolution aims at"),
+        make_option('--format', dest='output_format', default='csv',
+                    help="'csv' (default) or 'ndjson'"),
+        make_option('--output', '-o', dest='output',
+                    help="Output file (default: stdout)"),
+        )
+
+    def handle(self, *args, **options):
+        if not (options['measurement'] or options['supplier'] or
+                options['project']):
+            raise CommandError(
+                "Pass a --measurement, --supplier or --project.")
+        if options['output_format'] not in export.FORMATS:
+            raise CommandError("Unknown format: %s" %
+                               options['output_format'])
+        try:
+            start, end = [history.parse_time(options[name])
+                          if options[name] else None
+                          for name in ('start', 'end')]
+            start, end = history.period(start, end)
+            rollup_level = export.level(options['resolution'], start, end,
+                                        width=options['width'])
+        except ValueError as e:
+            raise CommandError(e)
+        points = export.select_points(
+            measurement_id=options['measurement'],
+            supplier_slug=options['supplier'],
+            project_slug=options['project'])
+        output = sys.stdout
+        if options['output']:
+            output = open(options['output'], 'wb')
+        try:
+            for chunk in export.export(points, start, end,
+                                       output_format=options['output_format'],
+                                       rollup_level=rollup_level):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
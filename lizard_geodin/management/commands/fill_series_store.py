@@ -0,0 +1,37 @@
+import base64
+import logging
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import Q
+
+from lizard_geodin import compression
+from lizard_geodin import models
+from lizard_geodin import seriesstore
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Write the series file of every point with a downloaded
+timeseries to GEODIN_SERIES_STORE_DIR. Refreshing a point's json already
+does this, this is for filling the store initially.
+"""
+
+    def handle(self, *args, **options):
+        if not seriesstore.store_dir():
+            raise CommandError("Set GEODIN_SERIES_STORE_DIR first.")
+        points = models.Point.objects.filter(
+            Q(packed_series__isnull=False) | Q(downloaded_json__isnull=False))
+        num_points = 0
+        for point in points.iterator():
+            if point.packed_series:
+                timestamps, values = compression.unpack(
+                    base64.b64decode(point.packed_series))
+            else:
+                timestamps, values = compression.json_to_arrays(
+                    point.downloaded_json)
+            seriesstore.write(point.id, timestamps, values)
+            num_points += 1
+        logger.info("Wrote the series files of %s points.", num_points)
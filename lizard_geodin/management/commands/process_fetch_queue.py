@@ -0,0 +1,61 @@
+import datetime
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+import requests
+
+from lizard_geodin import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Download the timeseries that local-only views (GEODIN_LOCAL_ONLY)
+asked for, oldest request first. Run it every minute or so from cron.
+Failed fetches stay in the queue until they've failed --max-attempts times.
+Points we gave up on are removed from the queue --retry-after seconds after
+they were queued, so the next request for them queues them again.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', dest='limit', type='int',
+                    default=100,
+                    help="Maximum number of fetches per run"),
+        make_option('--max-attempts', dest='max_attempts', type='int',
+                    default=5,
+                    help="Give up on a point after this many failures"),
+        make_option('--retry-after', dest='retry_after', type='int',
+                    default=60 * 60,
+                    help="Seconds until a point we gave up on can be "
+                    "queued again"),
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(
+            seconds=options['retry_after'])
+        expired = models.PendingFetch.objects.filter(
+            attempts__gte=options['max_attempts'], requested__lt=cutoff)
+        num_expired = expired.count()
+        if num_expired:
+            expired.delete()
+            logger.info("Removed %s failed fetches from the queue.",
+                        num_expired)
+        pending_fetches = models.PendingFetch.objects.filter(
+            attempts__lt=options['max_attempts']).select_related('point')
+        num_fetched = 0
+        for pending_fetch in pending_fetches[:options['limit']]:
+            try:
+                pending_fetch.point.json_from_source_url(
+                    from_cache_is_ok=False)
+            except (requests.exceptions.RequestException, ValueError), e:
+                logger.warn("Fetching %s failed: %s", pending_fetch.point, e)
+                pending_fetch.attempts += 1
+                pending_fetch.last_error = unicode(e)
+                pending_fetch.save()
+                continue
+            pending_fetch.delete()
+            num_fetched += 1
+        logger.info("Fetched %s timeseries.", num_fetched)
@@ -0,0 +1,77 @@
+import logging
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from lizard_geodin import layers
+from lizard_geodin import models
+from lizard_geodin import tiles
+
+logger = logging.getLogger(__name__)
+
+
+def seed_tile(args):
+    """Render one tile into the cache. Runs in a worker process."""
+    measurement_id, zoom, x, y = args
+    measurement = models.Measurement.objects.select_related(
+        'supplier').get(pk=measurement_id)
+    tiles.get_tile(measurement, zoom, x, y)
+
+
+class Command(BaseCommand):
+    args = '[measurement_id measurement_id ...]'
+    help = """Pre-render the geodin point tiles of the common zoom levels into
+the cache, for all measurements of active projects or for the given ones.
+This only makes sense with a cache that is shared between processes, like
+memcached.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--zoom', dest='zoom', default='',
+                    help="Zoom levels like '8-14' (default) or '10,12'"),
+        make_option('--processes', dest='processes', type='int', default=4,
+                    help="Number of rendering processes"),
+        )
+
+    def zoom_levels(self, zoom):
+        if not zoom:
+            return tiles.SEED_ZOOM_LEVELS
+        try:
+            if '-' in zoom:
+                start, end = zoom.split('-')
+                return range(int(start), int(end) + 1)
+            return [int(level) for level in zoom.split(',')]
+        except ValueError:
+            raise CommandError("Invalid zoom levels: %s" % zoom)
+
+    def handle(self, *args, **options):
+        zoom_levels = self.zoom_levels(options['zoom'])
+        if args:
+            measurements = models.Measurement.objects.filter(pk__in=args)
+        else:
+            measurements = models.Measurement.objects.filter(
+                project__active=True)
+        jobs = []
+        for measurement in measurements:
+            adapter = layers.GeodinPoints(
+                None, layer_arguments={'measurement_id': measurement.id})
+            extent = adapter.extent()
+            if extent is None:
+                logger.info("No extent for %s, skipping it.", measurement)
+                continue
+            for zoom in zoom_levels:
+                jobs.extend((measurement.id, zoom, x, y)
+                            for x, y in tiles.tiles_for_extent(extent, zoom))
+        print("Rendering {0} tiles.".format(len(jobs)))
+        # The worker processes mustn't share our database connection.
+        connection.close()
+        pool = Pool(options['processes'])
+        try:
+            pool.map(seed_tile, jobs, chunksize=10)
+        finally:
+            pool.close()
+            pool.join()
+        print("Done.")
@@ -0,0 +1,42 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Q
+
+from lizard_geodin import history
+from lizard_geodin import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Add the timesteps of the points' last downloaded timeseries to
+their sample history. Refreshing the json already does this, this is for filling
+the history initially.
+"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rollups', dest='rollups', action='store_true',
+                    default=False,
+                    help="Also recalculate all rollups from the samples"),
+        )
+
+    def handle(self, *args, **options):
+        num_samples = 0
+        points = models.Point.objects.filter(
+            Q(packed_series__isnull=False) | Q(downloaded_json__isnull=False))
+        for point in points.iterator():
+            num_samples += point.store_series(*point.series())
+        logger.info("Stored %s new samples.", num_samples)
+        if not options['rollups']:
+            return
+        periods = models.Sample.objects.values('point').annotate(
+            first=Min('timestamp'), last=Max('timestamp'))
+        for period in periods:
+            history.update_rollups(period['point'], period['first'],
+                                   period['last'])
+        logger.info("Recalculated the rollups of %s points.", len(periods))
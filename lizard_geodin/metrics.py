@@ -0,0 +1,260 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Counters and histograms in prometheus' text format.
+
+The numbers are kept in the django cache, so all gunicorn workers and the
+management commands add to the same counters, whichever worker prometheus
+happens to scrape. That needs a cache that all processes share and that
+increments atomically, like memcached. With django's default local-memory
+cache every process has its own numbers, which is only right with a single
+worker.
+
+Every series (a metric name with its labels) is registered in a numbered
+slot when it's first incremented, so that ``render()`` can find them all.
+A process does that only once per series (or when the value had been
+evicted), after that a counter is a single ``incr`` and a histogram two:
+its bucket and its sum. The count is the total of the buckets. Counters are
+integers and histogram sums are stored in microseconds, as memcached only
+increments integers. The last sync of every project is kept
+in the cache as well, see ``record_sync()``.
+
+"""
+from __future__ import unicode_literals
+from collections import defaultdict
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+
+# Metric name: (type, help text).
+METRICS = {
+    'geodin_fetch_seconds': (
+        'histogram', "Duration of json requests to geodin."),
+    'geodin_fetch_timeouts_total': (
+        'counter', "Json requests to geodin that timed out."),
+    'geodin_fallback_cache_total': (
+        'counter', "Times the fallback cache was served instead of geodin."),
+    'geodin_flot_cache_requests_total': (
+        'counter', "Flot data cache lookups, per hit/miss result."),
+    'geodin_single_flight_total': (
+        'counter', "Single-flight cache misses, per way they were answered."),
+    'geodin_sync_seconds': (
+        'histogram', "Duration of a project sync from geodin."),
+    'geodin_sync_rows_changed_total': (
+        'counter', "Database rows written by project syncs."),
+    'geodin_last_sync_seconds': (
+        'gauge', "Duration of the last sync of the project."),
+    'geodin_last_sync_rows_changed': (
+        'gauge', "Database rows written by the last sync of the project."),
+    'geodin_last_sync_timestamp_seconds': (
+        'gauge', "Unix time of the last sync of the project."),
+    }
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LAST_SYNC_CACHE_KEY = 'geodin_last_sync_{slug}'
+LAST_SYNC_CACHE_TIMEOUT = 7 * 24 * 60 * 60  # One week.
+VALUE_CACHE_KEY = 'geodin_metric_{hash}'
+NUM_SERIES_CACHE_KEY = 'geodin_metrics_num_series'
+SERIES_CACHE_KEY = 'geodin_metrics_series_{number}'
+REGISTERED_CACHE_KEY = 'geodin_metrics_registered_{hash}'
+METRICS_CACHE_TIMEOUT = 30 * 24 * 60 * 60  # A month.
+MICROSECONDS = 1000000
+# Part of the histogram values above the last bucket.
+OVERFLOW = len(BUCKETS)
+
+# The (name, labels) this process has registered.
+_registered = set()
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _hash(*description):
+    # Json, as str and unicode labels have to give the same key.
+    return hashlib.md5(json.dumps(description).encode('utf-8')).hexdigest()
+
+
+def _value_key(name, labels, part=None):
+    """Return cache key of (a part of) the series' value."""
+    return VALUE_CACHE_KEY.format(hash=_hash(name, labels, part))
+
+
+def _incr(key, amount):
+    """Add ``amount`` to the cached ``key``, return whether it's new."""
+    try:
+        cache.incr(key, amount)
+        return False
+    except ValueError:
+        # Not there yet (or evicted). Only one process can add it.
+        if cache.add(key, amount, METRICS_CACHE_TIMEOUT):
+            return True
+        cache.incr(key, amount)
+        return False
+
+
+def _register(name, labels, created):
+    """Make sure the series has a slot, for ``render()``.
+
+    Only the first time this process sees it, or when its value has just
+    been (re)created. Only one process gets to fill a slot.
+    """
+    if (name, labels) in _registered and not created:
+        return
+    _registered.add((name, labels))
+    if not cache.add(REGISTERED_CACHE_KEY.format(hash=_hash(name, labels)),
+                     True, METRICS_CACHE_TIMEOUT):
+        return
+    cache.add(NUM_SERIES_CACHE_KEY, 0, METRICS_CACHE_TIMEOUT)
+    number = cache.incr(NUM_SERIES_CACHE_KEY)
+    cache.set(SERIES_CACHE_KEY.format(number=number), (name, labels),
+              METRICS_CACHE_TIMEOUT)
+
+
+def _all_series():
+    """Return sorted list of registered (name, labels)."""
+    num_series = cache.get(NUM_SERIES_CACHE_KEY) or 0
+    slots = cache.get_many([SERIES_CACHE_KEY.format(number=number)
+                            for number in range(1, num_series + 1)])
+    # An evicted and re-added series can have two slots.
+    return sorted(set(slots.values()))
+
+
+def _histogram_parts():
+    return list(range(len(BUCKETS) + 1)) + ['sum']
+
+
+def inc(name, amount=1, **labels):
+    """Increment counter ``name`` by the integer ``amount``."""
+    labels = _labels_key(labels)
+    created = _incr(_value_key(name, labels), int(amount))
+    _register(name, labels, created)
+
+
+def observe(name, value, **labels):
+    """Add ``value`` to histogram ``name``."""
+    labels = _labels_key(labels)
+    part = OVERFLOW
+    for index, bound in enumerate(BUCKETS):
+        if value <= bound:
+            part = index
+            break
+    # Non-cumulative bucket counts.
+    created = _incr(_value_key(name, labels, part), 1)
+    _incr(_value_key(name, labels, 'sum'), int(round(value * MICROSECONDS)))
+    _register(name, labels, created)
+
+
+def reset():
+    """Forget everything, handy for tests."""
+    keys = [NUM_SERIES_CACHE_KEY]
+    num_series = cache.get(NUM_SERIES_CACHE_KEY) or 0
+    keys += [SERIES_CACHE_KEY.format(number=number)
+             for number in range(1, num_series + 1)]
+    for name, labels in _all_series():
+        keys.append(_value_key(name, labels))
+        keys.append(REGISTERED_CACHE_KEY.format(hash=_hash(name, labels)))
+        keys += [_value_key(name, labels, part)
+                 for part in _histogram_parts()]
+    cache.delete_many(keys)
+    _registered.clear()
+
+
+def record_sync(project_slug, seconds, rows_changed):
+    """Record a project sync, also in the cache for other processes."""
+    observe('geodin_sync_seconds', seconds, project=project_slug)
+    inc('geodin_sync_rows_changed_total', rows_changed,
+        project=project_slug)
+    cache.set(LAST_SYNC_CACHE_KEY.format(slug=project_slug),
+              {'seconds': seconds,
+               'rows_changed': rows_changed,
+               'timestamp': time.time()},
+              LAST_SYNC_CACHE_TIMEOUT)
+
+
+def last_syncs(project_slugs):
+    """Return gauge lines for the cached last sync of the projects."""
+    keys = dict((LAST_SYNC_CACHE_KEY.format(slug=slug), slug)
+                for slug in project_slugs)
+    gauges = []
+    for key, value in cache.get_many(keys.keys()).items():
+        labels = _labels_key({'project': keys[key]})
+        gauges.append(('geodin_last_sync_seconds', labels,
+                       value['seconds']))
+        gauges.append(('geodin_last_sync_rows_changed', labels,
+                       value['rows_changed']))
+        gauges.append(('geodin_last_sync_timestamp_seconds', labels,
+                       value['timestamp']))
+    return gauges
+
+
+def _escape(value):
+    return ('%s' % value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+def render(gauges=()):
+    """Return all metrics in prometheus' text exposition format.
+
+    ``gauges`` is an optional list of (name, labels, value) tuples, for
+    instance from ``last_syncs()``.
+
+    """
+    series = _all_series()
+    keys = []
+    for name, labels in series:
+        if METRICS[name][0] == 'histogram':
+            keys += [_value_key(name, labels, part)
+                     for part in _histogram_parts()]
+        else:
+            keys.append(_value_key(name, labels))
+    values = cache.get_many(keys)
+    lines_per_metric = defaultdict(list)
+    for name, labels in series:
+        if METRICS[name][0] != 'histogram':
+            value = values.get(_value_key(name, labels))
+            if value is not None:
+                lines_per_metric[name].append('%s%s %s' % (
+                        name, _format_labels(labels), _format_value(value)))
+            continue
+        buckets = [values.get(_value_key(name, labels, index))
+                   for index in range(len(BUCKETS) + 1)]
+        if buckets == [None] * len(buckets):
+            continue
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, buckets):
+            cumulative += bucket or 0
+            lines_per_metric[name].append('%s_bucket%s %s' % (
+                    name,
+                    _format_labels(labels, [('le', _format_value(bound))]),
+                    cumulative))
+        count = cumulative + (buckets[OVERFLOW] or 0)
+        total = values.get(_value_key(name, labels, 'sum'), 0)
+        lines_per_metric[name].append('%s_bucket%s %s' % (
+                name, _format_labels(labels, [('le', '+Inf')]), count))
+        lines_per_metric[name].append('%s_sum%s %s' % (
+                name, _format_labels(labels),
+                _format_value(float(total) / MICROSECONDS)))
+        lines_per_metric[name].append('%s_count%s %s' % (
+                name, _format_labels(labels), count))
+    for name, labels, value in gauges:
+        lines_per_metric[name].append('%s%s %s' % (
+                name, _format_labels(labels), _format_value(value)))
+    output = []
+    for name in sorted(lines_per_metric):
+        metric_type, help_text = METRICS[name]
+        output.append('# HELP %s %s' % (name, help_text))
+        output.append('# TYPE %s %s' % (name, metric_type))
+        output.extend(lines_per_metric[name])
+    return '\n'.join(output) + '\n'
@@ -0,0 +1,66 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from __future__ import unicode_literals
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from lizard_geodin import profiling
+
+PROFILE_HEADER = 'X-Geodin-Profile'
+SLOW_REQUEST_THRESHOLD = 2.0  # In seconds.
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilingMiddleware(object):
+    """Optional middleware that reports where a request's time went.
+
+    Add ``lizard_geodin.middleware.ProfilingMiddleware`` to your
+    ``MIDDLEWARE_CLASSES``. Every response gets a breakdown of database,
+    upstream geodin, cache and template rendering time in the
+    ``X-Geodin-Profile`` header (configurable with the
+    ``GEODIN_PROFILE_HEADER`` setting). Requests slower than
+    ``GEODIN_SLOW_REQUEST_THRESHOLD`` seconds are logged as a warning with
+    the breakdown as json.
+
+    Note that query recording needs django's debug cursor, which costs a bit
+    of performance and memory.
+
+    """
+
+    def process_request(self, request):
+        profile = profiling.start_profile()
+        profile.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+
+    def process_template_response(self, request, response):
+        profile = profiling.current_profile()
+        if profile is not None:
+            # Django renders the response right after the template response
+            # middleware, the callback tells us when it's done.
+            profile.render_start = time.time()
+            response.add_post_render_callback(profile.rendered)
+        return response
+
+    def process_response(self, request, response):
+        profile = profiling.stop_profile()
+        if profile is None:
+            return response
+        connection.use_debug_cursor = profile.old_debug_cursor
+        profile.num_queries = len(connection.queries)
+        profile.query_seconds = sum(float(query['time'])
+                                    for query in connection.queries)
+        header = getattr(settings, 'GEODIN_PROFILE_HEADER', PROFILE_HEADER)
+        response[header] = profile.as_header()
+        threshold = getattr(settings, 'GEODIN_SLOW_REQUEST_THRESHOLD',
+                            SLOW_REQUEST_THRESHOLD)
+        if profile.total_seconds >= threshold:
+            breakdown = profile.as_dict()
+            breakdown['path'] = request.path
+            breakdown['method'] = request.method
+            breakdown['status'] = response.status_code
+            logger.warn("Slow request: %s", json.dumps(breakdown))
+        return response
@@ -0,0 +1,106 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'PointCluster'
+        db.create_table('lizard_geodin_pointcluster', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('measurement', self.gf('django.db.models.fields.related.ForeignKey')(related_name=u'clusters', to=orm['lizard_geodin.Measurement'])),
+            ('zoom', self.gf('django.db.models.fields.IntegerField')()),
+            ('num_points', self.gf('django.db.models.fields.IntegerField')()),
+            ('worst_state', self.gf('django.db.models.fields.SmallIntegerField')(default=0)),
+            ('location', self.gf('django.contrib.gis.db.models.fields.PointField')(srid=3857)),
+        ))
+        db.send_create_signal('lizard_geodin', ['PointCluster'])
+
+        # The layer and the hover search always select on both.
+        db.create_index('lizard_geodin_pointcluster', ['measurement_id', 'zoom'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'PointCluster'
+        db.delete_table('lizard_geodin_pointcluster')
+
+
+    models = {
+        'lizard_geodin.apistartingpoint': {
+            'Meta': {'object_name': 'ApiStartingPoint'},
+            'downloaded_json': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'source_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.measurement': {
+            'Meta': {'ordering': "[u'project', u'supplier', u'name']", 'object_name': 'Measurement'},
+            'data_type_name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'investigation_type_name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'location_type_name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'parameter': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'measurements'", 'null': 'True', 'to': "orm['lizard_geodin.Parameter']"}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'measurements'", 'null': 'True', 'to': "orm['lizard_geodin.Project']"}),
+            'supplier': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'measurements'", 'null': 'True', 'to': "orm['lizard_geodin.Supplier']"})
+        },
+        'lizard_geodin.parameter': {
+            'Meta': {'object_name': 'Parameter'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'unit': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.point': {
+            'Meta': {'ordering': "(u'name', u'slug')", 'object_name': 'Point'},
+            'critical_level': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'downloaded_json': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.PointField', [], {'null': 'True', 'blank': 'True'}),
+            'measurement': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'points'", 'null': 'True', 'to': "orm['lizard_geodin.Measurement']"}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'source_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'warning_level': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'x': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'y': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'z': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.pointcluster': {
+            'Meta': {'object_name': 'PointCluster'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.PointField', [], {'srid': '3857'}),
+            'measurement': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'clusters'", 'to': "orm['lizard_geodin.Measurement']"}),
+            'num_points': ('django.db.models.fields.IntegerField', [], {}),
+            'worst_state': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'zoom': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'lizard_geodin.project': {
+            'Meta': {'ordering': "(u'-active', u'name')", 'object_name': 'Project'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'api_starting_point': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'location_types'", 'null': 'True', 'to': "orm['lizard_geodin.ApiStartingPoint']"}),
+            'downloaded_json': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'source_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.supplier': {
+            'Meta': {'object_name': 'Supplier'},
+            'html_color': ('django.db.models.fields.CharField', [], {'default': "u'#444444'", 'max_length': '20'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['lizard_geodin']
@@ -0,0 +1,210 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+# Existing duplicates would make the unique constraints fail. They all come
+# from geodin syncs, so we keep the oldest row (lowest id) and move the
+# references of the others to it. Order matters: merging suppliers and
+# parameters can create duplicate measurements.
+KEEP = "(SELECT {columns}, min(id) AS id FROM {table} GROUP BY {columns})"
+MERGE_DUPLICATES = [
+    ("suppliers", """
+UPDATE lizard_geodin_measurement measurement SET supplier_id = keep.id
+FROM lizard_geodin_supplier supplier JOIN {keep} keep
+    ON keep.slug = supplier.slug
+WHERE measurement.supplier_id = supplier.id AND supplier.id <> keep.id;
+DELETE FROM lizard_geodin_supplier supplier USING {keep} keep
+WHERE supplier.slug = keep.slug AND supplier.id <> keep.id;
+""".format(keep=KEEP.format(columns='slug',
+                            table='lizard_geodin_supplier'))),
+    ("parameters", """
+UPDATE lizard_geodin_measurement measurement SET parameter_id = keep.id
+FROM lizard_geodin_parameter parameter JOIN {keep} keep
+    ON keep.slug = parameter.slug
+WHERE measurement.parameter_id = parameter.id AND parameter.id <> keep.id;
+DELETE FROM lizard_geodin_parameter parameter USING {keep} keep
+WHERE parameter.slug = keep.slug AND parameter.id <> keep.id;
+""".format(keep=KEEP.format(columns='slug',
+                            table='lizard_geodin_parameter'))),
+    # NULLs never conflict in a unique constraint, the joins skip them too.
+    ("measurements", """
+UPDATE lizard_geodin_point point SET measurement_id = keep.id
+FROM lizard_geodin_measurement measurement JOIN {keep} keep
+    ON keep.project_id = measurement.project_id
+    AND keep.parameter_id = measurement.parameter_id
+    AND keep.supplier_id = measurement.supplier_id
+WHERE point.measurement_id = measurement.id AND measurement.id <> keep.id;
+DELETE FROM lizard_geodin_pointcluster point_cluster
+USING lizard_geodin_measurement measurement, {keep} keep
+WHERE point_cluster.measurement_id = measurement.id
+    AND keep.project_id = measurement.project_id
+    AND keep.parameter_id = measurement.parameter_id
+    AND keep.supplier_id = measurement.supplier_id
+    AND measurement.id <> keep.id;
+DELETE FROM lizard_geodin_measurement measurement USING {keep} keep
+WHERE keep.project_id = measurement.project_id
+    AND keep.parameter_id = measurement.parameter_id
+    AND keep.supplier_id = measurement.supplier_id
+    AND measurement.id <> keep.id;
+""".format(keep=KEEP.format(columns='project_id, parameter_id, supplier_id',
+                            table='lizard_geodin_measurement'))),
+    # Nothing refers to points yet; the next sync updates the one we keep.
+    ("points", """
+DELETE FROM lizard_geodin_point point USING {keep} keep
+WHERE point.slug = keep.slug AND point.id <> keep.id;
+""".format(keep=KEEP.format(columns='slug', table='lizard_geodin_point'))),
+    ]
+COUNT_DUPLICATES = """
+SELECT coalesce(sum(num_rows - 1), 0) FROM (
+    SELECT count(*) AS num_rows FROM {table} {where} GROUP BY {columns}
+) AS grouped
+"""
+DUPLICATE_CHECKS = {
+    "suppliers": ('lizard_geodin_supplier', 'slug', ''),
+    "parameters": ('lizard_geodin_parameter', 'slug', ''),
+    "measurements": (
+        'lizard_geodin_measurement', 'project_id, parameter_id, supplier_id',
+        'WHERE project_id IS NOT NULL AND parameter_id IS NOT NULL '
+        'AND supplier_id IS NOT NULL'),
+    "points": ('lizard_geodin_point', 'slug', ''),
+    }
+
+class Migration(SchemaMigration):
+
+    def merge_duplicates(self):
+        for name, query in MERGE_DUPLICATES:
+            table, columns, where = DUPLICATE_CHECKS[name]
+            num_duplicates = db.execute(COUNT_DUPLICATES.format(
+                    table=table, columns=columns, where=where))[0][0]
+            if num_duplicates:
+                print("Merging %s duplicate %s into the oldest one." % (
+                        num_duplicates, name))
+                db.execute(query)
+
+    def forwards(self, orm):
+        
+        self.merge_duplicates()
+
+        # Adding unique constraint on 'Supplier', fields ['slug']
+        db.create_unique('lizard_geodin_supplier', ['slug'])
+
+        # Adding unique constraint on 'Parameter', fields ['slug']
+        db.create_unique('lizard_geodin_parameter', ['slug'])
+
+        # Adding unique constraint on 'Point', fields ['slug']
+        db.create_unique('lizard_geodin_point', ['slug'])
+
+        # Adding unique constraint on 'Measurement', fields ['project', 'parameter', 'supplier']
+        db.create_unique('lizard_geodin_measurement', ['project_id', 'parameter_id', 'supplier_id'])
+
+        # The views look up active projects by slug.
+        db.create_index('lizard_geodin_project', ['slug', 'active'])
+
+        # The map layer's bounding box queries. Databases made with syncdb
+        # already have geodjango's own spatial index.
+        if not db.execute("SELECT 1 FROM pg_indexes "
+                          "WHERE tablename = 'lizard_geodin_point' "
+                          "AND indexdef LIKE '%%USING gist (location)%%'"):
+            db.execute("CREATE INDEX lizard_geodin_point_location_gist "
+                       "ON lizard_geodin_point USING GIST (location)")
+
+
+    def backwards(self, orm):
+        
+        db.execute("DROP INDEX IF EXISTS lizard_geodin_point_location_gist")
+
+        # Removing index on 'Project', fields ['slug', 'active']
+        db.delete_index('lizard_geodin_project', ['slug', 'active'])
+
+        # Removing unique constraint on 'Measurement', fields ['project', 'parameter', 'supplier']
+        db.delete_unique('lizard_geodin_measurement', ['project_id', 'parameter_id', 'supplier_id'])
+
+        # Removing unique constraint on 'Point', fields ['slug']
+        db.delete_unique('lizard_geodin_point', ['slug'])
+
+        # Removing unique constraint on 'Parameter', fields ['slug']
+        db.delete_unique('lizard_geodin_parameter', ['slug'])
+
+        # Removing unique constraint on 'Supplier', fields ['slug']
+        db.delete_unique('lizard_geodin_supplier', ['slug'])
+
+
+    models = {
+        'lizard_geodin.apistartingpoint': {
+            'Meta': {'object_name': 'ApiStartingPoint'},
+            'downloaded_json': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'source_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.measurement': {
+            'Meta': {'ordering': "[u'project', u'supplier', u'name']", 'unique_together': "((u'project', u'parameter', u'supplier'),)", 'object_name': 'Measurement'},
+            'data_type_name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'investigation_type_name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'location_type_name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'parameter': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'measurements'", 'null': 'True', 'to': "orm['lizard_geodin.Parameter']"}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'measurements'", 'null': 'True', 'to': "orm['lizard_geodin.Project']"}),
+            'supplier': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'measurements'", 'null': 'True', 'to': "orm['lizard_geodin.Supplier']"})
+        },
+        'lizard_geodin.parameter': {
+            'Meta': {'object_name': 'Parameter'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'}),
+            'unit': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.point': {
+            'Meta': {'ordering': "(u'name', u'slug')", 'unique_together': "((u'slug',),)", 'object_name': 'Point'},
+            'critical_level': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'current_value': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'downloaded_json': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.PointField', [], {'null': 'True', 'blank': 'True'}),
+            'measurement': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'points'", 'null': 'True', 'to': "orm['lizard_geodin.Measurement']"}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'projected_location': ('django.contrib.gis.db.models.fields.PointField', [], {'srid': '3857', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'source_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'warning_level': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'x': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'y': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'z': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.pointcluster': {
+            'Meta': {'object_name': 'PointCluster'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.PointField', [], {'srid': '3857'}),
+            'measurement': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'clusters'", 'to': "orm['lizard_geodin.Measurement']"}),
+            'num_points': ('django.db.models.fields.IntegerField', [], {}),
+            'worst_state': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'zoom': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'lizard_geodin.project': {
+            'Meta': {'ordering': "(u'-active', u'name')", 'object_name': 'Project'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'api_starting_point': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "u'location_types'", 'null': 'True', 'to': "orm['lizard_geodin.ApiStartingPoint']"}),
+            'downloaded_json': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'metadata': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '250', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'source_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'})
+        },
+        'lizard_geodin.supplier': {
+            'Meta': {'object_name': 'Supplier'},
+            'html_color': ('django.db.models.fields.CharField', [], {'default': "u'#444444'", 'max_length': '20'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['lizard_geodin']
@@ -1,29 +1,93 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 from __future__ import unicode_literals
+import base64
+import calendar
 import datetime
 import logging
+import math
+import time
+import uuid
 
 import pytz
+from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point as GeosPoint
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+from django.db import transaction
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
+from lizard_map import coordinates
 from lizard_map.lizard_widgets import WorkspaceAcceptable
 import dateutil.parser
 import requests
 
+from lizard_geodin import alarms
+from lizard_geodin import clustering
+from lizard_geodin import compression
+from lizard_geodin import history
+from lizard_geodin.alarms import ALARM_CHOICES
+from lizard_geodin.alarms import ALARM_CRITICAL
+from lizard_geodin.alarms import ALARM_OK
+from lizard_geodin.alarms import ALARM_WARNING
+from lizard_geodin import metrics
+from lizard_geodin import profiling
+from lizard_geodin import seriesstore
+
 ADAPTER_NAME = 'lizard_geodin_points'
 POINT_JSON_CACHE_TIMEOUT = 120  # In seconds
 FALLBACK_POINT_JSON_CACHE_TIMEOUT = 60 * 60  # One hour.
 CSS_CRITICAL_COLOR = "#ff0000"
 CSS_WARNING_COLOR = "#d66d00"
+POINTS_VERSION_CACHE_KEY = 'geodin_points_version_{id}'
+TILES_VERSION_CACHE_KEY = 'geodin_tiles_version_{id}'
+VERSION_CACHE_TIMEOUT = 30 * 24 * 60 * 60  # A month.
+# Default for GEODIN_STALE_AFTER: age of a download that local-only views
+# refresh in the background.
+STALE_AFTER = 60 * 60  # In seconds.
+# Samples inserted with a single query.
+SAMPLE_CHUNK_SIZE = 1000
 
 logger = logging.getLogger(__name__)
 
 
+def downsample(line, max_points):
+    """Return the (time, value) line with at most ``max_points`` points.
+
+    The line is cut into buckets; of each bucket we keep the lowest and
+    highest value (in time order), so the peaks stay visible in the graph.
+
+    """
+    if max_points is None or len(line) <= max_points:
+        return line
+    bucket_size = int(math.ceil(len(line) / (max_points / 2.0)))
+    result = []
+    for start in range(0, len(line), bucket_size):
+        bucket = line[start:start + bucket_size]
+        lowest = min(bucket, key=lambda timestep: timestep[1])
+        highest = max(bucket, key=lambda timestep: timestep[1])
+        if lowest is highest:
+            result.append(lowest)
+        elif lowest[0] < highest[0]:
+            result.extend([lowest, highest])
+        else:
+            result.extend([highest, lowest])
+    return result
+
+
+def parse_geodin_date(date):
+    """Return timezone-aware datetime from geodin's date string.
+
+    Geodin's dates have no timezone, we assume UTC.
+    """
+    if not 'Z' in date:
+        date = date + "Z"
+    return dateutil.parser.parse(date)
+
+
 def timestamp_in_ms(date):
     # See http://people.iola.dk/olau/flot/examples/time.html
     # date += date.utcoffset()  # Make it look good for flot.
@@ -32,6 +96,65 @@ def timestamp_in_ms(date):
     return 1000 * timestamp_in_seconds
 
 
+class FetchPending(Exception):
+    """There's no local data yet, a background fetch has been queued."""
+
+
+def local_only():
+    """Return whether views may only use local data.
+
+    Set ``GEODIN_LOCAL_ONLY`` to keep geodin out of the request path: views
+    then queue a ``PendingFetch`` instead of downloading anything.
+    """
+    return getattr(settings, 'GEODIN_LOCAL_ONLY', False)
+
+
+def _version(key):
+    """Return the cached version string, starting one if there's none.
+
+    If the version drops out of the cache, we simply start a new one, which
+    invalidates the derived data, too.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(key, version, VERSION_CACHE_TIMEOUT)
+        # Someone else might have been quicker.
+        version = cache.get(key) or version
+    return version
+
+
+def points_version(measurement_id):
+    """Return version string that changes when the measurement's points do.
+
+    Use it in cache keys of things derived from the points' locations.
+    """
+    return _version(POINTS_VERSION_CACHE_KEY.format(id=measurement_id))
+
+
+def bump_points_version(measurement_id):
+    """Mark the measurement's points as changed."""
+    cache.set(POINTS_VERSION_CACHE_KEY.format(id=measurement_id),
+              uuid.uuid4().hex,
+              VERSION_CACHE_TIMEOUT)
+
+
+def tiles_version(measurement_id):
+    """Return version string that changes when the measurement's tiles do.
+
+    That is when its clusters have been rebuilt (which a sync does after
+    the points changed) and when its points' alarm states change.
+    """
+    return _version(TILES_VERSION_CACHE_KEY.format(id=measurement_id))
+
+
+def bump_tiles_version(measurement_id):
+    """Mark the measurement's tiles as changed."""
+    cache.set(TILES_VERSION_CACHE_KEY.format(id=measurement_id),
+              uuid.uuid4().hex,
+              VERSION_CACHE_TIMEOUT)
+
+
 class Common(models.Model):
     """Abstract base class for the Geodin models.
 
@@ -64,6 +187,8 @@ class Common(models.Model):
     create_subitems = False
     auto_fill_metadata = False
     cache_json_from_api = False
+    # Keep a copy of every download in ``downloaded_json``.
+    keep_downloaded_json = True
     json_request_timeout = 10
     # The common fields.
     name = models.CharField(
@@ -145,7 +270,7 @@ class Common(models.Model):
         Set ``from_cache_is_ok`` to False if you want to refresh the cache.
 
         """
-        if self.downloaded_json is not None:
+        if self.downloaded_json is not None and from_cache_is_ok:
             logger.debug("Using downloaded json for %r", self)
             return self.downloaded_json
         logger.error("Help, grabbing json from geodin for %r", self)
@@ -154,45 +279,63 @@ class Common(models.Model):
         cache_key = self.source_url
         fallback_cache_key = 'FALLBACK' + self.source_url
         if self.cache_json_from_api and from_cache_is_ok:
-            cache_result = cache.get(cache_key)
+            cache_result = profiling.cache_get(cache_key)
             if cache_result is not None:
                 logger.debug("Returning cached json result.")
                 return cache_result
+        model_name = self.__class__.__name__.lower()
+        start = time.time()
         try:
-            response = requests.get(self.source_url,
-                                    timeout=self.json_request_timeout)
+            with profiling.upstream_call():
+                response = requests.get(self.source_url,
+                                        timeout=self.json_request_timeout)
         except requests.exceptions.Timeout:
+            metrics.inc('geodin_fetch_timeouts_total', model=model_name)
             if self.cache_json_from_api:
                 # Try and grab the fallback cache value, which can be up to an
                 # hour old.
-                cache_result = cache.get(fallback_cache_key)
+                cache_result = profiling.cache_get(fallback_cache_key)
                 if cache_result is not None:
                     logger.warn(
                         "Timeout on %s; returning fallback cache value",
                         self.source_url)
+                    metrics.inc('geodin_fallback_cache_total',
+                                model=model_name, reason='timeout')
                     return cache_result
             raise
+        finally:
+            metrics.observe('geodin_fetch_seconds', time.time() - start,
+                            model=model_name)
         if response.json is None:
             msg = "No json found. HTTP status code was %s, text was \n%s"
             msg = msg % (response.status_code, response.text)
             if self.cache_json_from_api:
-                cache_result = cache.get(fallback_cache_key)
+                cache_result = profiling.cache_get(fallback_cache_key)
                 if cache_result is not None:
                     logger.warn(msg + " Returning fallback cache value")
+                    metrics.inc('geodin_fallback_cache_total',
+                                model=model_name, reason='no_json')
                     return cache_result
             raise ValueError(msg)
         result = response.json
         if self.cache_json_from_api:
-            cache.set(cache_key, result, POINT_JSON_CACHE_TIMEOUT)
-            cache.set(fallback_cache_key, result,
-                      FALLBACK_POINT_JSON_CACHE_TIMEOUT)
+            profiling.cache_set(cache_key, result, POINT_JSON_CACHE_TIMEOUT)
+            profiling.cache_set(fallback_cache_key, result,
+                                FALLBACK_POINT_JSON_CACHE_TIMEOUT)
             logger.debug("Caching json result from API.")
-        # Temp hack.
-        self.downloaded_json = result
+        self.json_downloaded(result)
+        if self.keep_downloaded_json:
+            # Temp hack.
+            self.downloaded_json = result
         logger.info("Saved downloaded json: %r", self)
         self.save()
         return result
 
+    def json_downloaded(self, the_json):
+        """Hook that is called with every json freshly grabbed from geodin.
+        """
+        pass
+
 
 class Project(Common):
     """Geodin project, it is the starting point for the API.
@@ -222,6 +365,7 @@ class Project(Common):
         verbose_name = _('project')
         verbose_name_plural = _('projects')
         ordering = ('-active', 'name')
+        # Migration 0024 adds an index on (slug, active).
 
     def get_absolute_url(self):
         return reverse('lizard_geodin_project_view',
@@ -237,6 +381,10 @@ class Project(Common):
         ``views.py``.
 
         """
+        start = time.time()
+        rows_changed = 0
+        changed_measurement_ids = set()
+        synced_measurements = {}
         the_json = self.json_from_source_url(
             from_cache_is_ok=from_cache_is_ok)
         # already_handled = defaultdict(list)
@@ -260,6 +408,7 @@ class Project(Common):
                         if is_created:
                             supplier.name = supplier_name
                             supplier.save()
+                            rows_changed += 1
                         # Get parameter.
                         parameter_name = point_dict.pop('Description')
                         parameter_slug = slugify(parameter_name)[:50]
@@ -268,6 +417,7 @@ class Project(Common):
                         if is_created:
                             parameter.name = parameter_name
                             parameter.save()
+                            rows_changed += 1
                         # Get measurement.
                         measurement_name = '{project}: {parameter} ({supplier})'.format(
                             project=self.name,
@@ -285,17 +435,37 @@ class Project(Common):
                             measurement.data_type_name = data_type_name
                             measurement.name = measurement_name
                             measurement.save()
+                            rows_changed += 1
                         else:
                             logger.debug("Reusing existing measurement: %s",
                                          measurement_name)
+                        synced_measurements[measurement.id] = measurement
 
                         try:
                             point = Point.create_or_update_from_json(point_dict)
+                            old_location = point.location
+                            old_measurement_id = point.measurement_id
                             point.measurement = measurement
                             point.set_location_from_xy()
+                            point.current_value = point.metadata_value()
                             point.save()
+                            rows_changed += 1
                         except ValueError:
                             logger.warn("Point has no x/y: %s", point_dict)
+                            continue
+                        if (old_measurement_id != measurement.id or
+                            old_location != point.location):
+                            changed_measurement_ids.add(measurement.id)
+                            if old_measurement_id is not None:
+                                changed_measurement_ids.add(
+                                    old_measurement_id)
+        for measurement_id in changed_measurement_ids:
+            bump_points_version(measurement_id)
+        rows_changed += alarms.evaluate(synced_measurements.keys())
+        # The clusters' alarm states depend on the values, too.
+        for measurement in synced_measurements.values():
+            measurement.update_clusters()
+        metrics.record_sync(self.slug, time.time() - start, rows_changed)
 
 
 class ApiStartingPoint(Common):
@@ -391,6 +561,7 @@ class Measurement(models.Model):
         verbose_name = _('measurement')
         verbose_name_plural = _('measurements')
         ordering = ['project', 'supplier', 'name']
+        unique_together = ('project', 'parameter', 'supplier')
 
     def __unicode__(self):
         return self.name
@@ -409,6 +580,26 @@ class Measurement(models.Model):
             adapter_name=ADAPTER_NAME,
             adapter_layer_json={'measurement_id': self.id})
 
+    def update_clusters(self):
+        """Recalculate the stored point clusters for the low zoom levels."""
+        points = [(location.x, location.y, alarm_state)
+                  for location, alarm_state in self.points.filter(
+                projected_location__isnull=False).values_list(
+                'projected_location', 'alarm_state').iterator()]
+        clusters = []
+        for zoom in clustering.CLUSTER_ZOOM_LEVELS:
+            for x, y, num_points, worst_state in clustering.grid_clusters(
+                points, zoom):
+                clusters.append(PointCluster(
+                        measurement=self,
+                        zoom=zoom,
+                        num_points=num_points,
+                        worst_state=worst_state,
+                        location=GeosPoint(x, y, srid=3857)))
+        self.clusters.all().delete()
+        PointCluster.objects.bulk_create(clusters)
+        bump_tiles_version(self.id)
+
 
 class Supplier(models.Model):
     """Supplier/company that provides the measurement data apparatus."""
@@ -419,6 +610,7 @@ class Supplier(models.Model):
         blank=True)
     slug = models.SlugField(
         _('slug'),
+        unique=True,
         help_text=_("Often set automatically from the internal Geodin ID"))
     html_color = models.CharField(max_length=20, default="#444444")
 
@@ -443,6 +635,7 @@ class Parameter(models.Model):
         blank=True)
     slug = models.SlugField(
         _('slug'),
+        unique=True,
         help_text=_("Often set automatically from the internal Geodin ID"))
     unit = models.CharField(
         _('unit'),
@@ -462,6 +655,8 @@ class Point(Common):
     """Data point."""
     auto_fill_metadata = True
     cache_json_from_api = True
+    # ``packed_series`` has it, in a fraction of the space.
+    keep_downloaded_json = False
     field_mapping = {'source_url': 'Url',
                      'name': 'Name',
                      'x': 'Xcoord',
@@ -470,6 +665,27 @@ class Point(Common):
                      }
     warning_level = models.FloatField(null=True, blank=True)
     critical_level = models.FloatField(null=True, blank=True)
+    current_value = models.FloatField(
+        _('current value'),
+        help_text=_("Last value according to the project sync."),
+        null=True,
+        blank=True)
+    alarm_state = models.SmallIntegerField(
+        _('alarm state'),
+        help_text=_("Current value versus the levels, see alarms.py."),
+        choices=ALARM_CHOICES,
+        default=ALARM_OK,
+        db_index=True)
+    alarm_since = models.DateTimeField(
+        _('alarm since'),
+        help_text=_("When the point got into its current alarm state."),
+        null=True,
+        blank=True)
+    alarm_peak = models.FloatField(
+        _('alarm peak'),
+        help_text=_("Highest value since the alarm started."),
+        null=True,
+        blank=True)
     x = models.FloatField(null=True, blank=True)
     y = models.FloatField(null=True, blank=True)
     z = models.FloatField(null=True, blank=True)
@@ -489,10 +705,29 @@ class Point(Common):
             "Generated automatically from the x/y/z values."),
         null=True,
         blank=True)
+    projected_location = models.PointField(
+        help_text=_(
+            "Location in google's spherical mercator, for the map searches."),
+        srid=3857,
+        null=True,
+        blank=True)
+    last_fetched = models.DateTimeField(
+        _('last fetched'),
+        help_text=_("When the timeseries was last downloaded from geodin."),
+        null=True,
+        blank=True)
+    packed_series = models.TextField(
+        _('packed series'),
+        help_text=_("Last downloaded timeseries, base64 encoded in the "
+                    "compact format of compression.py."),
+        null=True,
+        blank=True)
     objects = models.GeoManager()
 
     class Meta:
         ordering = ('name', 'slug', )
+        # The slug field comes from Common, so we can't set unique on it.
+        unique_together = ('slug', )
         verbose_name = _('point with data')
         verbose_name_plural = _('points with data')
 
@@ -515,13 +750,6 @@ class Point(Common):
         'data' for flot. You can add 'color' and so yourself afterwards.
 
         """
-        the_json = self.json_from_source_url()
-        logger.debug("Got the json data from Geodin.")
-        if not the_json:
-            # Empty.
-            return []
-
-        line = []
         # now = datetime.datetime.now(tz=pytz.timezone('Europe/Amsterdam'))
         now = dateutil.parser.parse('2012-09-08T14:01:00Z')
         # ^^^ Hardcoded for the fixed demo: afternoon after the collapse.
@@ -530,16 +758,60 @@ class Point(Common):
         else:
             # Just one week.
             cutoff_date = now - datetime.timedelta(days=7)
-        for timestep in the_json:
-            date = timestep.pop('Date')
-            if not 'Z' in date:
-                date = date + "Z"  # Assumption: we're in UTC.
-            date = dateutil.parser.parse(date)
-            if date < cutoff_date:
+        cutoff_timestamp = calendar.timegm(cutoff_date.utctimetuple())
+        timestamps, values = self.series(start=cutoff_timestamp)
+        if not len(timestamps):
+            # Empty.
+            return []
+
+        line = []
+        for timestamp, value in zip(timestamps, values):
+            if timestamp < cutoff_timestamp:
                 continue
-            line.append((timestamp_in_ms(date), timestep['Value']))
-        min_time = timestamp_in_ms(cutoff_date)
-        max_time = timestamp_in_ms(now)
+            date = datetime.datetime.fromtimestamp(int(timestamp), pytz.utc)
+            value = None if math.isnan(value) else float(value)
+            line.append((timestamp_in_ms(date), value))
+        return self.flot_lines(line, cutoff_date, now)
+
+    def has_local_series(self):
+        """Return whether ``series()`` can do without geodin."""
+        return bool(self.packed_series or self.downloaded_json is not None or
+                    (seriesstore.store_dir() and seriesstore.get(self.id)))
+
+    def series(self, start=None):
+        """Return (timestamps, values) arrays of geodin's timeseries.
+
+        Timestamps are in seconds, missing values are NaN. They come from
+        the series store (see ``seriesstore.py``) when that's enabled, only
+        from ``start`` on. Otherwise they're decoded from ``packed_series``
+        when we have it, which is a lot quicker and smaller than the json.
+
+        In local-only mode, raise ``FetchPending`` if we have nothing.
+        """
+        result = seriesstore.read(self.id, start=start)
+        if result is not None:
+            return result
+        if self.packed_series:
+            return compression.unpack(base64.b64decode(self.packed_series))
+        if self.downloaded_json is None and local_only():
+            self.request_fetch()
+            raise FetchPending("No local timeseries for %r" % self)
+        logger.debug("No packed series for %r, using the json.", self)
+        return compression.json_to_arrays(self.json_from_source_url())
+
+    def history_timeseries(self, start, end, width=history.WIDTH):
+        """Return flot data like ``timeseries()``, but from our samples.
+
+        The period can be as long as you want, see ``history.py``.
+        """
+        line = [(timestamp_in_ms(date), value) for date, value in
+                history.sample_line(self.id, start, end, width=width)]
+        return self.flot_lines(line, start, end)
+
+    def flot_lines(self, line, start, end):
+        """Return flot's list of lines: our values and the levels."""
+        min_time = timestamp_in_ms(start)
+        max_time = timestamp_in_ms(end)
         result = [{'label': self.measurement.parameter.name,
                    'data': line,
                    'min': min_time,
@@ -560,8 +832,105 @@ class Point(Common):
                                     [max_time, self.critical_level]]})
         return result
 
-    def last_value(self):
-        """Return last known value."""
+    def flot_data(self, one_day_only=False, max_points=None, start=None,
+                  end=None, width=history.WIDTH):
+        """Return dict with the flot ``data`` and the x axis' min/max.
+
+        Pass ``max_points`` to downsample the timeseries line. Pass a
+        ``start`` and/or ``end`` datetime to get that period from the sample
+        history instead of the last day or week from geodin, in about
+        ``width`` values.
+        """
+        if start is None and end is None:
+            data = self.timeseries(one_day_only=one_day_only)
+        else:
+            start, end = history.period(start, end)
+            data = self.history_timeseries(start, end, width=width)
+        result = {'data': data}
+        if data and 'max' in data[0]:
+            data[0]['data'] = downsample(data[0]['data'], max_points)
+            result['max'] = data[0]['max']
+            result['min'] = data[0]['min']
+        return result
+
+    def json_downloaded(self, the_json):
+        """Pack the timeseries and add it to our history.
+
+        See ``pack_series()`` and ``store_samples()``. It is also written to
+        the series store, if enabled.
+        """
+        self.last_fetched = timezone.now()
+        self.pack_series(the_json)
+        if seriesstore.store_dir():
+            seriesstore.write(self.id, *compression.json_to_arrays(the_json))
+        self.store_samples(the_json)
+
+    def is_stale(self):
+        """Return whether our timeseries is older than GEODIN_STALE_AFTER."""
+        if self.last_fetched is None:
+            return True
+        stale_after = getattr(settings, 'GEODIN_STALE_AFTER', STALE_AFTER)
+        return (timezone.now() - self.last_fetched >
+                datetime.timedelta(seconds=stale_after))
+
+    def request_fetch(self):
+        """Queue a background download of our timeseries."""
+        PendingFetch.objects.get_or_create(point=self)
+
+    def pack_series(self, the_json):
+        """Set ``packed_series`` from geodin's timeseries json.
+
+        It replaces the json, so ``downloaded_json`` is emptied.
+        """
+        self.packed_series = base64.b64encode(
+            compression.pack_json(the_json)).decode('ascii')
+        self.downloaded_json = None
+
+    def store_samples(self, the_json):
+        """Append the timeseries json's timesteps, see ``store_series()``.
+        """
+        return self.store_series(*compression.json_to_arrays(the_json))
+
+    @transaction.commit_on_success
+    def store_series(self, timestamps, series_values):
+        """Append the series' new values to our samples.
+
+        Geodin only gives us the last couple of days, so the history only
+        grows if we store every download. Timestamps (seconds) we already
+        have are left alone, also when another process stores them at the
+        same time. Missing (NaN) values are skipped. Return the number of
+        new samples.
+
+        """
+        values = {}
+        for timestamp, value in zip(timestamps, series_values):
+            if math.isnan(value):
+                continue
+            date = datetime.datetime.fromtimestamp(timestamp, pytz.utc)
+            values[history.db_datetime(date)] = float(value)
+        if not values:
+            return 0
+        existing = set(self.samples.filter(
+                timestamp__gte=min(values),
+                timestamp__lte=max(values)).values_list('timestamp',
+                                                        flat=True))
+        new_samples = _insert_samples(
+            [Sample(point=self, timestamp=date, value=value)
+             for date, value in sorted(values.items())
+             if date not in existing])
+        if new_samples:
+            history.update_rollups(self.id, new_samples[0].timestamp,
+                                   new_samples[-1].timestamp)
+        return len(new_samples)
+
+    def metadata_value(self):
+        """Return last known value as found in the metadata, or None.
+
+        The project's json gives us the last value along with the point, so
+        this doesn't need geodin.
+        """
+        if not self.metadata:
+            return None
         keys = [key for key in self.metadata.keys()
                 if not key.startswith('DF_') or key == 'Date']
         if 'F_DECAY' in keys and 'STPH' in keys:
@@ -570,18 +939,31 @@ class Point(Common):
             last_value_key = keys[0]
             last_value = self.metadata[last_value_key]
             try:
-                last_value = float(last_value)
-                return last_value
-            except ValueError:
+                return float(last_value)
+            except (TypeError, ValueError):
                 pass
-        # Fallback: grab the json.
-        the_json = self.json_from_source_url()
-        last_timestep = the_json[-1]
-        return last_timestep['Value']
+        return None
+
+    def last_value(self):
+        """Return last known value, None if there is none."""
+        last_value = self.metadata_value()
+        if last_value is not None:
+            return last_value
+        # Fallback: the timeseries.
+        try:
+            timestamps, values = self.series()
+        except FetchPending:
+            return None
+        if not len(values) or math.isnan(values[-1]):
+            return None
+        return values[-1]
 
     def set_location_from_xy(self):
         """x/y is assumed to be in WGS."""
         self.location = GeosPoint(float(self.x), float(self.y))
+        self.projected_location = GeosPoint(
+            *coordinates.wgs84_to_google(float(self.x), float(self.y)),
+            srid=3857)
 
     def get_popup_url(self):
         return reverse('lizard_geodin_point', kwargs={'slug': self.slug})
@@ -592,3 +974,136 @@ class Point(Common):
                 self.name, self.slug)
         except:
             return self.name or self.slug
+
+
+class PointCluster(models.Model):
+    """Precomputed cluster of a measurement's points for one zoom level.
+
+    At low zoom levels we show these instead of the individual points, see
+    ``clustering.py``. The location is in google's spherical mercator, as
+    that's what the grid is made in.
+    """
+    measurement = models.ForeignKey(
+        'Measurement',
+        related_name='clusters')
+    zoom = models.IntegerField(_('zoom level'))
+    num_points = models.IntegerField(_('number of points'))
+    worst_state = models.SmallIntegerField(
+        _('worst threshold state'),
+        choices=ALARM_CHOICES,
+        default=ALARM_OK)
+    location = models.PointField(srid=3857)
+    objects = models.GeoManager()
+
+    class Meta:
+        verbose_name = _('cluster of points')
+        verbose_name_plural = _('clusters of points')
+
+    def __unicode__(self):
+        return '%s points (zoom %s)' % (self.num_points, self.zoom)
+
+
+class Sample(models.Model):
+    """One timestep of a point's timeseries, see ``Point.store_samples()``.
+
+    Append-only. The unique (point, timestamp) index keeps the samples of a
+    point together in time order, which is what all our queries want.
+    """
+    point = models.ForeignKey(
+        'Point',
+        related_name='samples')
+    timestamp = models.DateTimeField(_('timestamp'))
+    value = models.FloatField(_('value'))
+
+    class Meta:
+        verbose_name = _('sample')
+        verbose_name_plural = _('samples')
+        unique_together = ('point', 'timestamp')
+        ordering = ('point', 'timestamp')
+
+    def __unicode__(self):
+        return '%s %s: %s' % (self.point_id, self.timestamp, self.value)
+
+
+def _insert_if_new(samples):
+    """Insert the samples, return False if any of them already exists."""
+    savepoint = transaction.savepoint()
+    try:
+        Sample.objects.bulk_create(samples)
+    except IntegrityError:
+        transaction.savepoint_rollback(savepoint)
+        return False
+    transaction.savepoint_commit(savepoint)
+    return True
+
+
+def _insert_samples(samples):
+    """Insert the samples in chunks, return the ones that were new.
+
+    Another process can insert some of them between our check and our
+    insert. The chunk with those is then inserted one by one instead,
+    skipping the ones that are there now. Needs a managed transaction:
+    ``bulk_create()`` commits otherwise.
+    """
+    inserted = []
+    for index in range(0, len(samples), SAMPLE_CHUNK_SIZE):
+        chunk = samples[index:index + SAMPLE_CHUNK_SIZE]
+        if _insert_if_new(chunk):
+            inserted.extend(chunk)
+            continue
+        inserted.extend(sample for sample in chunk
+                        if _insert_if_new([sample]))
+    return inserted
+
+
+class Rollup(models.Model):
+    """Aggregated samples of a point per 10 minutes, hour or day.
+
+    ``level`` is the bucket size in seconds, see ``history.RESOLUTIONS``.
+    Long periods are read from here instead of from the samples.
+    """
+    point = models.ForeignKey(
+        'Point',
+        related_name='rollups')
+    level = models.IntegerField(_('level'))
+    bucket_start = models.DateTimeField(_('bucket start'))
+    min_value = models.FloatField(_('minimum'))
+    max_value = models.FloatField(_('maximum'))
+    sum_value = models.FloatField(_('sum'))
+    num_values = models.IntegerField(_('number of values'))
+
+    class Meta:
+        verbose_name = _('rollup')
+        verbose_name_plural = _('rollups')
+        unique_together = ('point', 'level', 'bucket_start')
+        ordering = ('point', 'level', 'bucket_start')
+
+    def __unicode__(self):
+        return '%s %s (%ss)' % (self.point_id, self.bucket_start, self.level)
+
+    @property
+    def mean(self):
+        return self.sum_value / self.num_values
+
+
+class PendingFetch(models.Model):
+    """A point whose timeseries has to be downloaded in the background.
+
+    Local-only views (see ``local_only()``) queue these instead of calling
+    geodin. The ``process_fetch_queue`` management command works through
+    them.
+    """
+    point = models.OneToOneField(
+        'Point',
+        related_name='pending_fetch')
+    requested = models.DateTimeField(_('requested'), auto_now_add=True)
+    attempts = models.IntegerField(_('failed attempts'), default=0)
+    last_error = models.TextField(_('last error'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('pending fetch')
+        verbose_name_plural = _('pending fetches')
+        ordering = ('requested', )
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.point_id, self.requested)
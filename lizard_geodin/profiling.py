@@ -0,0 +1,115 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Per-request breakdown of where the time of a geodin page goes.
+
+``ProfilingMiddleware`` (see ``middleware.py``) starts a ``RequestProfile``
+for every request. Our code reports upstream geodin calls and cache accesses
+to it through the helpers in here. Outside of a profiled request the helpers
+are cheap no-ops, so they're safe to call from management commands.
+
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import threading
+import time
+
+from django.core.cache import cache
+
+_local = threading.local()
+
+
+class RequestProfile(object):
+    """Counters and timings for one request."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.num_queries = 0
+        self.query_seconds = 0.0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_seconds = 0.0
+        self.render_start = None
+        self.render_seconds = 0.0
+
+    @property
+    def total_seconds(self):
+        end = self.end or time.time()
+        return end - self.start
+
+    def rendered(self, response):
+        """Post-render callback for template responses."""
+        if self.render_start is not None:
+            self.render_seconds += time.time() - self.render_start
+            self.render_start = None
+
+    def as_dict(self):
+        return {'total_ms': round(self.total_seconds * 1000, 1),
+                'db_queries': self.num_queries,
+                'db_ms': round(self.query_seconds * 1000, 1),
+                'upstream_calls': self.upstream_calls,
+                'upstream_ms': round(self.upstream_seconds * 1000, 1),
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'cache_ms': round(self.cache_seconds * 1000, 1),
+                'render_ms': round(self.render_seconds * 1000, 1)}
+
+    def as_header(self):
+        """Return the breakdown as a compact ``key=value;...`` string."""
+        return ';'.join('%s=%s' % item
+                        for item in sorted(self.as_dict().items()))
+
+
+def start_profile():
+    _local.profile = RequestProfile()
+    return _local.profile
+
+
+def stop_profile():
+    """Return the current profile (if any) and stop collecting."""
+    profile = current_profile()
+    _local.profile = None
+    if profile is not None:
+        profile.end = time.time()
+    return profile
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def upstream_call():
+    """Time the wrapped call to the geodin server."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile = current_profile()
+        if profile is not None:
+            profile.upstream_calls += 1
+            profile.upstream_seconds += time.time() - start
+
+
+def cache_get(key):
+    """Return ``cache.get(key)``, recording the hit or miss."""
+    start = time.time()
+    value = cache.get(key)
+    profile = current_profile()
+    if profile is not None:
+        profile.cache_seconds += time.time() - start
+        if value is None:
+            profile.cache_misses += 1
+        else:
+            profile.cache_hits += 1
+    return value
+
+
+def cache_set(key, value, timeout):
+    """Call ``cache.set()``, recording the time it takes."""
+    start = time.time()
+    cache.set(key, value, timeout)
+    profile = current_profile()
+    if profile is not None:
+        profile.cache_seconds += time.time() - start
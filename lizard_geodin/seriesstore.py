@@ -0,0 +1,166 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Optional on-disk store of the points' series, shared by all workers.
+
+Enable it by pointing the ``GEODIN_SERIES_STORE_DIR`` setting at a
+directory. Every download of a point's timeseries then also writes
+``<point id>.series`` there: a 16 byte header (magic, number of values)
+followed by the little-endian int64 timestamps (seconds) and the float64
+values. Files are written to a temporary file first and renamed into place,
+so readers always see a complete file.
+
+Readers map the files read-only, so all worker processes share the same
+pages of the OS' page cache instead of each deserializing their own copy.
+With numpy the arrays are views on the mapped file and slicing a period out
+of them doesn't copy anything; without numpy only the requested slice is
+unpacked.
+
+"""
+from __future__ import unicode_literals
+from array import array
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'GEODSER1'
+# Magic, number of values. 16 bytes, so the arrays are 8-byte aligned.
+HEADER = struct.Struct(b'<8sQ')
+TIMESTAMP = struct.Struct(b'<q')
+# Forget all open files when there are more than this many.
+MAX_OPEN_FILES = 1000
+
+_lock = threading.Lock()
+# Point id -> (file identity, SeriesFile).
+_open_files = {}
+
+
+def store_dir():
+    """Return the configured directory, None if the store isn't used."""
+    return getattr(settings, 'GEODIN_SERIES_STORE_DIR', None)
+
+
+def path(point_id, directory=None):
+    return os.path.join(directory or store_dir(), '%s.series' % point_id)
+
+
+def write(point_id, timestamps, values, directory=None):
+    """Atomically (re)write the point's series file."""
+    directory = directory or store_dir()
+    count = len(timestamps)
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as series_file:
+            series_file.write(HEADER.pack(MAGIC, count))
+            series_file.write(struct.pack(str('<%dq' % count), *timestamps))
+            series_file.write(struct.pack(str('<%dd' % count), *values))
+        # mkstemp only lets us read it.
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path(point_id, directory))
+    except:
+        os.remove(temp_path)
+        raise
+
+
+class SeriesFile(object):
+    """Read-only memory map of a series file."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as series_file:
+            self.mmap = mmap.mmap(series_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError("%s is no series file" % filename)
+        self.values_offset = HEADER.size + TIMESTAMP.size * self.count
+        self.timestamps = self.values = None
+        if numpy is not None:
+            self.timestamps = numpy.frombuffer(
+                self.mmap, dtype='<i8', count=self.count,
+                offset=HEADER.size)
+            self.values = numpy.frombuffer(
+                self.mmap, dtype='<f8', count=self.count,
+                offset=self.values_offset)
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, index):
+        return TIMESTAMP.unpack_from(
+            self.mmap, HEADER.size + TIMESTAMP.size * index)[0]
+
+    def index(self, timestamp):
+        """Return index of the first value at or after the timestamp."""
+        if self.timestamps is not None:
+            return int(self.timestamps.searchsorted(timestamp))
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def slice(self, start=None, end=None):
+        """Return (timestamps, values) from start until end (seconds)."""
+        first = 0 if start is None else self.index(start)
+        last = self.count if end is None else self.index(end)
+        last = max(first, last)
+        if self.timestamps is not None:
+            return self.timestamps[first:last], self.values[first:last]
+        count = last - first
+        timestamps = array(b'l', struct.unpack_from(
+                str('<%dq' % count), self.mmap,
+                HEADER.size + TIMESTAMP.size * first))
+        values = array(b'd', struct.unpack_from(
+                str('<%dd' % count), self.mmap,
+                self.values_offset + 8 * first))
+        return timestamps, values
+
+
+def get(point_id, directory=None):
+    """Return the point's mapped SeriesFile, None if there's no file.
+
+    A file is mapped once per process and mapped again when it has been
+    replaced.
+    """
+    filename = path(point_id, directory)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    identity = (filename, stat.st_ino, stat.st_mtime, stat.st_size)
+    cached = _open_files.get(point_id)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    series_file = SeriesFile(filename)
+    with _lock:
+        if len(_open_files) >= MAX_OPEN_FILES:
+            # The maps are closed when the last array on them is gone.
+            _open_files.clear()
+        _open_files[point_id] = (identity, series_file)
+    return series_file
+
+
+def read(point_id, start=None, end=None, directory=None):
+    """Return the point's (timestamps, values), None if not in the store."""
+    if not (directory or store_dir()):
+        return None
+    series_file = get(point_id, directory)
+    if series_file is None:
+        return None
+    return series_file.slice(start, end)
+
+
+def clear():
+    """Forget all mapped files, handy for tests."""
+    with _lock:
+        _open_files.clear()
@@ -0,0 +1,66 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""Compute an expensive cached value only once when many ask at once.
+
+When a popular graph's cache entry expires, all workers that ask for it at
+that moment would compute it. After a cache miss, ``compute_once()`` lets
+only the one that gets the lock (an atomic ``cache.add()``) compute it.
+The others poll the cache for a short while; if the value isn't there in
+time they get the previous value, which is kept much longer. Only if there
+is none they compute it themselves, so a crashed worker can't block anyone
+for long.
+
+"""
+from __future__ import unicode_literals
+import time
+
+from django.core.cache import cache
+
+from lizard_geodin import metrics
+from lizard_geodin import profiling
+
+LOCK_KEY = 'lock_{key}'
+PREVIOUS_KEY = 'previous_{key}'
+# A lock outlives a crashed worker for at most this long.
+LOCK_TIMEOUT = 30  # In seconds.
+PREVIOUS_TIMEOUT = 24 * 60 * 60  # One day.
+WAIT = 2.0  # In seconds.
+POLL_INTERVAL = 0.05  # In seconds.
+
+
+def compute_once(key, compute, timeout, wait=WAIT):
+    """Return ``compute()``'s value for ``key``, which wasn't in the cache.
+
+    ``compute`` is called without arguments, at most once for all
+    concurrent callers (unless it takes longer than ``wait`` seconds and
+    there's no previous value). Its result is cached for ``timeout``
+    seconds.
+    """
+    lock_key = LOCK_KEY.format(key=key)
+    if cache.add(lock_key, True, LOCK_TIMEOUT):
+        try:
+            # Someone else might have just finished computing it.
+            value = profiling.cache_get(key)
+            if value is not None:
+                metrics.inc('geodin_single_flight_total', result='waited')
+                return value
+            value = compute()
+            profiling.cache_set(key, value, timeout)
+            profiling.cache_set(PREVIOUS_KEY.format(key=key), value,
+                                PREVIOUS_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        metrics.inc('geodin_single_flight_total', result='computed')
+        return value
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        value = profiling.cache_get(key)
+        if value is not None:
+            metrics.inc('geodin_single_flight_total', result='waited')
+            return value
+    value = profiling.cache_get(PREVIOUS_KEY.format(key=key))
+    if value is not None:
+        metrics.inc('geodin_single_flight_total', result='previous')
+        return value
+    metrics.inc('geodin_single_flight_total', result='gave_up')
+    return compute()
@@ -0,0 +1,104 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""In-process grid index of a measurement's points for the hover search.
+
+Enable it with the ``GEODIN_IN_MEMORY_HOVER_INDEX`` setting. Each process
+then keeps the projected coordinates of the points of a measurement in
+compact arrays, bucketed in a square grid. The index is built on the first
+search and rebuilt when the sync bumps the measurement's points version, so
+all mouse moves after that are answered without a database query. (A point
+that's only renamed keeps its old name in the index until then.)
+
+"""
+from __future__ import unicode_literals
+from array import array
+import math
+import threading
+
+from lizard_geodin import models
+
+# Larger than the hover radius at the zoom levels that show single points,
+# so a search mostly looks at a couple of cells.
+CELL_SIZE = 250.0  # In meters.
+
+_lock = threading.Lock()
+# Measurement id -> (points version, index).
+_indexes = {}
+
+
+class GridIndex(object):
+    """Points bucketed in a grid of ``cell_size`` by ``cell_size`` meters.
+
+    ``points`` is an iterable of (id, name, x, y) with google coordinates.
+    """
+
+    def __init__(self, points, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.ids = array(b'l')
+        self.xs = array(b'd')
+        self.ys = array(b'd')
+        self.names = []
+        self.cells = {}
+        for index, (point_id, name, x, y) in enumerate(points):
+            self.ids.append(point_id)
+            self.xs.append(x)
+            self.ys.append(y)
+            self.names.append(name)
+            key = self._cell(x, y)
+            if key not in self.cells:
+                self.cells[key] = array(b'l')
+            self.cells[key].append(index)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def nearest(self, x, y, radius, limit):
+        """Return up to ``limit`` (id, name, distance) within ``radius``,
+        nearest first."""
+        min_col, min_row = self._cell(x - radius, y - radius)
+        max_col, max_row = self._cell(x + radius, y + radius)
+        found = []
+        for col in range(min_col, max_col + 1):
+            for row in range(min_row, max_row + 1):
+                for index in self.cells.get((col, row), ()):
+                    distance = math.hypot(self.xs[index] - x,
+                                          self.ys[index] - y)
+                    if distance <= radius:
+                        found.append((distance, index))
+        found.sort()
+        return [(self.ids[index], self.names[index], distance)
+                for distance, index in found[:limit]]
+
+
+def build_index(measurement_id):
+    points = models.Point.objects.filter(
+        measurement=measurement_id,
+        projected_location__isnull=False).values_list(
+        'id', 'name', 'projected_location')
+    return GridIndex((point_id, name, location.x, location.y)
+                     for point_id, name, location in points.iterator())
+
+
+def get_index(measurement_id):
+    """Return the measurement's index, (re)building it when outdated."""
+    version = models.points_version(measurement_id)
+    cached = _indexes.get(measurement_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    index = build_index(measurement_id)
+    with _lock:
+        _indexes[measurement_id] = (version, index)
+    return index
+
+
+def nearest(measurement_id, x, y, radius, limit):
+    return get_index(measurement_id).nearest(x, y, radius, limit)
+
+
+def clear():
+    """Forget all indexes, handy for tests."""
+    with _lock:
+        _indexes.clear()
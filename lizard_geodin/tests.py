@@ -1,11 +1,59 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+import datetime
+import json
+import math
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.db import connection
 from django.http import Http404
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from lizard_map import coordinates
 
+from lizard_geodin import alarms
+from lizard_geodin import benchmark
+from lizard_geodin import clustering
+from lizard_geodin import compression
+from lizard_geodin import export
+from lizard_geodin import history
+from lizard_geodin import layers
+from lizard_geodin import metrics
+from lizard_geodin import middleware
 from lizard_geodin import models
+from lizard_geodin import profiling
+from lizard_geodin import seriesstore
+from lizard_geodin import singleflight
+from lizard_geodin import spatialindex
+from lizard_geodin import tiles
+from lizard_geodin import urls
 from lizard_geodin import views
 
 
+def create_small_dataset(points_per_measurement=1):
+    """Return the first point of a single synthetic measurement."""
+    return benchmark.create_synthetic_dataset(
+        num_projects=1, num_suppliers=1, num_parameters=1,
+        points_per_measurement=points_per_measurement)
+
+
+class SmallDatasetMixin(object):
+    """Give every test ``self.point`` from ``create_small_dataset()``."""
+    points_per_measurement = 1
+
+    def setUp(self):
+        self.point = create_small_dataset(self.points_per_measurement)
+
+
 class CommonModelTest(TestCase):
     # The tests are done with Project because Common is abstract.
 
@@ -90,3 +138,1127 @@ class ProjectViewTest(TestCase):
         view = views.ProjectView()
         view.kwargs = {'slug': 'slug'}
         self.assertEquals(view.project, project)
+
+
+class QueryBudgetTest(TestCase):
+
+    def test_all_views_render(self):
+        point = benchmark.create_synthetic_dataset()
+        for url_name, url, status_code, num_queries, seconds in (
+            benchmark.render_all_views(self.client, point)):
+            self.assertEquals(status_code, 200, url)
+
+    def test_within_budget(self):
+        point = benchmark.create_synthetic_dataset()
+        measurements = benchmark.render_all_views(self.client, point)
+        self.assertEquals(benchmark.budget_violations(measurements), [])
+
+    def test_query_count_independent_of_dataset_size(self):
+        point = create_small_dataset()
+        small = benchmark.render_all_views(self.client, point)
+        benchmark.delete_synthetic_dataset()
+        point = benchmark.create_synthetic_dataset(
+            num_projects=3, num_suppliers=3, num_parameters=3,
+            points_per_measurement=10)
+        large = benchmark.render_all_views(self.client, point)
+        for small_result, large_result in zip(small, large):
+            if small_result[0] in benchmark.PER_POINT_VIEWS:
+                continue
+            self.assertEquals(small_result[3], large_result[3],
+                              "Query count of %s grows with the data" %
+                              small_result[0])
+
+    def test_every_view_has_a_budget(self):
+        url_names = set(
+            getattr(pattern, 'name', None) for pattern in urls.urlpatterns)
+        url_names = set(name for name in url_names
+                        if name and name.startswith('lizard_geodin_'))
+        self.assertEquals(url_names - set(benchmark.VIEW_BUDGETS), set())
+
+
+class ProfilingTest(TestCase):
+
+    def tearDown(self):
+        profiling.stop_profile()
+
+    def test_no_profile_outside_request(self):
+        self.assertEquals(profiling.cache_get('nonexisting'), None)
+        self.assertEquals(profiling.current_profile(), None)
+
+    def test_cache_hits_and_misses(self):
+        cache.set('profiling-test', 42)
+        profile = profiling.start_profile()
+        profiling.cache_get('profiling-test')
+        profiling.cache_get('nonexisting')
+        self.assertEquals(profile.cache_hits, 1)
+        self.assertEquals(profile.cache_misses, 1)
+
+    def test_upstream_call(self):
+        profile = profiling.start_profile()
+        with profiling.upstream_call():
+            pass
+        self.assertEquals(profile.upstream_calls, 1)
+
+    def test_middleware_header(self):
+        request = RequestFactory().get('/')
+        profiling_middleware = middleware.ProfilingMiddleware()
+        profiling_middleware.process_request(request)
+        response = profiling_middleware.process_response(
+            request, HttpResponse('hurray'))
+        self.assertTrue('db_queries=' in response['X-Geodin-Profile'])
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_counter(self):
+        metrics.inc('geodin_fetch_timeouts_total', model='point')
+        metrics.inc('geodin_fetch_timeouts_total', model='point')
+        self.assertTrue('geodin_fetch_timeouts_total{model="point"} 2.0'
+                        in metrics.render())
+
+    def test_histogram(self):
+        metrics.observe('geodin_fetch_seconds', 0.3, model='point')
+        output = metrics.render()
+        self.assertTrue(
+            'geodin_fetch_seconds_bucket{model="point",le="0.5"} 1' in output)
+        self.assertTrue(
+            'geodin_fetch_seconds_bucket{model="point",le="0.25"} 0' in output)
+        self.assertTrue('geodin_fetch_seconds_count{model="point"} 1'
+                        in output)
+
+    def test_histogram_sum(self):
+        metrics.observe('geodin_fetch_seconds', 0.3, model='point')
+        metrics.observe('geodin_fetch_seconds', 0.2, model='point')
+        self.assertTrue('geodin_fetch_seconds_sum{model="point"} 0.5'
+                        in metrics.render())
+
+    def test_kept_in_the_cache(self):
+        # Nothing is kept in-process: other workers see the same numbers,
+        # and an evicted series simply starts again.
+        metrics.inc('geodin_fetch_timeouts_total', model='point')
+        cache.clear()
+        self.assertEquals(metrics.render(), '\n')
+        metrics.inc('geodin_fetch_timeouts_total', model='point')
+        self.assertTrue('geodin_fetch_timeouts_total{model="point"} 1.0'
+                        in metrics.render())
+
+    def test_last_sync(self):
+        metrics.record_sync('project', 1.5, 10)
+        output = metrics.render(gauges=metrics.last_syncs(['project']))
+        self.assertTrue(
+            'geodin_last_sync_rows_changed{project="project"} 10.0' in output)
+
+    def test_flot_cache_metrics(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        url = '/flot/%s/' % point.id
+        cache.clear()
+        self.client.get(url)
+        self.client.get(url)
+        output = self.client.get('/metrics/').content
+        self.assertTrue(
+            'geodin_flot_cache_requests_total{result="hit"} 1.0' in output)
+        self.assertTrue(
+            'geodin_flot_cache_requests_total{result="miss"} 1.0' in output)
+
+
+class PointListViewTest(TestCase):
+
+    def setUp(self):
+        self.point = benchmark.create_synthetic_dataset(
+            num_projects=1, num_suppliers=2, num_parameters=1,
+            points_per_measurement=3)
+        self.view = views.PointListView()
+        self.view.paginate_by = 100
+
+    def _request(self, path='/point/', filters=None):
+        request = RequestFactory().get(path)
+        request.session = {'filter-measurements': filters or {}}
+        self.view.request = request
+
+    def test_all_points(self):
+        self._request()
+        self.assertEquals(len(self.view.points()), 6)
+
+    def test_supplier_filter(self):
+        supplier = self.point.measurement.supplier
+        self._request(filters={'Supplier::%s' % supplier.id: 'false'})
+        points = self.view.points()
+        self.assertEquals(len(points), 3)
+        self.assertTrue(self.point not in points)
+
+    def test_constant_queries(self):
+        supplier = self.point.measurement.supplier
+        self._request(filters={'Supplier::%s' % supplier.id: 'true'})
+        with self.assertNumQueries(1):
+            [point.measurement.parameter.id for point in self.view.points()]
+
+    def test_slug_order(self):
+        slugs = list(models.Point.objects.values_list('slug', flat=True))
+        slugs.reverse()
+        self._request('/point/?' + '&'.join('slug=' + slug
+                                            for slug in slugs))
+        self.assertEquals([point.slug for point in self.view.points()],
+                          slugs)
+
+    def test_unknown_slug(self):
+        self._request('/point/?slug=nonexisting')
+        with self.assertRaises(Http404):
+            self.view.points()
+
+    def test_filtered_slug_is_no_404(self):
+        supplier = self.point.measurement.supplier
+        self._request('/point/?slug=%s' % self.point.slug,
+                      filters={'Supplier::%s' % supplier.id: 'false'})
+        self.assertEquals(list(self.view.points()), [])
+
+    def test_pagination(self):
+        self.view.paginate_by = 4
+        self._request()
+        first_page = self.view.points()
+        next_page_url = self.view.next_page_url()
+        self.assertEquals(len(first_page), 4)
+        self.view = views.PointListView()
+        self.view.paginate_by = 4
+        self._request('/point/' + next_page_url)
+        second_page = self.view.points()
+        self.assertEquals(len(second_page), 2)
+        self.assertEquals(self.view.next_page_url(), None)
+        self.assertTrue(self.view.first_page_url())
+        self.assertFalse(set(first_page) & set(second_page))
+
+    def test_stream(self):
+        self.view.stream_chunk_size = 4
+        self._request('/point/?stream=1')
+        content = ''.join(self.view.stream())
+        self.assertEquals(content.count('<iframe'), 6)
+
+
+class KeysetPageTest(TestCase):
+
+    def test_empty_names(self):
+        for slug, name in [('a', 'x'), ('b', None), ('c', 'y'), ('d', None)]:
+            models.Point.objects.create(slug=slug, name=name)
+        seen = []
+        cursor = None
+        while True:
+            page, next_cursor = views.keyset_page(
+                models.Point.objects.all(), cursor, 1)
+            seen.extend(point.slug for point in page)
+            if next_cursor is None:
+                break
+            cursor = views.decode_cursor(next_cursor)
+        self.assertEquals(seen, ['a', 'c', 'b', 'd'])
+
+    def test_invalid_cursor(self):
+        self.assertEquals(views.decode_cursor('nonsense'), None)
+
+
+class StyleCacheTest(TestCase):
+
+    def test_supplier_color(self):
+        supplier = models.Supplier(html_color='#ff0000')
+        self.assertEquals(layers.supplier_color(supplier),
+                          (1.0, 0.0, 0.0, 1.0))
+
+    def test_invalid_supplier_color(self):
+        supplier = models.Supplier(html_color='red')
+        self.assertEquals(layers.supplier_color(supplier),
+                          layers.ICON_STYLE['color'])
+
+    def test_prewarmed_on_first_use(self):
+        supplier = models.Supplier.objects.create(slug='supplier',
+                                                  html_color='#ff0000')
+        layers._STYLE_CACHE.clear()
+        layers._styles_prewarmed = False
+        layers.points_style(layers.ICON_STYLE['color'])
+        key = layers._style_key(layers.supplier_color(supplier))
+        self.assertTrue(key in layers._STYLE_CACHE)
+        self.assertTrue(('cluster', ) + key in layers._STYLE_CACHE)
+
+    def test_color_change_forgets_style(self):
+        supplier = models.Supplier.objects.create(slug='supplier',
+                                                  html_color='#ff0000')
+        key = layers._style_key(layers.supplier_color(supplier))
+        layers._STYLE_CACHE[key] = 'cached style'
+        supplier.html_color = '#00ff00'
+        supplier.save()
+        self.assertFalse(key in layers._STYLE_CACHE)
+
+
+class PointsVersionTest(TestCase):
+
+    def test_stable(self):
+        self.assertEquals(models.points_version(42),
+                          models.points_version(42))
+
+    def test_bump(self):
+        version = models.points_version(42)
+        models.bump_points_version(42)
+        self.assertNotEquals(models.points_version(42), version)
+
+
+class TilesTest(TestCase):
+
+    def test_tile_bounds_world(self):
+        west, south, east, north = tiles.tile_bounds(0, 0, 0)
+        self.assertAlmostEquals(west, -tiles.ORIGIN_SHIFT)
+        self.assertAlmostEquals(north, tiles.ORIGIN_SHIFT)
+
+    def test_tiles_for_extent(self):
+        bounds = tiles.tile_bounds(10, 525, 336)
+        extent = {'west': bounds[0] + 1, 'south': bounds[1] + 1,
+                  'east': bounds[2] - 1, 'north': bounds[3] - 1}
+        self.assertEquals(tiles.tiles_for_extent(extent, 10), [(525, 336)])
+
+    def test_valid_tile(self):
+        self.assertTrue(tiles.valid_tile(0, 0, 0))
+        self.assertTrue(tiles.valid_tile(10, 1023, 0))
+        self.assertFalse(tiles.valid_tile(10, 1024, 0))
+        self.assertFalse(tiles.valid_tile(tiles.MAX_ZOOM + 1, 0, 0))
+
+    def test_out_of_range_tile_not_found(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        response = self.client.get('/tiles/%s/2/4/0.png' %
+                                   point.measurement.id)
+        self.assertEquals(response.status_code, 404)
+
+    def test_clusters_at_low_zoom(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        mapnik_layers, styles = tiles.tile_layers(point.measurement, 8)
+        self.assertEquals(styles.keys(), ['clustersStyle'])
+        mapnik_layers, styles = tiles.tile_layers(
+            point.measurement, clustering.FIRST_POINTS_ZOOM)
+        self.assertEquals(styles.keys(), ['pointsStyle'])
+
+    def test_render_clustered_tile(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        x, y = tiles.tile_for_location(point.projected_location, 8)
+        png = tiles.render_tile(point.measurement, 8, x, y)
+        self.assertTrue(png.startswith(b'\x89PNG'))
+
+    def test_cache_key_follows_clusters(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        measurement = point.measurement
+        key = tiles.tile_cache_key(measurement, 10, 525, 336)
+        measurement.update_clusters()
+        self.assertNotEquals(tiles.tile_cache_key(measurement, 10, 525, 336),
+                             key)
+
+    def test_cache_key_follows_alarm_states(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        measurement = point.measurement
+        key = tiles.tile_cache_key(measurement, 10, 525, 336)
+        alarms.evaluate([measurement.id])
+        # Nothing changed.
+        self.assertEquals(tiles.tile_cache_key(measurement, 10, 525, 336),
+                          key)
+        models.Point.objects.filter(pk=point.pk).update(critical_level=0.5)
+        alarms.evaluate([measurement.id])
+        self.assertNotEquals(tiles.tile_cache_key(measurement, 10, 525, 336),
+                             key)
+
+
+class ClusteringTest(TestCase):
+
+    def test_grid_clusters(self):
+        points = [(0.0, 0.0, models.ALARM_OK),
+                  (1.0, 1.0, models.ALARM_CRITICAL),
+                  (1000000.0, 0.0, models.ALARM_WARNING)]
+        clusters = sorted(clustering.grid_clusters(points, 5))
+        self.assertEquals(clusters, [(0.5, 0.5, 2, models.ALARM_CRITICAL),
+                                     (1000000.0, 0.0, 1,
+                                      models.ALARM_WARNING)])
+
+    def test_zoom_for_resolution(self):
+        self.assertEquals(
+            clustering.zoom_for_resolution(clustering.resolution(12)), 12)
+
+    def test_zoom_from_wms_request(self):
+        bbox = '0,0,%s,%s' % (256 * clustering.resolution(10),
+                              256 * clustering.resolution(10))
+        request = RequestFactory().get('/wms/', {'BBOX': bbox,
+                                                 'WIDTH': '256'})
+        self.assertEquals(clustering.zoom_from_wms_request(request), 10)
+
+    def test_update_clusters(self):
+        point = benchmark.create_synthetic_dataset(num_projects=1)
+        measurement = point.measurement
+        measurement.update_clusters()
+        clusters = measurement.clusters.filter(zoom=0)
+        self.assertEquals(len(clusters), 1)
+        self.assertEquals(clusters[0].num_points,
+                          measurement.points.count())
+
+
+class PointsGeojsonTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 3
+
+    def setUp(self):
+        super(PointsGeojsonTest, self).setUp()
+        self.url = '/points/%s/geojson/' % self.point.measurement.id
+
+    def test_all_points(self):
+        response = self.client.get(self.url)
+        features = json.loads(response.content)['features']
+        self.assertEquals(len(features), 3)
+        self.assertEquals(features[0]['properties']['value'], 1.0)
+        self.assertTrue('max-age' in response['Cache-Control'])
+
+    def test_bbox(self):
+        x, y = self.point.location.x, self.point.location.y
+        bbox = '%s,%s,%s,%s' % (x - 0.0005, y - 0.0005, x + 0.0005, y + 0.0005)
+        response = self.client.get(self.url, {'bbox': bbox})
+        features = json.loads(response.content)['features']
+        self.assertEquals([feature['id'] for feature in features],
+                          [self.point.id])
+
+    def test_invalid_bbox(self):
+        response = self.client.get(self.url, {'bbox': 'a,b'})
+        self.assertEquals(response.status_code, 400)
+
+
+class HoverSearchTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 3
+
+    def setUp(self):
+        super(HoverSearchTest, self).setUp()
+        self.adapter = layers.GeodinPoints(
+            None, layer_arguments={'measurement_id': self.point.measurement.id})
+
+    def test_projected_location(self):
+        x, y = coordinates.wgs84_to_google(self.point.x, self.point.y)
+        self.assertAlmostEquals(self.point.projected_location.x, x)
+        self.assertAlmostEquals(self.point.projected_location.y, y)
+
+    def test_nearest_point(self):
+        location = self.point.projected_location
+        result = self.adapter.search(location.x + 5, location.y, radius=20)
+        self.assertEquals([found['identifier'] for found in result],
+                          [{'point_id': self.point.id}])
+        self.assertAlmostEquals(result[0]['distance'], 5, places=3)
+
+    def test_nothing_in_radius(self):
+        location = self.point.projected_location
+        self.assertEquals(
+            self.adapter.search(location.x, location.y + 50, radius=20), [])
+
+
+class GridIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = spatialindex.GridIndex(
+            [(1, 'one', 0.0, 0.0),
+             (2, 'two', 30.0, 0.0),
+             (3, 'three', 260.0, 0.0),
+             (4, 'four', -10.0, -10.0)],
+            cell_size=100.0)
+
+    def test_nearest_first(self):
+        self.assertEquals(
+            [point_id for point_id, name, distance in
+             self.index.nearest(25.0, 0.0, 50.0, limit=5)],
+            [2, 1, 4])
+
+    def test_limit(self):
+        self.assertEquals(len(self.index.nearest(0.0, 0.0, 50.0, limit=2)),
+                          2)
+
+    def test_across_cells(self):
+        self.assertEquals(self.index.nearest(240.0, 0.0, 25.0, limit=5),
+                          [(3, 'three', 20.0)])
+
+
+class InMemoryHoverSearchTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 3
+
+    def setUp(self):
+        spatialindex.clear()
+        super(InMemoryHoverSearchTest, self).setUp()
+        self.measurement_id = self.point.measurement.id
+
+    def test_lazily_built_once(self):
+        location = self.point.projected_location
+        with self.assertNumQueries(1):
+            spatialindex.nearest(self.measurement_id, location.x, location.y,
+                                 20, 5)
+        with self.assertNumQueries(0):
+            found = spatialindex.nearest(
+                self.measurement_id, location.x, location.y, 20, 5)
+        self.assertEquals(found, [(self.point.id, self.point.name, 0.0)])
+
+    def test_rebuilt_after_version_bump(self):
+        index = spatialindex.get_index(self.measurement_id)
+        models.bump_points_version(self.measurement_id)
+        self.assertNotEquals(spatialindex.get_index(self.measurement_id),
+                             index)
+
+
+class DownsampleTest(TestCase):
+
+    def test_short_line_untouched(self):
+        line = [(1, 1.0), (2, 2.0)]
+        self.assertEquals(models.downsample(line, 10), line)
+
+    def test_keeps_peaks(self):
+        line = [(time, 0.0) for time in range(1000)]
+        line[500] = (500, 10.0)
+        result = models.downsample(line, 100)
+        self.assertTrue(len(result) <= 100)
+        self.assertTrue((500, 10.0) in result)
+        self.assertEquals(result, sorted(result))
+
+
+class PopupTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 5
+
+    def setUp(self):
+        super(PopupTest, self).setUp()
+        self.adapter = layers.GeodinPoints(
+            None, layer_arguments={'measurement_id': self.point.measurement.id})
+        self.point_ids = list(self.point.measurement.points.order_by(
+                '-id').values_list('id', flat=True))
+
+    def test_one_query(self):
+        with self.assertNumQueries(1):
+            html = self.adapter.html(
+                identifiers=[{'point_id': point_id}
+                             for point_id in self.point_ids])
+        self.assertEquals(html.count('data-flot-graph-data='), 5)
+
+    def test_order_preserved(self):
+        html = self.adapter.html(
+            identifiers=[{'point_id': point_id}
+                         for point_id in self.point_ids])
+        positions = [html.index('/flot/%s/' % point_id)
+                     for point_id in self.point_ids]
+        self.assertEquals(positions, sorted(positions))
+
+    def test_no_geodin_call(self):
+        # Without a local timeseries the graph loads it from the flot url.
+        self.point.packed_series = None
+        self.point.source_url = None
+        self.point.save()
+        html = self.adapter.html(
+            identifiers=[{'point_id': point_id}
+                         for point_id in self.point_ids])
+        self.assertEquals(html.count('data-flot-graph-data='), 4)
+        self.assertEquals(layers.popup_flot_data(self.point), None)
+
+    def test_unknown_point(self):
+        self.assertRaises(Http404, self.adapter.html,
+                          identifiers=[{'point_id': 0}])
+
+
+class LookupIndexTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 2
+
+    def test_lookups_find_the_point(self):
+        for description, queryset in benchmark.lookup_querysets(self.point):
+            self.assertTrue(queryset.exists(), description)
+
+    def test_explain(self):
+        for description, queryset in benchmark.lookup_querysets(self.point):
+            self.assertTrue(benchmark.explain(queryset))
+
+    def test_point_slug_is_unique(self):
+        self.assertRaises(IntegrityError, models.Point.objects.create,
+                          slug=self.point.slug)
+
+
+class AlarmsTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 3
+
+    def setUp(self):
+        super(AlarmsTest, self).setUp()
+        # The synthetic points all have 1.0 as current value.
+        self.point.measurement.points.update(warning_level=0.5,
+                                             critical_level=2.0)
+        models.Point.objects.filter(pk=self.point.pk).update(
+            critical_level=1.0)
+
+    def states(self):
+        return dict(models.Point.objects.values_list('id', 'alarm_state'))
+
+    def test_evaluate(self):
+        self.assertEquals(alarms.evaluate(), 3)
+        states = self.states()
+        self.assertEquals(states.pop(self.point.id), models.ALARM_CRITICAL)
+        self.assertEquals(set(states.values()), set([models.ALARM_WARNING]))
+
+    def test_unchanged_points_untouched(self):
+        alarms.evaluate()
+        self.assertEquals(alarms.evaluate(), 0)
+
+    def test_peak_and_since(self):
+        alarms.evaluate()
+        since = models.Point.objects.get(pk=self.point.pk).alarm_since
+        models.Point.objects.filter(pk=self.point.pk).update(
+            current_value=3.0)
+        alarms.evaluate()
+        models.Point.objects.filter(pk=self.point.pk).update(
+            current_value=1.5)
+        alarms.evaluate()
+        point = models.Point.objects.get(pk=self.point.pk)
+        self.assertEquals(point.alarm_peak, 3.0)
+        self.assertEquals(point.alarm_since, since)
+
+    def test_back_to_ok(self):
+        alarms.evaluate()
+        models.Point.objects.update(current_value=0.0)
+        alarms.evaluate()
+        self.assertEquals(
+            models.Point.objects.filter(alarm_since__isnull=False).count(),
+            0)
+
+    def test_view(self):
+        alarms.evaluate()
+        with self.assertNumQueries(1):
+            response = self.client.get('/alarms/')
+        result = json.loads(response.content)
+        self.assertEquals(len(result), 3)
+        self.assertEquals(result[0]['id'], self.point.id)
+        self.assertEquals(result[0]['state'], 'critical')
+
+
+class SampleHistoryTest(SmallDatasetMixin, TestCase):
+
+    def test_synthetic_samples(self):
+        self.assertEquals(self.point.samples.count(),
+                          len(benchmark.synthetic_timeseries()))
+
+    def test_deduplicated(self):
+        self.assertEquals(
+            self.point.store_samples(benchmark.synthetic_timeseries()), 0)
+
+    def test_appended(self):
+        the_json = benchmark.synthetic_timeseries(num_values=72)
+        self.assertEquals(self.point.store_samples(the_json[24:]), 24)
+        self.assertEquals(self.point.samples.count(), 72)
+
+    def test_unusable_timesteps(self):
+        self.assertEquals(
+            self.point.store_samples([{'Date': '2012-10-01T00:00:00',
+                                       'Value': None},
+                                      {'Value': 1.0}]),
+            0)
+
+    def test_parse_geodin_date(self):
+        self.assertEquals(
+            models.parse_geodin_date('2012-09-07T01:00:00').utcoffset(),
+            datetime.timedelta(0))
+
+
+class ConcurrentSamplesTest(TransactionTestCase):
+    # Threads have their own connection, so they need committed data.
+
+    def test_stored_twice_at_the_same_time(self):
+        point = create_small_dataset()
+        the_json = benchmark.synthetic_timeseries(num_values=500)
+        start = threading.Event()
+        results = []
+
+        def store():
+            start.wait()
+            try:
+                results.append(models.Point.objects.get(
+                        pk=point.pk).store_samples(the_json))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=store) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sum(results), 500 - 48)
+        self.assertEquals(point.samples.count(), 500)
+        daily = point.rollups.filter(level=history.RESOLUTIONS[-1])
+        self.assertEquals(sum(daily.values_list('num_values', flat=True)),
+                          500)
+
+
+class HistoryTest(SmallDatasetMixin, TestCase):
+
+    def setUp(self):
+        super(HistoryTest, self).setUp()
+        self.url = '/flot/%s/' % self.point.id
+
+    def test_parse_time(self):
+        self.assertEquals(history.parse_time('2012-09-07'),
+                          history.parse_time('1346976000000'))
+
+    def test_resolution(self):
+        start = history.parse_time('2012-09-01')
+        self.assertEquals(
+            history.resolution(start, start + datetime.timedelta(hours=1)),
+            None)
+        self.assertEquals(
+            history.resolution(start, start + datetime.timedelta(days=7)),
+            10 * 60)
+        self.assertEquals(
+            history.resolution(start, start + datetime.timedelta(days=3650)),
+            24 * 60 * 60)
+
+    def test_raw_samples(self):
+        line = history.sample_line(
+            self.point.id,
+            history.parse_time('2012-09-07T00:00:00'),
+            history.parse_time('2012-09-07T06:00:00'))
+        self.assertEquals(len(line), 6)
+        self.assertEquals(line[1], (history.parse_time('2012-09-07T01:00'),
+                                    0.1))
+
+    def test_daily_averages(self):
+        line = history.sample_line(
+            self.point.id,
+            history.parse_time('2012-01-01'),
+            history.parse_time('2013-01-01'),
+            width=100)
+        self.assertEquals(len(line), 2)
+        self.assertAlmostEquals(line[0][1], 1.15)
+
+    def test_flot_view(self):
+        response = self.client.get(self.url, {'start': '2012-09-07',
+                                              'end': '2012-09-08'})
+        data = json.loads(response.content)['data']
+        self.assertEquals(len(data[0]['data']), 24)
+
+    def test_invalid_period(self):
+        response = self.client.get(self.url, {'start': 'yesterday-ish'})
+        self.assertEquals(response.status_code, 400)
+
+
+class RollupTest(SmallDatasetMixin, TestCase):
+
+    def test_created_with_samples(self):
+        daily = self.point.rollups.filter(level=24 * 60 * 60)
+        self.assertEquals([rollup.num_values for rollup in daily], [24, 24])
+        self.assertEquals(daily[0].min_value, 0.0)
+        self.assertEquals(daily[0].max_value, 2.3)
+        self.assertAlmostEquals(daily[0].mean, 1.15)
+
+    def test_updated_incrementally(self):
+        the_json = benchmark.synthetic_timeseries(num_values=72)
+        self.point.store_samples(the_json[30:])
+        hourly = self.point.rollups.filter(level=60 * 60)
+        self.assertEquals(hourly.count(), 72)
+        daily = self.point.rollups.filter(level=24 * 60 * 60)
+        self.assertEquals([rollup.num_values for rollup in daily],
+                          [24, 24, 24])
+
+    def test_coarsest_level_for_width(self):
+        start = history.parse_time('2012-09-01')
+        end = start + datetime.timedelta(days=30)
+        self.assertEquals(history.resolution(start, end, width=30),
+                          24 * 60 * 60)
+        self.assertEquals(history.resolution(start, end, width=500),
+                          60 * 60)
+        self.assertEquals(history.resolution(start, end, width=5000),
+                          None)
+
+
+class ExportTest(SmallDatasetMixin, TestCase):
+
+    points_per_measurement = 2
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.measurement = self.point.measurement
+        self.start = history.parse_time('2012-09-07')
+        self.end = history.parse_time('2012-09-09')
+
+    def test_raw_rows(self):
+        rows = list(export.rows(
+                export.select_points(measurement_id=self.measurement.id),
+                self.start, self.end))
+        self.assertEquals(len(rows), 2 * 48)
+        self.assertEquals(rows[1], (self.point.slug,
+                                    history.parse_time('2012-09-07T01:00'),
+                                    0.1))
+
+    def test_keyset_chunks(self):
+        old_chunk_size = export.CHUNK_SIZE
+        export.CHUNK_SIZE = 10
+        try:
+            rows = list(export.rows(
+                    export.select_points(measurement_id=self.measurement.id),
+                    self.start, self.end))
+        finally:
+            export.CHUNK_SIZE = old_chunk_size
+        self.assertEquals(len(rows), 2 * 48)
+        self.assertEquals(len(set(rows)), 2 * 48)
+
+    def test_rollup_rows(self):
+        rows = list(export.rows(
+                export.select_points(project_slug='project-0'),
+                self.start, self.end, rollup_level=24 * 60 * 60))
+        self.assertEquals(len(rows), 2 * 2)
+        self.assertEquals(rows[0][-1], 24)
+
+    def test_level(self):
+        self.assertEquals(export.level('raw', self.start, self.end), None)
+        self.assertEquals(export.level('3600', self.start, self.end), 3600)
+        self.assertRaises(ValueError, export.level, '42', self.start,
+                          self.end)
+
+    def test_csv_view(self):
+        response = self.client.get(
+            '/export/measurement/%s.csv' % self.measurement.id,
+            {'start': '2012-09-07', 'end': '2012-09-09'})
+        lines = ''.join(response).splitlines()
+        self.assertEquals(lines[0], 'point,timestamp,value')
+        self.assertEquals(len(lines), 1 + 2 * 48)
+
+    def test_ndjson_view(self):
+        response = self.client.get(
+            '/export/supplier/%s.ndjson' % self.measurement.supplier.slug,
+            {'start': '2012-09-07', 'end': '2012-09-09',
+             'resolution': '86400'})
+        lines = ''.join(response).splitlines()
+        self.assertEquals(json.loads(lines[0])['count'], 24)
+
+    def test_unknown_project(self):
+        response = self.client.get('/export/project/nonexisting.csv')
+        self.assertEquals(response.status_code, 404)
+
+
+class DayPartitionTest(TestCase):
+
+    def test_days(self):
+        days = list(export.days(history.parse_time('2012-09-07T13:00'),
+                                history.parse_time('2012-09-09T00:00')))
+        self.assertEquals(days, [history.parse_time('2012-09-07'),
+                                 history.parse_time('2012-09-08')])
+
+    def test_partition_path(self):
+        self.assertEquals(
+            export.partition_path('/tmp/out', 'project-0', 3,
+                                  history.parse_time('2012-09-07')),
+            '/tmp/out/project=project-0/measurement=3/day=2012-09-07/'
+            'samples.parquet')
+
+    def test_partition_path_without_project(self):
+        self.assertEquals(
+            export.partition_path('/tmp/out', None, 3,
+                                  history.parse_time('2012-09-07')),
+            '/tmp/out/project=__none__/measurement=3/day=2012-09-07/'
+            'samples.parquet')
+
+    def test_complete_until(self):
+        now = history.parse_time('2012-09-14T13:00')
+        self.assertEquals(export.complete_until(now),
+                          history.parse_time('2012-09-07'))
+        with override_settings(GEODIN_LOOKBACK_DAYS=0):
+            self.assertEquals(export.complete_until(now),
+                              history.parse_time('2012-09-14'))
+
+    def test_state(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            self.assertEquals(export.read_state(output_dir), {})
+            state = {3: history.parse_time('2012-09-07')}
+            export.write_state(output_dir, state)
+            self.assertEquals(export.read_state(output_dir), state)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_day_columns(self):
+        point = create_small_dataset(2)
+        columns = export.day_columns(point.measurement.id,
+                                     history.parse_time('2012-09-08'))
+        self.assertEquals(len(columns['point']), 2 * 24)
+        self.assertEquals(columns['timestamp'][0], 1347062400000)
+        self.assertEquals(set(columns['supplier']),
+                          set([point.measurement.supplier.slug]))
+
+
+class CompressionTest(TestCase):
+
+    def assertRoundtrip(self, timestamps, values):
+        result_timestamps, result_values = compression.unpack(
+            compression.pack(timestamps, values))
+        self.assertEquals(list(result_timestamps), timestamps)
+        self.assertEquals(len(result_values), len(values))
+        for result, value in zip(result_values, values):
+            if math.isnan(value):
+                self.assertTrue(math.isnan(result))
+            else:
+                self.assertEquals(result, value)
+
+    def test_empty(self):
+        self.assertRoundtrip([], [])
+
+    def test_single_value(self):
+        self.assertRoundtrip([1347000000], [1.5])
+
+    def test_regular_series(self):
+        self.assertRoundtrip(
+            [1347000000 + 600 * index for index in range(1000)],
+            [round(10 + math.sin(index / 50.0), 2) for index in range(1000)])
+
+    def test_irregular_series(self):
+        # All timestamp buckets, going back in time and large jumps.
+        self.assertRoundtrip(
+            [1347000000, 1347000600, 1347001230, 1347001400, 1347005000,
+             1347000000, 1647000000, 1647000001],
+            [0.0, -1.0, 1e300, -1e-300, float('nan'), float('inf'), 3.3,
+             3.3])
+
+    def test_packed_smaller(self):
+        the_json = benchmark.synthetic_timeseries(num_values=1000)
+        result = compression.benchmark(the_json, repeat=1)
+        self.assertEquals(result['num_values'], 1000)
+        self.assertTrue(result['packed_bytes'] * 5 < result['json_bytes'])
+
+    def test_json_to_arrays(self):
+        timestamps, values = compression.json_to_arrays(
+            [{'Date': '2012-09-07T00:00:00', 'Value': 1.0},
+             {'Date': '2012-09-07T01:00:00', 'Value': None},
+             {'Value': 2.0}])
+        self.assertEquals(list(timestamps), [1346976000, 1346979600])
+        self.assertEquals(values[0], 1.0)
+        self.assertTrue(math.isnan(values[1]))
+
+    def test_point_series(self):
+        point = create_small_dataset()
+        packed_line = point.timeseries()[0]['data']
+        # Points downloaded before the packing only have the json.
+        point.packed_series = None
+        point.downloaded_json = benchmark.synthetic_timeseries()
+        self.assertEquals(packed_line, point.timeseries()[0]['data'])
+        self.assertEquals(len(packed_line),
+                          len(benchmark.synthetic_timeseries()))
+
+    def test_last_value_of_empty_series(self):
+        point = models.Point()
+        point.pack_series([])
+        self.assertEquals(point.last_value(), None)
+
+    def test_packing_empties_the_json(self):
+        point = models.Point(downloaded_json=benchmark.synthetic_timeseries())
+        point.pack_series(point.downloaded_json)
+        self.assertEquals(point.downloaded_json, None)
+        self.assertTrue(point.packed_series)
+
+
+class SeriesStoreTest(SmallDatasetMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        seriesstore.clear()
+        self.directory = tempfile.mkdtemp()
+        super(SeriesStoreTest, self).setUp()
+
+    def tearDown(self):
+        seriesstore.clear()
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        seriesstore.write(1, [10, 20, 30], [1.0, 2.0, 3.0],
+                          directory=self.directory)
+        timestamps, values = seriesstore.read(1, directory=self.directory)
+        self.assertEquals(list(timestamps), [10, 20, 30])
+        self.assertEquals(list(values), [1.0, 2.0, 3.0])
+
+    def test_slice(self):
+        seriesstore.write(1, [10, 20, 30], [1.0, 2.0, 3.0],
+                          directory=self.directory)
+        timestamps, values = seriesstore.read(1, start=15, end=30,
+                                              directory=self.directory)
+        self.assertEquals(list(timestamps), [20])
+        self.assertEquals(list(values), [2.0])
+
+    def test_missing(self):
+        self.assertEquals(seriesstore.read(1, directory=self.directory),
+                          None)
+
+    def test_replaced_file_is_mapped_again(self):
+        seriesstore.write(1, [10], [1.0], directory=self.directory)
+        seriesstore.read(1, directory=self.directory)
+        seriesstore.write(1, [10, 20], [1.0, 2.0], directory=self.directory)
+        timestamps, values = seriesstore.read(1, directory=self.directory)
+        self.assertEquals(list(timestamps), [10, 20])
+
+    def test_flot_data_from_store(self):
+        expected = self.point.timeseries()[0]['data']
+        with override_settings(GEODIN_SERIES_STORE_DIR=self.directory):
+            self.point.json_downloaded(benchmark.synthetic_timeseries())
+            self.point.packed_series = None
+            self.assertEquals(self.point.timeseries()[0]['data'], expected)
+            response = self.client.get('/flot/%s/' % self.point.id)
+        self.assertEquals(json.loads(response.content)['data'][0]['data'],
+                          [list(value) for value in expected])
+
+    def test_flot_data_from_store_cached(self):
+        cache.clear()
+        cache_key = 'flot_data_False_%s_None_None_%s' % (self.point.id,
+                                                         history.WIDTH)
+        with override_settings(GEODIN_SERIES_STORE_DIR=self.directory):
+            self.point.json_downloaded(benchmark.synthetic_timeseries())
+            response = self.client.get('/flot/%s/' % self.point.id)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(cache.get(cache_key), response.content)
+
+
+@override_settings(GEODIN_LOCAL_ONLY=True)
+class LocalOnlyTest(SmallDatasetMixin, TestCase):
+
+    def setUp(self):
+        cache.clear()
+        super(LocalOnlyTest, self).setUp()
+        self.url = '/flot/%s/' % self.point.id
+
+    def test_pending_without_local_data(self):
+        self.point.packed_series = None
+        self.point.source_url = None
+        self.point.save()
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals(json.loads(response.content),
+                          {'status': 'pending'})
+        self.assertEquals(models.PendingFetch.objects.filter(
+                point=self.point).count(), 1)
+        # Asking again doesn't queue it twice.
+        self.client.get(self.url)
+        self.assertEquals(models.PendingFetch.objects.count(), 1)
+
+    def test_stale(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['stale'])
+        self.assertTrue(models.PendingFetch.objects.filter(
+                point=self.point).exists())
+
+    def test_fresh(self):
+        self.point.last_fetched = timezone.now()
+        self.point.save()
+        response = self.client.get(self.url)
+        self.assertFalse('stale' in json.loads(response.content))
+        self.assertFalse(models.PendingFetch.objects.exists())
+
+    def test_popup_without_local_data(self):
+        self.point.packed_series = None
+        self.assertEquals(layers.popup_flot_data(self.point), None)
+
+    def test_failed_fetch_stays_queued(self):
+        self.point.source_url = None
+        self.point.save()
+        self.point.request_fetch()
+        call_command('process_fetch_queue')
+        pending_fetch = models.PendingFetch.objects.get(point=self.point)
+        self.assertEquals(pending_fetch.attempts, 1)
+        self.assertTrue(pending_fetch.last_error)
+
+    def test_given_up_fetch_expires(self):
+        self.point.request_fetch()
+        models.PendingFetch.objects.update(attempts=5)
+        call_command('process_fetch_queue')
+        self.assertTrue(models.PendingFetch.objects.exists())
+        models.PendingFetch.objects.update(
+            requested=timezone.now() - datetime.timedelta(hours=2))
+        call_command('process_fetch_queue')
+        self.assertFalse(models.PendingFetch.objects.exists())
+        # The next request queues it again.
+        self.point.packed_series = None
+        self.point.save()
+        self.assertEquals(self.client.get(self.url).status_code, 202)
+        self.assertEquals(models.PendingFetch.objects.get().attempts, 0)
+
+    def test_pending_is_cached(self):
+        self.point.packed_series = None
+        self.point.save()
+        self.assertEquals(self.client.get(self.url).status_code, 202)
+        models.PendingFetch.objects.all().delete()
+        # Answered from the cache, without looking at the point again.
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals(response['Retry-After'],
+                          str(views.PENDING_RETRY_AFTER))
+        self.assertFalse(models.PendingFetch.objects.exists())
+        # It isn't kept as the previous graph.
+        cache_key = 'flot_data_False_%s_None_None_%s' % (self.point.id,
+                                                         history.WIDTH)
+        self.assertEquals(cache.get(singleflight.PREVIOUS_KEY.format(
+                    key=cache_key)), None)
+
+
+class ConcurrentFlotTest(SmallDatasetMixin, TransactionTestCase):
+    # Threads have their own connection, so they need committed data.
+
+    def setUp(self):
+        cache.clear()
+        super(ConcurrentFlotTest, self).setUp()
+
+    def test_concurrent_misses_compute_once(self):
+        point_id = str(self.point.id)
+        start = threading.Event()
+        computations = []
+        responses = []
+        original_flot_data = models.Point.__dict__['flot_data']
+
+        def flot_data(point, *args, **kwargs):
+            computations.append(1)
+            time.sleep(0.2)
+            return original_flot_data(point, *args, **kwargs)
+
+        def request():
+            start.wait()
+            try:
+                responses.append(views.point_flot_data(
+                        RequestFactory().get('/flot/%s/' % point_id),
+                        point_id=point_id))
+            finally:
+                connection.close()
+
+        models.Point.flot_data = flot_data
+        try:
+            threads = [threading.Thread(target=request) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            models.Point.flot_data = original_flot_data
+        self.assertEquals(len(computations), 1)
+        self.assertEquals([response.status_code for response in responses],
+                          [200] * 10)
+        self.assertEquals(len(set(response.content
+                                  for response in responses)), 1)
+
+
+class SingleFlightTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_previous_value_while_computing(self):
+        cache.set(singleflight.PREVIOUS_KEY.format(key='single_flight_test'),
+                  'old', 60)
+        cache.add(singleflight.LOCK_KEY.format(key='single_flight_test'),
+                  True, 60)
+        self.assertEquals(
+            singleflight.compute_once('single_flight_test', lambda: 'new',
+                                      30, wait=0.1),
+            'old')
+
+    def test_lock_released_after_error(self):
+        def compute():
+            raise ValueError()
+
+        self.assertRaises(ValueError, singleflight.compute_once,
+                          'single_flight_test', compute, 30)
+        self.assertEquals(
+            singleflight.compute_once('single_flight_test', lambda: 'new',
+                                      30),
+            'new')
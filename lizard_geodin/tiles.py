@@ -0,0 +1,110 @@
+# Rendered and cached 256x256 google tiles of a measurement's points.
+# from __future__ import unicode_literals  # Mapnik dislikes this.
+import hashlib
+import logging
+import math
+
+from django.core.cache import cache
+from lizard_map import coordinates
+import mapnik
+
+from lizard_geodin import layers
+from lizard_geodin import models
+
+TILE_SIZE = 256
+# Half the circumference of the earth in google (spherical mercator) meters.
+ORIGIN_SHIFT = math.pi * 6378137
+TILE_CACHE_KEY = 'geodin_tile_{id}_{version}_{style}_{zoom}_{x}_{y}'
+TILE_CACHE_TIMEOUT = 24 * 60 * 60  # The tiles version invalidates it.
+SEED_ZOOM_LEVELS = range(8, 15)
+# Deeper zoom levels than google/OSM go are refused.
+MAX_ZOOM = 20
+
+logger = logging.getLogger(__name__)
+
+
+def valid_tile(zoom, x, y):
+    """Return whether the xyz tile exists, up to ``MAX_ZOOM``."""
+    return 0 <= zoom <= MAX_ZOOM and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom
+
+
+def tile_for_location(location, zoom):
+    """Return (x, y) of the tile with the google location at the zoom."""
+    return tiles_for_extent({'west': location.x, 'east': location.x,
+                             'south': location.y, 'north': location.y},
+                            zoom)[0]
+
+
+def tile_bounds(zoom, x, y):
+    """Return (west, south, east, north) of a google/OSM xyz tile."""
+    tile_width = 2 * ORIGIN_SHIFT / 2 ** zoom
+    west = -ORIGIN_SHIFT + x * tile_width
+    north = ORIGIN_SHIFT - y * tile_width
+    return west, north - tile_width, west + tile_width, north
+
+
+def tiles_for_extent(extent, zoom):
+    """Return the (x, y) of the tiles that cover the google extent dict."""
+    tile_width = 2 * ORIGIN_SHIFT / 2 ** zoom
+    max_index = 2 ** zoom - 1
+
+    def index(value):
+        return min(max(int((value + ORIGIN_SHIFT) // tile_width), 0),
+                   max_index)
+
+    min_x, max_x = index(extent['west']), index(extent['east'])
+    # Tile rows count from the top.
+    min_y = max_index - index(extent['north'])
+    max_y = max_index - index(extent['south'])
+    return [(x, y)
+            for x in range(min_x, max_x + 1)
+            for y in range(min_y, max_y + 1)]
+
+
+def style_version(measurement):
+    """Return short hash of the style the measurement's points are drawn in.
+    """
+    color = layers.supplier_color(measurement.supplier)
+    return hashlib.md5(repr(layers._style_key(color))).hexdigest()[:8]
+
+
+def tile_cache_key(measurement, zoom, x, y):
+    return TILE_CACHE_KEY.format(
+        id=measurement.id,
+        version=models.tiles_version(measurement.id),
+        style=style_version(measurement),
+        zoom=zoom,
+        x=x,
+        y=y)
+
+
+def tile_layers(measurement, zoom):
+    """Return mapnik layers and styles: points or clusters at the zoom."""
+    adapter = layers.GeodinPoints(
+        None, layer_arguments={'measurement_id': measurement.id})
+    return adapter.layer(zoom=zoom)
+
+
+def render_tile(measurement, zoom, x, y):
+    """Return png data of the measurement's points on one tile."""
+    mapnik_layers, styles = tile_layers(measurement, zoom)
+    mapnik_map = mapnik.Map(TILE_SIZE, TILE_SIZE, coordinates.GOOGLE)
+    mapnik_map.background = mapnik.Color('transparent')
+    for name, style in styles.items():
+        mapnik_map.append_style(name, style)
+    for layer in mapnik_layers:
+        mapnik_map.layers.append(layer)
+    mapnik_map.zoom_to_box(mapnik.Box2d(*tile_bounds(zoom, x, y)))
+    image = mapnik.Image(TILE_SIZE, TILE_SIZE)
+    mapnik.render(mapnik_map, image)
+    return image.tostring('png')
+
+
+def get_tile(measurement, zoom, x, y):
+    """Return png data of the tile, from the cache if possible."""
+    cache_key = tile_cache_key(measurement, zoom, x, y)
+    png = cache.get(cache_key)
+    if png is None:
+        png = render_tile(measurement, zoom, x, y)
+        cache.set(cache_key, png, TILE_CACHE_TIMEOUT)
+    return png
@@ -22,6 +22,24 @@ urlpatterns = patterns(
     url(r'^flot/(?P<point_id>[^/]+)/$',
         views.point_flot_data,
         name='lizard_geodin_flot_data'),
+    url(r'^tiles/(?P<measurement_id>\d+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$',
+        views.tile_view,
+        name='lizard_geodin_tile'),
+    url(r'^points/(?P<measurement_id>\d+)/geojson/$',
+        views.points_geojson,
+        name='lizard_geodin_points_geojson'),
+    url(r'^points/(?P<measurement_id>\d+)/(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$',
+        views.points_mvt,
+        name='lizard_geodin_points_mvt'),
+    url(r'^export/(?P<kind>measurement|supplier|project)/(?P<key>[^/]+)\.(?P<output_format>csv|ndjson)$',
+        views.export_view,
+        name='lizard_geodin_export'),
+    url(r'^alarms/$',
+        views.alarms_view,
+        name='lizard_geodin_alarms'),
+    url(r'^metrics/$',
+        views.metrics_view,
+        name='lizard_geodin_metrics'),
 
     url(r'^point/$',
         views.PointListView.as_view(),
@@ -1,12 +1,22 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 from __future__ import unicode_literals
 from collections import defaultdict
+import base64
 import json
 
 # from lizard_map.views import MapView
-from django.core.cache import cache
+from django.contrib.gis.geos import Polygon
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Count
+from django.db.models import Q
+from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext as _
 from django.views.generic.base import TemplateView
 
@@ -15,7 +25,46 @@ from lizard_ui.views import UiView
 from lizard_ui.views import ViewContextMixin
 from lizard_map.views import AppView
 
+from lizard_geodin import alarms
+from lizard_geodin import export
+from lizard_geodin import history
+from lizard_geodin import metrics
 from lizard_geodin import models
+from lizard_geodin import profiling
+from lizard_geodin import singleflight
+from lizard_geodin import tiles
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django 1.4: a regular response streams an iterator just as well.
+    StreamingHttpResponse = HttpResponse
+
+TILE_MAX_AGE = 5 * 60  # Browser cache time for tiles, in seconds.
+VECTOR_MAX_AGE = 60  # Browser cache time for geojson/vector tiles.
+# How long a client should wait before asking again for a pending graph.
+PENDING_RETRY_AFTER = 5  # In seconds.
+PENDING_JSON = json.dumps({'status': 'pending'})
+FLOT_CACHE_TIMEOUT = 30  # In seconds.
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+MVT_QUERY = """
+SELECT ST_AsMVT(tile, 'points', %(extent)s, 'geom') FROM (
+    SELECT
+        id,
+        name,
+        current_value AS value,
+        %(color)s AS color,
+        ST_AsMVTGeom(
+            projected_location,
+            ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s, 3857),
+            %(extent)s, %(buffer)s, true) AS geom
+    FROM lizard_geodin_point
+    WHERE measurement_id = %(measurement_id)s
+    AND projected_location &&
+        ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s, 3857)
+) AS tile
+"""
 
 
 def _breadcrumb_element(obj):
@@ -24,6 +73,84 @@ def _breadcrumb_element(obj):
                   url=obj.get_absolute_url())
 
 
+def encode_cursor(point):
+    """Return an url-safe cursor pointing just after ``point``."""
+    return base64.urlsafe_b64encode(
+        json.dumps([point.name, point.slug]).encode('utf-8'))
+
+
+def decode_cursor(cursor):
+    """Return (name, slug) from the cursor or None if it is invalid."""
+    try:
+        name, slug = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    return name, slug
+
+
+def keyset_page(points, cursor, page_size):
+    """Return (page of points, next cursor) for the points after ``cursor``.
+
+    ``points`` must be ordered on name and slug, like ``Point.Meta``. Instead
+    of an OFFSET (which gets slower for every page), we ask the database for
+    the points after the last one we've shown. Postgres sorts empty names
+    last.
+
+    """
+    if cursor is not None:
+        name, slug = cursor
+        if name is None:
+            points = points.filter(name__isnull=True, slug__gt=slug)
+        else:
+            points = points.filter(Q(name__gt=name) |
+                                   Q(name=name, slug__gt=slug) |
+                                   Q(name__isnull=True))
+    page = list(points.order_by('name', 'slug')[:page_size + 1])
+    if len(page) > page_size:
+        page = page[:page_size]
+        return page, encode_cursor(page[-1])
+    return page, None
+
+
+class KeysetPaginationMixin(object):
+    """Paginate ``self.all_points()`` with an ``?after=<cursor>`` parameter.
+
+    ``all_points()`` may also return a list (of explicitly requested
+    points). That one is bounded by the URL length, so it isn't paginated.
+    """
+    paginate_by = 25
+
+    def _keyset_page(self):
+        if not hasattr(self, '_keyset_result'):
+            points = self.all_points()
+            if isinstance(points, list):
+                self._keyset_result = (points, None)
+            else:
+                cursor = self.request.GET.get('after')
+                if cursor is not None:
+                    cursor = decode_cursor(cursor)
+                self._keyset_result = keyset_page(
+                    points, cursor, self.paginate_by)
+        return self._keyset_result
+
+    def points(self):
+        return self._keyset_page()[0]
+
+    def next_page_url(self):
+        next_cursor = self._keyset_page()[1]
+        if next_cursor is not None:
+            query = self.request.GET.copy()
+            query['after'] = next_cursor
+            return '?' + query.urlencode()
+
+    def first_page_url(self):
+        if 'after' in self.request.GET:
+            query = self.request.GET.copy()
+            del query['after']
+            return '?' + query.urlencode()
+
+
 class ProjectsOverview(UiView):
     """Simple overview page with list of projects."""
     template_name = 'lizard_geodin/projects_overview.html'
@@ -39,8 +166,8 @@ class ProjectsOverview(UiView):
         return models.Supplier.objects.all()
 
     def measurements(self):
-        """Return all measurements."""
-        return models.Measurement.objects.all()
+        """Return all measurements, annotated with their number of points."""
+        return models.Measurement.objects.annotate(num_points=Count('points'))
 
     def api_starting_points(self):
         return models.ApiStartingPoint.objects.all()
@@ -77,7 +204,8 @@ class ProjectView(AppView):
     @property
     def suppliers(self):
         suppliers = defaultdict(list)
-        for measurement in self.project.measurements.all():
+        for measurement in self.project.measurements.select_related(
+            'supplier'):
             suppliers[measurement.supplier].append(measurement)
         result = []
         for supplier in sorted(suppliers.keys()):
@@ -112,7 +240,8 @@ class SupplierView(AppView):
     @property
     def projects(self):
         projects = defaultdict(list)
-        for measurement in self.supplier.measurements.all():
+        for measurement in self.supplier.measurements.select_related(
+            'project'):
             projects[measurement.project].append(measurement)
         result = []
         for project in sorted(projects.keys()):
@@ -154,23 +283,236 @@ class MeasurementView(UiView):
 
 
 def point_flot_data(request, point_id=None):
+    """Return flot json of the point's last week (or day).
+
+    Pass ``start`` and/or ``end`` (iso dates or flot's milliseconds) to get
+    any other period from the sample history, optionally with the graph's
+    ``width`` in pixels.
+
+    With the series store enabled, a cache miss for the last week (or day)
+    of a point with a series file is sliced straight from it.
+
+    In local-only mode (see ``models.local_only()``) geodin is never called:
+    without any local data we answer ``202`` with ``{"status": "pending"}``
+    and queue a background fetch; old data is returned with ``"stale":
+    true`` and a refresh is queued. The pending answer is cached for
+    ``PENDING_RETRY_AFTER`` seconds, so concurrent requests don't all wait
+    for it, but it never replaces a previous graph.
+
+    Concurrent cache misses are computed only once, see ``singleflight.py``.
+    """
     one_day_only = bool(request.GET.get('one_day_only'))
-    cache_key = 'flot_data_{one}_{id}'.format(one=one_day_only,
-                                              id=point_id)
-    the_json = cache.get(cache_key)
-    if the_json is None:
+    try:
+        start, end = [history.parse_time(request.GET[key])
+                      if request.GET.get(key) else None
+                      for key in ('start', 'end')]
+        width = int(request.GET.get('width', history.WIDTH))
+        if width < 1:
+            raise ValueError()
+    except ValueError:
+        return HttpResponseBadRequest("Invalid start, end or width")
+    cache_key = 'flot_data_{one}_{id}_{start}_{end}_{width}'.format(
+        one=one_day_only,
+        id=point_id,
+        start=start and start.isoformat(),
+        end=end and end.isoformat(),
+        width=width)
+    def compute():
         point = get_object_or_404(models.Point, pk=int(point_id))
-        data = point.timeseries(one_day_only=one_day_only)
-        result = {'data': data}
-        if data and 'max' in data[0]:
-            result['max'] = data[0]['max']
-            result['min'] = data[0]['min']
-        the_json = json.dumps(result,
-                              indent=2)
-        cache.set(cache_key, the_json, 30)
+        flot_data = point.flot_data(one_day_only=one_day_only,
+                                    start=start,
+                                    end=end,
+                                    width=width)
+        if (models.local_only() and start is None and end is None and
+            point.is_stale()):
+            point.request_fetch()
+            flot_data['stale'] = True
+        return json.dumps(flot_data, indent=2)
+
+    the_json = profiling.cache_get(cache_key)
+    metrics.inc('geodin_flot_cache_requests_total',
+                result='miss' if the_json is None else 'hit')
+    if the_json is None:
+        # Concurrent misses wait for one of them to compute it.
+        try:
+            the_json = singleflight.compute_once(cache_key, compute,
+                                                 FLOT_CACHE_TIMEOUT)
+        except models.FetchPending:
+            the_json = PENDING_JSON
+            profiling.cache_set(cache_key, the_json, PENDING_RETRY_AFTER)
+    if the_json == PENDING_JSON:
+        response = HttpResponse(the_json,
+                                mimetype='application/json',
+                                status=202)
+        response['Retry-After'] = str(PENDING_RETRY_AFTER)
+        return response
     return HttpResponse(the_json, mimetype='application/json')
 
 
+def tile_view(request, measurement_id=None, zoom=None, x=None, y=None):
+    """Return a cached png tile with the measurement's points."""
+    zoom, x, y = int(zoom), int(x), int(y)
+    if not tiles.valid_tile(zoom, x, y):
+        raise Http404("No such tile")
+    measurement = get_object_or_404(
+        models.Measurement.objects.select_related('supplier'),
+        pk=int(measurement_id))
+    png = tiles.get_tile(measurement, zoom, x, y)
+    response = HttpResponse(png, mimetype='image/png')
+    patch_cache_control(response, max_age=TILE_MAX_AGE)
+    return response
+
+
+def points_geojson(request, measurement_id=None):
+    """Return the measurement's points as GeoJSON (in WGS84).
+
+    Pass ``?bbox=west,south,east,north`` to get only the points in view.
+    """
+    measurement = get_object_or_404(
+        models.Measurement.objects.select_related('supplier'),
+        pk=int(measurement_id))
+    points = models.Point.objects.filter(
+        measurement=measurement,
+        location__isnull=False).only('id', 'name', 'current_value',
+                                     'location')
+    bbox = request.GET.get('bbox')
+    if bbox:
+        try:
+            bbox = Polygon.from_bbox(
+                [float(value) for value in bbox.split(',')])
+        except (ValueError, TypeError):
+            return HttpResponseBadRequest("Invalid bbox")
+        bbox.srid = 4326
+        # The && operator, so the spatial index does the work.
+        points = points.filter(location__bboverlaps=bbox)
+    color = measurement.supplier and measurement.supplier.html_color
+    features = [{'type': 'Feature',
+                 'id': point.id,
+                 'geometry': {'type': 'Point',
+                              'coordinates': [point.location.x,
+                                              point.location.y]},
+                 'properties': {'name': point.name,
+                                'color': color,
+                                'value': point.current_value}}
+                for point in points]
+    response = HttpResponse(
+        json.dumps({'type': 'FeatureCollection', 'features': features}),
+        mimetype='application/json')
+    patch_cache_control(response, max_age=VECTOR_MAX_AGE)
+    return response
+
+
+def points_mvt(request, measurement_id=None, zoom=None, x=None, y=None):
+    """Return a Mapbox vector tile with the measurement's points.
+
+    Postgis (2.4 or higher) builds the tile itself from an index-backed
+    bounding box query.
+    """
+    zoom, x, y = int(zoom), int(x), int(y)
+    if not tiles.valid_tile(zoom, x, y):
+        raise Http404("No such tile")
+    measurement = get_object_or_404(
+        models.Measurement.objects.select_related('supplier'),
+        pk=int(measurement_id))
+    west, south, east, north = tiles.tile_bounds(zoom, x, y)
+    cursor = connection.cursor()
+    cursor.execute(MVT_QUERY, {
+            'measurement_id': measurement.id,
+            'color': measurement.supplier and measurement.supplier.html_color,
+            'west': west,
+            'south': south,
+            'east': east,
+            'north': north,
+            'extent': MVT_EXTENT,
+            'buffer': MVT_BUFFER})
+    data = cursor.fetchone()[0]
+    response = HttpResponse(bytes(data or b''),
+                            mimetype='application/vnd.mapbox-vector-tile')
+    patch_cache_control(response, max_age=VECTOR_MAX_AGE)
+    return response
+
+
+def metrics_view(request):
+    """Return our metrics in prometheus' text format."""
+    project_slugs = models.Project.objects.filter(
+        active=True).values_list('slug', flat=True)
+    output = metrics.render(gauges=metrics.last_syncs(project_slugs))
+    return HttpResponse(output,
+                        mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def export_view(request, kind=None, key=None, output_format=None):
+    """Stream the sample history of a measurement, supplier or project.
+
+    Optional parameters: ``start`` and ``end`` (see ``point_flot_data``),
+    ``resolution`` (``raw``, ``auto`` or a rollup level in seconds) and
+    ``width`` for the ``auto`` resolution.
+    """
+    if kind == 'measurement':
+        if not key.isdigit():
+            raise Http404
+        get_object_or_404(models.Measurement, pk=int(key))
+        points = export.select_points(measurement_id=int(key))
+    elif kind == 'supplier':
+        get_object_or_404(models.Supplier, slug=key)
+        points = export.select_points(supplier_slug=key)
+    else:
+        get_object_or_404(models.Project, slug=key)
+        points = export.select_points(project_slug=key)
+    try:
+        start, end = [history.parse_time(request.GET[name])
+                      if request.GET.get(name) else None
+                      for name in ('start', 'end')]
+        start, end = history.period(start, end)
+        rollup_level = export.level(
+            request.GET.get('resolution', export.RAW), start, end,
+            width=int(request.GET.get('width', history.WIDTH)))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid start, end or resolution")
+    response = StreamingHttpResponse(
+        export.export(points, start, end, output_format=output_format,
+                      rollup_level=rollup_level),
+        mimetype=export.FORMATS[output_format])
+    response['Content-Disposition'] = (
+        'attachment; filename="%s-%s.%s"' % (kind, key, output_format))
+    return response
+
+
+def alarms_view(request):
+    """Return json list of the points that are over one of their levels.
+
+    Worst first, then the longest-running. Pass ``?project=<slug>`` to get
+    only one project's points.
+    """
+    points = models.Point.objects.filter(
+        alarm_state__gt=models.ALARM_OK).order_by('-alarm_state',
+                                                  'alarm_since')
+    if request.GET.get('project'):
+        points = points.filter(
+            measurement__project__slug=request.GET['project'])
+    points = points.values(
+        'id', 'slug', 'name', 'alarm_state', 'alarm_since', 'alarm_peak',
+        'current_value', 'warning_level', 'critical_level',
+        'measurement__name', 'measurement__project__slug')
+    result = [{'id': point['id'],
+               'slug': point['slug'],
+               'name': point['name'],
+               'state': alarms.ALARM_NAMES[point['alarm_state']],
+               'since': (point['alarm_since'] and
+                         point['alarm_since'].isoformat()),
+               'peak': point['alarm_peak'],
+               'value': point['current_value'],
+               'warning_level': point['warning_level'],
+               'critical_level': point['critical_level'],
+               'measurement': point['measurement__name'],
+               'project': point['measurement__project__slug'],
+               'url': reverse('lizard_geodin_point',
+                              kwargs={'slug': point['slug']})}
+              for point in points]
+    return HttpResponse(json.dumps(result, indent=2),
+                        mimetype='application/json')
+
+
 class MeasurementPopupView(ViewContextMixin, TemplateView):
     template_name = 'lizard_geodin/measurement_popup.html'
 
@@ -188,43 +530,98 @@ class MeasurementPopupView(ViewContextMixin, TemplateView):
         return self.measurement.points.all()[0]
 
 
-class PointListView(ViewContextMixin, TemplateView):
+class PointListView(KeysetPaginationMixin, ViewContextMixin, TemplateView):
     """Display a list of all points. Optionally provide point slugs as get parameters
+
+    The list is paginated; add ``?stream=1`` to get all points in one
+    streamed response instead.
     """
     template_name = 'lizard_geodin/point_list.html'
+    item_template_name = 'lizard_geodin/point_list_item.html'
+    stream_chunk_size = 500
+    stream_marker = '<!-- points -->'
 
     def filter_request_points(self, points):
         """Filter out items that are not selected in the filter pane.
+
+        The filter pane stores ``{'Supplier::<id>': 'true', 'Parameter::<id>':
+        'false', ...}`` in the session. Everything that isn't ``'true'`` is
+        excluded in the query itself.
         """
         filters = {}
         try:
             filters = self.request.session['filter-measurements']
         except:
             pass
-        result = []
-        for point in points:
-            filter_key = 'Supplier::%d' % point.measurement.supplier.id
-            filter_key_param = 'Parameter::%d' % point.measurement.parameter.id
-            if ((filter_key not in filters or filters[filter_key] == 'true') and
-                (filter_key_param not in filters or filters[filter_key_param] == 'true')):
-                # This object is wanted.
-                result.append(point)
-        return result
+        excluded = {'Supplier': [], 'Parameter': []}
+        for filter_key, value in filters.items():
+            if value == 'true':
+                continue
+            try:
+                kind, pk = filter_key.split('::')
+                pk = int(pk)
+            except ValueError:
+                continue
+            if kind in excluded:
+                excluded[kind].append(pk)
+        if excluded['Supplier']:
+            points = points.exclude(
+                measurement__supplier__id__in=excluded['Supplier'])
+        if excluded['Parameter']:
+            points = points.exclude(
+                measurement__parameter__id__in=excluded['Parameter'])
+        return points
 
-    def points(self):
+    def all_points(self):
+        """Return the wanted points, in the order of the slugs (if given)."""
+        points = models.Point.objects.select_related(
+            'measurement__supplier', 'measurement__parameter')
+        points = self.filter_request_points(points)
         slugs = self.request.GET.getlist('slug')
-        # if slugs:
-        #     points = points.filter(slug__in=slugs)
-
+        if not slugs:
+            return points
         # The points must be in the correct order.
-        if slugs:
-            points = []
-            for slug in slugs:
-                points.append(get_object_or_404(models.Point, slug=slug))
+        found = dict((point.slug, point)
+                     for point in points.filter(slug__in=slugs))
+        missing = set(slugs) - set(found)
+        if missing and (models.Point.objects.filter(slug__in=missing).count()
+                        < len(missing)):
+            # Not merely filtered out, but really unknown.
+            raise Http404
+        return [found[slug] for slug in slugs if slug in found]
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('stream'):
+            return StreamingHttpResponse(self.stream())
+        return super(PointListView, self).get(request, *args, **kwargs)
+
+    def stream(self):
+        """Yield the page, rendering the points in bounded chunks."""
+        page = render_to_string(self.template_name,
+                                {'view': self, 'streaming': True},
+                                context_instance=RequestContext(self.request))
+        head, tail = page.split(self.stream_marker)
+        yield head
+        points = self.all_points()
+        if isinstance(points, list):
+            chunks = [points]
         else:
-            points = models.Point.objects.all()
-        points = self.filter_request_points(points)
-        return points
+            chunks = self._stream_chunks(points)
+        for chunk in chunks:
+            yield ''.join(render_to_string(self.item_template_name,
+                                           {'point': point})
+                          for point in chunk)
+        yield tail
+
+    def _stream_chunks(self, points):
+        cursor = None
+        while True:
+            chunk, next_cursor = keyset_page(
+                points, cursor, self.stream_chunk_size)
+            yield chunk
+            if next_cursor is None:
+                return
+            cursor = decode_cursor(next_cursor)
 
 
 class PointView(ViewContextMixin, TemplateView):
@@ -263,8 +660,10 @@ class SidebarPointView(PointView):
     extra = False
 
 
-class MultiplePointsView(ViewContextMixin, TemplateView):
+class MultiplePointsView(KeysetPaginationMixin, ViewContextMixin,
+                         TemplateView):
     template_name = 'lizard_geodin/points.html'
+    paginate_by = 10
 
     @property
     def width(self):
@@ -274,10 +673,10 @@ class MultiplePointsView(ViewContextMixin, TemplateView):
     def height(self):
         return self.request.GET.get('height', 100)
 
-    @property
-    def points(self):
-        points = models.Point.objects.all()
+    def all_points(self):
+        points = models.Point.objects.select_related(
+            'measurement__supplier', 'measurement__parameter')
         slugs = self.request.GET.getlist('slug')
         if slugs:
             points = points.filter(slug__in=slugs)
-        return points[:10]  # max 10!
+        return points